@@ -1,67 +1,407 @@
-# ****************************************
-# |docname| - Test this server under load?
-# ****************************************
+#!/usr/bin/env python
+#
+# **********************************************
+# |docname| - Load test and benchmark the server
+# **********************************************
+# This file is both a `Locust <https://locust.io>`_ locustfile, which defines simulated users, and a command-line tool which runs a complete, reproducible load test:
+#
+# .. code-block:: text
+#
+#   python loadtest.py run [--users 50] [--duration 60s] [--workers 4] ...
+#   python loadtest.py compare results/old.json results/new.json
+#
+# ``run`` performs these steps:
+#
+# #.  Create a clean database using the ``loadtest`` configuration in `config.py` (which reads ``LOADTEST_DBURL``), then seed it with courses, questions and students using ``create_scale_data`` from `tests/conftest.py`. If ``LOADTEST_DBURL`` isn't set, use a `throwaway PostgreSQL server <tests/ephemeral_postgres.py>` instead, which is deleted afterwards.
+# #.  Write a synthetic book, with pages and static assets of realistic sizes, to ``runestone/book_server/templates/<base course>``.
+# #.  Start the server under gunicorn, then run Locust against it headless.
+# #.  Write a JSON report to ``loadtest_results/``. The report gives throughput and p50/p95/p99 latencies for each request type, plus the git commit tested. ``compare`` prints the differences between two reports, so runs of different commits can be compared.
+#
+# Recent Locust releases require a newer Flask than this server uses, so the Locust part of this file imports nothing from the server. Install Locust in a separate virtualenv if needed, then pass its path with ``--locust``. The simulated users get their course, question and student names from a plan file which ``run`` writes.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from datetime import datetime
+from html.parser import HTMLParser
+from itertools import count
+from pathlib import Path
+from random import Random
+from urllib.parse import urljoin
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
 
-from locust import HttpLocust, TaskSet, task
-from lxml import html
-import requests as rq
+# Third-party imports
+# -------------------
+# Locust is only needed by the simulated users, not by the ``run`` and ``compare`` commands, which launch it as a separate program.
+try:
+    from locust import HttpUser, task, between, events
+except ImportError:
+    HttpUser = None
 
+# Local imports
+# -------------
+# The server is imported only when needed; see above.
 
+ROOT = Path(__file__).resolve().parent
+RESULTS_DIR = ROOT / 'loadtest_results'
+# The percentiles reported.
+PERCENTILES = (0.5, 0.95, 0.99)
 
-def timeit(f):
 
-    def timed(*args, **kw):
+# Simulated users
+# ===============
+# Read the plan written by ``run``: the names created by ``seed``, as JSON.
+def load_plan():
+    with open(os.environ['LOADTEST_PLAN'], encoding='utf-8') as f:
+        return json.load(f)
 
-        ts = time.time()
-        result = f(*args, **kw)
-        te = time.time()
 
-        print('func:%r args:[%r, %r] took: %2.4f sec' % \
-          (f.__name__, args, kw, te-ts))
-        return result
+# Find every stylesheet, script and image referenced by a page, as a browser would.
+class AssetParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.assets = []
 
-    return timed
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'link' and attrs.get('rel') == 'stylesheet':
+            self.assets.append(attrs.get('href'))
+        elif tag in ('script', 'img'):
+            self.assets.append(attrs.get('src'))
 
-class SimpleTests(TaskSet):
 
-    @task
-    def index(self):
-        self.client.get("/", verify=False)
+# The arguments for an hsblog call of each event type, and the relative frequency of each type. The weights approximate a book in which multiple-choice and fill-in-the-blank questions are the most common.
+def event_args(rng, event, plan):
+    args = dict(event=event, act='', div_id=rng.choice(plan['questions']))
+    correct = rng.choice('TF')
+    if event == 'timedExam':
+        args.update(act=rng.choice(('finish', 'finish', 'finish', 'reset')), correct=rng.randint(0, 10), incorrect=rng.randint(0, 10), skipped=rng.randint(0, 3), time=rng.randint(60, 3600))
+    elif event in ('mChoice', 'fillb', 'dragNdrop', 'clickableArea'):
+        args.update(answer=rng.choice(('A', 'B', 'C', 'D')), correct=correct)
+    elif event in ('parsons', 'codelensq'):
+        args.update(answer='0_0-1_1-2_0', source='def f():\n    return 1\n', correct=correct)
+    elif event == 'shortanswer':
+        args.update(answer='A short answer ' + 'x'*rng.randint(0, 200))
+    elif event == 'lp_build':
+        args.update(answer='{"code_snippets": []}', correct=rng.randint(0, 100))
+    return args
 
-    @task
-    def home(self):
-        self.client.get("/runestone/course/index.html", verify=False)
-        self.getAllAssets()
+EVENT_WEIGHTS = dict(mChoice=30, fillb=15, dragNdrop=5, clickableArea=5, parsons=8, codelensq=4, shortanswer=8, lp_build=2, timedExam=3)
 
 
-    ## @task
-    ## def logrun(self):
-    ##     self.client.post("/runestone/ajax/hsblog",
-    ##         {'event': 'activecode', 'act': 'edit', 'div_id': 'logtest'},
-    ##         verify=False)
+if HttpUser:
+    # Give each simulated user its own random number generator, seeded from ``LOADTEST_SEED`` and the user's number, so that a run's requests are reproducible.
+    _user_numbers = count()
 
-    @task
-    def add(self):
-        return 2+2
+    class BookUser(HttpUser):
+        abstract = True
+        wait_time = between(1, 5)
 
-    @task
-    def dynamicpage(self):
-        self.r = self.client.get("/runestone/course/PythonTurtle/TheforLoop.html", verify=False)
-        self.getAllAssets()
+        def on_start(self):
+            self.plan = load_plan()
+            self.rng = Random(int(os.environ.get('LOADTEST_SEED', 1))*100003 + next(_user_numbers))
+            self.events = list(EVENT_WEIGHTS)
+            self.weights = list(EVENT_WEIGHTS.values())
 
-    def getAllAssets(self):
-        tree = html.fromstring(self.r.text)
-        csslinks = tree.xpath('//link/@href')
-        jslinks = tree.xpath('//script/@src')
-        base = self.r.url[:self.r.url.rfind('/')+1]
-        for l in csslinks:
-            rq.get(base + l, verify=False)
+        # Read a page and fetch its assets, grouping requests in the statistics by type rather than by URL.
+        def read_page(self, course):
+            page = self.rng.choice(self.plan['pages'])
+            url = '/runestone/{}/{}'.format(course, page)
+            with self.client.get(url, name='page', catch_response=True) as response:
+                if response.status_code != 200 or 'eBookConfig' not in response.text:
+                    response.failure('Bad page.')
+                    return
+            parser = AssetParser()
+            parser.feed(response.text)
+            for asset in parser.assets:
+                self.client.get(urljoin(url, asset), name='asset')
 
-        for l in jslinks:
-            rq.get(base + l, verify=False)
+        # Log an event, checking the response as the book's JavaScript would.
+        def log_event(self, course, is_authenticated):
+            event = self.rng.choices(self.events, self.weights)[0]
+            args = event_args(self.rng, event, self.plan)
+            args['course'] = course
+            name = 'hsblog {} {}'.format('authenticated' if is_authenticated else 'anonymous', event)
+            with self.client.get('/api/hsblog', params=args, name=name, catch_response=True) as response:
+                try:
+                    result = response.json()
+                except ValueError:
+                    response.failure('Invalid JSON.')
+                    return
+                if result.get('is_authenticated') != is_authenticated or 'log' not in result:
+                    response.failure('Unexpected response {}.'.format(result))
 
-class WebsiteUser(HttpLocust):
-    task_set = SimpleTests
-    min_wait = 5000
-    max_wait = 15000
-    host = "http://rstest"
+    # A visitor who reads books which don't require a login.
+    class AnonymousReader(BookUser):
+        weight = 1
+
+        def on_start(self):
+            super().on_start()
+            self.course = self.rng.choice(self.plan['public_courses'])
+
+        @task(3)
+        def read(self):
+            self.read_page(self.course)
+
+        @task(5)
+        def interact(self):
+            self.log_event(self.course, False)
+
+    # A student who logs in, then reads and answers questions.
+    class Student(BookUser):
+        weight = 3
+
+        def on_start(self):
+            super().on_start()
+            self.course = self.rng.choice(self.plan['login_courses'])
+            # The ``loadtest`` configuration disables CSRF protection, so no token is needed.
+            with self.client.post('/user/sign-in', name='login', catch_response=True, data=dict(
+                username=self.rng.choice(self.plan['users']),
+                password=self.plan['password'],
+            )) as response:
+                if response.status_code != 200 or 'sign-in' in response.url:
+                    response.failure('Login failed.')
+
+        @task(2)
+        def read(self):
+            self.read_page(self.course)
+
+        @task(8)
+        def answer(self):
+            self.log_event(self.course, True)
+
+    # Write a report once the test finishes.
+    @events.quitting.add_listener
+    def on_quitting(environment, **kwargs):
+        path = os.environ.get('LOADTEST_RESULTS')
+        if path:
+            write_report(environment.stats, path)
+
+
+# Reports
+# =======
+def _entry_report(entry):
+    report = dict(
+        requests=entry.num_requests,
+        failures=entry.num_failures,
+        rps=entry.total_rps,
+        avg_ms=entry.avg_response_time,
+    )
+    for percentile in PERCENTILES:
+        report['p{:g}_ms'.format(percentile*100)] = entry.get_response_time_percentile(percentile)
+    return report
+
+
+# Save Locust's statistics, along with the run's settings (passed from ``run`` in ``LOADTEST_INFO``).
+def write_report(stats, path):
+    report = json.loads(os.environ.get('LOADTEST_INFO', '{}'))
+    report['requests'] = {entry.name: _entry_report(entry) for entry in stats.entries.values()}
+    report['total'] = _entry_report(stats.total)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+# Print a comparison of two reports.
+def compare_reports(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print('Comparing {} ({}) to {} ({}).'.format(old_path, old.get('commit'), new_path, new.get('commit')))
+    columns = ['rps'] + ['p{:g}_ms'.format(p*100) for p in PERCENTILES]
+    print('{:40}'.format('Request') + ''.join('{:>24}'.format(column) for column in columns))
+    names = sorted(set(old['requests']) & set(new['requests'])) + ['total']
+    for name in names:
+        old_entry = old['total'] if name == 'total' else old['requests'][name]
+        new_entry = new['total'] if name == 'total' else new['requests'][name]
+        cells = []
+        for column in columns:
+            old_value, new_value = old_entry[column] or 0, new_entry[column] or 0
+            change = (new_value - old_value)/old_value*100 if old_value else 0
+            cells.append('{:>24}'.format('{:.1f} -> {:.1f} ({:+.0f}%)'.format(old_value, new_value, change)))
+        print('{:40}'.format(name) + ''.join(cells))
+
+
+# Setup
+# =====
+# Write a synthetic book with ``pages`` pages into ``templates_path/base_course``. Each page is a template which uses the same variables as a Sphinx-built book, and references stylesheets, scripts and an image sized like those of a typical book. Return the page names.
+def write_book(templates_path, base_course, pages):
+    book_path = Path(templates_path) / base_course
+    shutil.rmtree(str(book_path), ignore_errors=True)
+    (book_path / '_static').mkdir(parents=True)
+    (book_path / '_images').mkdir()
+    # File name: size in bytes.
+    assets = {
+        '_static/basic.css': 12000,
+        '_static/runestone-custom-sphinx-bootstrap.css': 30000,
+        '_static/jquery.js': 95000,
+        '_static/runestone.js': 450000,
+        '_images/figure.png': 40000,
+    }
+    rng = Random(0)
+    for name, size in assets.items():
+        (book_path / name).write_bytes(bytes(rng.getrandbits(8) for _ in range(size)))
+
+    page_names = ['chapter{}.html'.format(i) for i in range(pages)]
+    head = ''.join('<link rel="stylesheet" href="{}">'.format(name) for name in assets if name.endswith('.css'))
+    head += ''.join('<script src="{}"></script>'.format(name) for name in assets if name.endswith('.js'))
+    for page_name in page_names:
+        body = '<p>{}</p>'.format('Some text about programming. '*20)*50
+        (book_path / page_name).write_text(
+            '<html><head>{}<script>eBookConfig = {{course: "{{{{ basecourse }}}}", python3: {{{{ python3 }}}}, '
+            'loginRequired: {{{{ login_required }}}}}};</script></head><body>{}<img src="_images/figure.png"></body></html>'.format(head, body),
+            encoding='utf-8'
+        )
+    return page_names
+
+
+# Create and seed a clean database, returning the plan for the simulated users.
+def seed(courses, questions, students, pages):
+    os.environ['FLASK_CONFIG'] = 'loadtest'
+    from runestone import create_app, db
+    from runestone.book_server.server import book_server
+    from conftest import create_scale_data
+
+    app = create_app('loadtest')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        plan = create_scale_data(app, courses, questions, students, prefix='loadtest')
+        db.session.remove()
+    plan['pages'] = write_book(Path(book_server.root_path) / book_server.template_folder, plan['base_course'], pages)
+    return plan
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT), universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Start the server, returning its process. Use gunicorn when it's installed, since that's how the server is deployed.
+def start_server(port, workers):
+    env = dict(os.environ, FLASK_CONFIG='loadtest')
+    if shutil.which('gunicorn'):
+        args = ['gunicorn', '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port), 'wsgi:app']
+    else:
+        print('gunicorn not found; using the (single-process) Werkzeug server.')
+        args = [sys.executable, '-c', 'from werkzeug.serving import run_simple; from wsgi import app; run_simple("127.0.0.1", {}, app, threaded=True)'.format(port)]
+    server = subprocess.Popen(args, cwd=str(ROOT), env=env)
+    # Wait for it to accept connections.
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('The server failed to start.')
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('The server did not start.')
+
+
+# Run the load test, on a throwaway database server unless ``LOADTEST_DBURL`` names a database.
+def run(args):
+    sys.path.insert(0, str(ROOT / 'tests'))
+    from ephemeral_postgres import EphemeralPostgres, create_database
+
+    if os.environ.get('LOADTEST_DBURL'):
+        create_database(os.environ['LOADTEST_DBURL'])
+        load_test(args)
+        return
+
+    print('LOADTEST_DBURL is not set; starting a throwaway PostgreSQL server.')
+    server = EphemeralPostgres().start()
+    try:
+        # The server's workers inherit this.
+        os.environ['LOADTEST_DBURL'] = server.url('runestone_loadtest')
+        create_database(os.environ['LOADTEST_DBURL'])
+        load_test(args)
+    finally:
+        del os.environ['LOADTEST_DBURL']
+        server.stop()
+
+
+def load_test(args):
+    print('Seeding the database...')
+    plan = seed(args.courses, args.questions, args.students, args.pages)
+    RESULTS_DIR.mkdir(exist_ok=True)
+    commit = git_commit()
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    plan_path = RESULTS_DIR / 'plan-{}.json'.format(stamp)
+    with open(str(plan_path), 'w', encoding='utf-8') as f:
+        json.dump(plan, f)
+    results_path = RESULTS_DIR / '{}-{}.json'.format(stamp, commit)
+    info = dict(
+        commit=commit,
+        date=stamp,
+        settings={key: value for key, value in vars(args).items() if key not in ('func', 'locust')},
+    )
+
+    server = start_server(args.port, args.workers)
+    try:
+        env = dict(
+            os.environ,
+            LOADTEST_PLAN=str(plan_path),
+            LOADTEST_RESULTS=str(results_path),
+            LOADTEST_SEED=str(args.seed),
+            LOADTEST_INFO=json.dumps(info),
+        )
+        subprocess.check_call([
+            args.locust, '-f', __file__, '--headless', '--only-summary',
+            '--host', 'http://127.0.0.1:{}'.format(args.port),
+            '--users', str(args.users), '--spawn-rate', str(args.spawn_rate), '--run-time', args.duration,
+        ], cwd=str(ROOT), env=env)
+    finally:
+        server.terminate()
+        server.wait()
+        plan_path.unlink()
+    print('Results written to {}.'.format(results_path))
+
+
+# Main
+# ====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the Runestone server.')
+    subparsers = parser.add_subparsers()
+
+    run_parser = subparsers.add_parser('run', help='Seed a database, start the server, then load test it.')
+    run_parser.add_argument('--users', type=int, default=50, help='The number of simulated users.')
+    run_parser.add_argument('--spawn-rate', type=float, default=10, help='Users started per second.')
+    run_parser.add_argument('--duration', default='60s', help='How long to run, such as 60s or 5m.')
+    run_parser.add_argument('--workers', type=int, default=4, help='The number of gunicorn workers.')
+    run_parser.add_argument('--port', type=int, default=5001, help='The port for the server.')
+    run_parser.add_argument('--courses', type=int, default=10, help='The number of courses to create.')
+    run_parser.add_argument('--questions', type=int, default=200, help='The number of questions in the book.')
+    run_parser.add_argument('--students', type=int, default=200, help='The number of students to create.')
+    run_parser.add_argument('--pages', type=int, default=20, help='The number of pages in the book.')
+    run_parser.add_argument('--seed', type=int, default=1, help='The random seed for the simulated users.')
+    run_parser.add_argument('--locust', default='locust', help='The path to the locust program.')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two reports.')
+    compare_parser.add_argument('old', help='The baseline report.')
+    compare_parser.add_argument('new', help='The report to compare with the baseline.')
+    compare_parser.set_defaults(func=lambda args: compare_reports(args.old, args.new))
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
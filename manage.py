@@ -6,8 +6,8 @@
 # Execute ``python manage.py`` for a list of available commands.
 import os
 from runestone import create_app, db
-from runestone.model import Course, LogInfo
-from flask_script import Manager, Shell
+from runestone.model import Courses, Useinfo
+from flask_script import Manager, Shell, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
@@ -15,10 +15,134 @@ manager = Manager(app)
 migrate = Migrate(app, db)
 
 def make_shell_context():
-    return dict(app=app, db=db, Course=Course, LogInfo=LogInfo)
+    return dict(app=app, db=db, Courses=Courses, Useinfo=Useinfo)
 
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
+
+# Fill in the integer courses_id column of existing log and answer tables. See `backfill.py`.
+class BackfillCourseIds(Command):
+    option_list = (
+        Option('--batch-size', dest='batch_size', type=int, default=10000, help='Rows to update per transaction.'),
+    )
+
+    def run(self, batch_size):
+        from runestone.backfill import backfill_course_ids
+        backfill_course_ids(batch_size)
+
+manager.add_command('backfill-course-ids', BackfillCourseIds)
+
+
+# Recompute the per-student progress rollup from existing answers. See `runestone/progress.py`.
+class RebuildProgress(Command):
+    def run(self):
+        from runestone.progress import rebuild_question_progress
+        print('Rebuilt {} progress rows.'.format(rebuild_question_progress()))
+
+manager.add_command('rebuild-progress', RebuildProgress)
+
+
+# Recompute timed exam statistics from existing results. See `runestone/exam_stats.py`.
+class RebuildExamStats(Command):
+    def run(self):
+        from runestone.exam_stats import rebuild_timed_exam_stats
+        print('Rebuilt statistics for {} exams.'.format(rebuild_timed_exam_stats()))
+
+manager.add_command('rebuild-exam-stats', RebuildExamStats)
+
+
+# Move Useinfo rows into the compact layout. See `runestone/useinfo_storage.py`.
+class CompactUseinfo(Command):
+    option_list = (
+        Option('--batch-size', dest='batch_size', type=int, default=10000, help='Rows to move per transaction.'),
+    )
+
+    def run(self, batch_size):
+        from runestone.useinfo_storage import compact_useinfo
+        compact_useinfo(batch_size)
+
+manager.add_command('compact-useinfo', CompactUseinfo)
+
+
+# Copy rows logged before a date into a columnar archive. See `runestone/archive.py`.
+class Archive(Command):
+    option_list = (
+        Option('archive_dir', help='The directory to write the archive to.'),
+        Option('--before', dest='before', required=True, help='Archive rows logged before this date, as YYYY-MM-DD; typically the start of the current term.'),
+        Option('--course', dest='courses', action='append', help='A course to archive; repeat for more. Defaults to all courses.'),
+    )
+
+    def run(self, archive_dir, before, courses):
+        from datetime import datetime
+        from runestone.archive import archive
+        archive(archive_dir, datetime.strptime(before, '%Y-%m-%d'), courses)
+
+manager.add_command('archive', Archive)
+
+
+# Print statistics on a course's questions and timed exams. See `runestone/analytics.py`.
+class Report(Command):
+    option_list = (
+        Option('course', help='The course to report on.'),
+    )
+
+    def run(self, course):
+        from runestone.analytics import course_report
+        for name, report in course_report(course).items():
+            print('{}:\n{}\n'.format(name, report.to_string()))
+
+manager.add_command('report', Report)
+
+
+# Load a book's question manifest into the Questions table. See `load_questions.py`.
+class LoadQuestions(Command):
+    option_list = (
+        Option('base_course', help='The base course (book) these questions belong to.'),
+        Option('manifest', help='The path to the JSON question manifest produced by the book build.'),
+    )
+
+    def run(self, base_course, manifest):
+        from runestone.load_questions import read_manifest, load_questions
+        result = load_questions(base_course, read_manifest(manifest))
+        print('{}: {inserted} inserted, {updated} updated, {removed} removed in {seconds:.2f} s.'.format(base_course, **result))
+
+manager.add_command('load-questions', LoadQuestions)
+
+
+# Pre-render the pages of courses which don't require a login. See `runestone/book_server/snapshot.py`.
+class Snapshot(Command):
+    option_list = (
+        Option('courses', nargs='+', help='The courses to snapshot.'),
+        Option('--processes', dest='processes', type=int, default=None, help='The number of worker processes; defaults to one per CPU.'),
+    )
+
+    def run(self, courses, processes):
+        from runestone.book_server.snapshot import snapshot_course
+        for course in courses:
+            result = snapshot_course(course, app.config['SNAPSHOT_DIR'], os.getenv('FLASK_CONFIG') or 'default', processes)
+            print('{}: {pages} pages, {bytes} bytes in {seconds:.2f} s.'.format(course, **result))
+
+manager.add_command('snapshot', Snapshot)
+
+
+# Compile every book template into the shared bytecode cache. See `runestone/book_server/template_cache.py`.
+class CompileTemplates(Command):
+    option_list = (
+        Option('--processes', dest='processes', type=int, default=None, help='The number of worker processes; defaults to one per CPU.'),
+    )
+
+    def run(self, processes):
+        from runestone.book_server.template_cache import compile_templates
+        cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+        if not cache_dir:
+            raise SystemExit('Set JINJA_BYTECODE_CACHE_DIR to the bytecode cache directory.')
+        result = compile_templates(cache_dir, os.getenv('FLASK_CONFIG') or 'default', processes)
+        for error in result['errors']:
+            print(error)
+        print('{templates} templates compiled in {seconds:.2f} s; {0} could not be compiled.'.format(len(result['errors']), **result))
+
+manager.add_command('compile-templates', CompileTemplates)
+
 if __name__ == '__main__':
     manager.run()
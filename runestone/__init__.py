@@ -24,18 +24,34 @@ from config import config
 
 # Local imports
 # -------------
-from .extensions import db, bootstrap, mail
+from .extensions import db, bootstrap, cache, mail
 from .model import user_manager
+from . import instrumentation, metrics, profiling, rate_limit, routing, sessions, sid, spool, useinfo_storage
+from .book_server import template_cache
 
 
 def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
+    # This must precede any database use; see ``metrics.init_app``.
+    metrics.init_app(app)
+    # This must precede any use of ``app.jinja_env``; see ``template_cache.init_app``.
+    template_cache.init_app(app)
     bootstrap.init_app(app)
+    cache.init_app(app)
+    sessions.init_app(app)
+    # This adds database binds, so it must precede any database use.
+    routing.init_app(app)
     db.init_app(app)
     mail.init_app(app)
     user_manager.init_app(app)
+    instrumentation.init_app(app)
+    profiling.init_app(app)
+    useinfo_storage.init_app(app)
+    spool.init_app(app)
+    sid.init_app(app)
+    rate_limit.init_app(app)
 
     # TODO: Why put these here?
     from runestone.book_server.server import book_server
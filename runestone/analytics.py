@@ -0,0 +1,184 @@
+# ***********************************
+# |docname| - Course answer analytics
+# ***********************************
+# Instructors want to know, for each question in a course, how often it's answered correctly, how many tries students need, and how long they take to get it right. This module loads every answer in a course with one query, into a `pandas <https://pandas.pydata.org>`_ DataFrame, then computes these statistics with vectorized group-by operations rather than a Python loop over rows. Scores are computed by the database, using ``score_expression`` in `progress.py`. The statistics are reported by ``python manage.py report <course>`` and by the `course_analytics endpoint`.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+# None.
+#
+# Third-party imports
+# -------------------
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+import numpy as np
+import pandas as pd
+
+# Local imports
+# -------------
+from .backfill import course_id_models
+from .model import db, CorrectAnswerMixin, LpAnswers, TimedExam, Web2PyBoolean
+from .progress import score_expression
+
+
+# Loading
+# =======
+# Return the models whose answers have a score; see ``answer_score`` in `progress.py`.
+def scored_answer_models():
+    return [model for model in course_id_models() if issubclass(model, CorrectAnswerMixin) or model is LpAnswers]
+
+
+# Run ``query``, returning its rows as a DataFrame with the given column names. This reads the database driver's cursor directly, skipping SQLAlchemy's per-row result processing, so ``query`` must only return types the driver converts itself.
+def _fetch_frame(query, columns):
+    result = db.session.execute(query)
+    try:
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+    return pd.DataFrame(rows, columns=columns)
+
+
+# Convert ``codes``, the raw values of a Web2PyBoolean_ column as a string with one character per row (``T``, ``F``, or ``-`` for NULL), to a NumPy masked array of booleans in which NULLs are masked. This converts the whole column at once, rather than calling ``Web2PyBoolean.process_result_value`` for each value.
+def web2py_boolean_array(codes):
+    codes = np.frombuffer(codes.encode('ascii'), dtype='S1')
+    is_true = codes == b'T'
+    return np.ma.MaskedArray(is_true, mask=~(is_true | (codes == b'F')))
+
+
+# Return ``{name: array}`` holding the values of ``columns`` in the rows matching ``where``, sorted by ``order_by``. Instead of returning a row per match, PostgreSQL aggregates each column into a single value: a Web2PyBoolean_ column into one string of its raw characters, which becomes a masked array (see ``web2py_boolean_array``), and any other column into an array. No SQLAlchemy processing runs per row, and no Python object is created per Web2PyBoolean_ value. An aggregate is limited to 1 GB, which is tens of millions of rows of a short column.
+def load_columns(columns, where, order_by):
+    aggregates = []
+    for column in columns:
+        if isinstance(column.type, Web2PyBoolean):
+            # Fetch the raw ``CHAR(1)`` as text. Coalescing the Web2PyBoolean itself would bind ``'-'`` as a Web2PyBoolean, which converts it to ``'T'``.
+            code = db.func.coalesce(db.cast(column, db.Text), '-')
+            aggregates.append(db.func.string_agg(code, aggregate_order_by(db.literal_column("''"), order_by)))
+        else:
+            aggregates.append(db.func.array_agg(aggregate_order_by(column, order_by)))
+    values = db.session.execute(db.select(aggregates).where(where)).fetchone()
+
+    arrays = {}
+    for column, value in zip(columns, values):
+        if isinstance(column.type, Web2PyBoolean):
+            arrays[column.key] = web2py_boolean_array(value or '')
+        elif isinstance(column.type, (db.Integer, db.Float)):
+            # A NULL becomes NaN.
+            arrays[column.key] = np.array(value or [], dtype=float)
+        elif isinstance(column.type, db.DateTime):
+            arrays[column.key] = np.array(value or [], dtype='datetime64[us]')
+        else:
+            arrays[column.key] = np.array(value or [], dtype=object)
+    return arrays
+
+
+# Return every scored answer in ``course_name`` as a DataFrame with columns ``div_id``, ``sid``, ``timestamp`` and ``score`` (NaN if the answer has no score), sorted by question, student and time.
+def load_answers(course_name):
+    query = db.union_all(*[
+        db.select([
+            model.div_id, model.sid, model.timestamp, score_expression(model).label('score'),
+        ]).where(model.course_name == course_name)
+        for model in scored_answer_models()
+    ])
+    answers = _fetch_frame(query, ['div_id', 'sid', 'timestamp', 'score'])
+    answers['timestamp'] = pd.to_datetime(answers['timestamp'])
+    answers['score'] = answers['score'].astype(float)
+    return answers.sort_values(['div_id', 'sid', 'timestamp'], kind='stable', ignore_index=True)
+
+
+# Return every TimedExam_ attempt in ``course_name`` as a DataFrame with columns ``div_id``, ``sid``, ``timestamp``, ``correct``, ``incorrect``, ``skipped``, ``time_taken`` (NaN if missing) and ``reset``.
+def load_timed_exams(course_name):
+    columns = [TimedExam.div_id, TimedExam.sid, TimedExam.timestamp, TimedExam.correct, TimedExam.incorrect, TimedExam.skipped, TimedExam.time_taken, TimedExam.reset]
+    exams = pd.DataFrame(load_columns(columns, TimedExam.course_name == course_name, TimedExam.id))
+    # Only a reset is marked; a NULL means a result.
+    exams['reset'] = exams['reset'].fillna(False).astype(bool)
+    return exams
+
+
+# Statistics
+# ==========
+# Return a DataFrame indexed by div_id_, given ``answers`` from ``load_answers``, with the columns:
+#
+# attempts
+#   The number of answers.
+# students
+#   The number of students who answered.
+# correct_rate
+#   The fraction of answers which were correct.
+# students_correct
+#   The number of students who eventually answered correctly.
+# mean_attempts_to_correct
+#   Among those students, the mean number of answers up to and including their first correct one.
+# median_seconds_to_correct
+#   Among those students, the median time from their first answer to their first correct one.
+def question_report(answers):
+    student = [answers['div_id'], answers['sid']]
+    # Number each student's answers to a question: 1 for the first, and so on. This relies on ``load_answers``'s sort order.
+    attempt = answers.groupby(student, sort=False).cumcount() + 1
+    first_at = answers.groupby(student, sort=False)['timestamp'].transform('first')
+    correct = answers['score'] == 100
+
+    by_question = answers.groupby('div_id')
+    report = pd.DataFrame(dict(
+        attempts=by_question.size(),
+        students=by_question['sid'].nunique(),
+        correct_rate=correct.groupby(answers['div_id']).mean(),
+    ))
+
+    # Each student's first correct answer to each question.
+    firsts = pd.DataFrame(dict(
+        div_id=answers['div_id'], sid=answers['sid'], attempt=attempt,
+        seconds=(answers['timestamp'] - first_at).dt.total_seconds(),
+    ))[correct].drop_duplicates(['div_id', 'sid'])
+    by_question = firsts.groupby('div_id')
+    report['students_correct'] = by_question.size()
+    report['mean_attempts_to_correct'] = by_question['attempt'].mean()
+    report['median_seconds_to_correct'] = by_question['seconds'].median()
+    report['students_correct'] = report['students_correct'].fillna(0).astype(int)
+    return report
+
+
+# Return a DataFrame indexed by div_id_, given ``answers`` from ``load_answers``, whose column ``n`` gives the number of students who answered that question ``n`` times. The last column counts students who answered ``max_attempts`` or more times.
+def attempt_distribution(answers, max_attempts=10):
+    per_student = answers.groupby(['div_id', 'sid']).size()
+    attempts = np.minimum(per_student.to_numpy(), max_attempts)
+    distribution = pd.crosstab(per_student.index.get_level_values('div_id'), attempts)
+    distribution = distribution.reindex(columns=range(1, max_attempts + 1), fill_value=0)
+    distribution.index.name = 'div_id'
+    distribution.columns.name = None
+    return distribution
+
+
+# Return a DataFrame indexed by the timed exam's div_id_, given ``exams`` from ``load_timed_exams``, with the columns ``attempts``, ``students``, ``mean_score`` and ``median_score`` (as a percentage of the exam's questions), and ``mean_time_taken``. Attempts the student reset aren't results, so they're excluded.
+def timed_exam_report(exams):
+    exams = exams[~exams['reset']]
+    questions = exams['correct'] + exams['incorrect'] + exams['skipped']
+    score = 100*exams['correct']/questions.where(questions > 0)
+    by_exam = pd.DataFrame(dict(div_id=exams['div_id'], sid=exams['sid'], score=score, time_taken=exams['time_taken'])).groupby('div_id')
+    return pd.DataFrame(dict(
+        attempts=by_exam.size(),
+        students=by_exam['sid'].nunique(),
+        mean_score=by_exam['score'].mean(),
+        median_score=by_exam['score'].median(),
+        mean_time_taken=by_exam['time_taken'].mean(),
+    ))
+
+
+# Return every report for ``course_name`` as a dict of DataFrames.
+def course_report(course_name):
+    answers = load_answers(course_name)
+    return dict(
+        questions=question_report(answers),
+        attempts=attempt_distribution(answers),
+        timed_exams=timed_exam_report(load_timed_exams(course_name)),
+    )
+
+
+# Convert a report to a list of dicts suitable for JSON, with the index as the first field and None in place of NaN.
+def report_records(report):
+    report = report.reset_index()
+    report.columns = [str(column) for column in report.columns]
+    return report.astype(object).where(report.notna(), None).to_dict(orient='records')
@@ -9,18 +9,26 @@
 #
 # Standard library
 # ----------------
-import uuid
 from datetime import datetime
 from functools import wraps
 
 # Third-party imports
 # -------------------
-from flask import Blueprint, request, session, jsonify
-from flask_user import current_user, is_authenticated
+from flask import Blueprint, request, jsonify
+from flask_user import current_user, is_authenticated, login_required
 
 # Local imports
 # -------------
-from ..model import db, Useinfo, TimedExam, MchoiceAnswers, Courses, Questions, Web2PyBoolean, FitbAnswers, DragndropAnswers, ClickableareaAnswers, ParsonsAnswers, CodelensAnswers, ShortanswerAnswers, LpAnswers
+from ..model import db, Useinfo, UseinfoCompact, TimedExam, MchoiceAnswers, CourseInstructor, Web2PyBoolean, FitbAnswers, DragndropAnswers, ClickableareaAnswers, ParsonsAnswers, CodelensAnswers, ShortanswerAnswers, LpAnswers
+from ..progress import record_answer, progress_matrix
+from ..exam_stats import exam_score, exam_stats, record_timed_exam
+from ..inserts import insert_row
+from ..question_cache import question_cache
+from ..course_cache import course_info
+from ..metrics import count_hsblog_event
+from ..spool import log_useinfo
+from ..sid import get_sid, is_anonymous_sid, set_sid, new_sid
+from ..rate_limit import check_hsblog_limits
 
 # Blueprint
 # =========
@@ -179,84 +187,113 @@ def request_validation_handler(on_error_func):
 @api.route('/hsblog')
 @request_validation_handler( lambda e: jsonify(error=e.args[0], log=False, is_authenticated=is_authenticated()) )
 def log_book_event():
+    # Turn away floods, and shed load when the database is saturated, before doing any work. See `rate_limit.py`.
+    rejection = check_hsblog_limits()
+    if rejection:
+        return rejection
+
     is_auth = is_authenticated()
+    # See `sid.py`.
+    sid = get_sid()
     if is_auth:
         # ``current_user`` is a `proxy <https://flask-login.readthedocs.io/en/latest/#flask_login.current_user>`_ for the currently logged-in user. It returns ``None`` if no user is logged in.
-        sid = current_user.username
-        # If the user wasn't logged in, but is now, update all ``hsblog`` entries to their username.
-        session_sid = session.get('sid')
-        if session_sid != sid:
-            # Yes, so update all ``session_sid`` entries.
-            for _ in Useinfo[session_sid]:
-                _.sid = sid
-    else:
-        # Create a uuid for a user that's not logged in. See `request.cookies <http://flask.pocoo.org/docs/0.12/api/#flask.Request.cookies>`_.
-        if 'sid' in session:
-            sid = session['sid']
-        else:
-            # See `request.remove_addr <http://werkzeug.pocoo.org/docs/0.12/wrappers/#werkzeug.wrappers.BaseRequest.remote_addr>`_.
-            sid = str(uuid.uuid1().int) + "@" + request.remote_addr
+        username = current_user.username
+        # If the user wasn't logged in, but is now, update their anonymous ``hsblog`` entries to their username. A sid which isn't anonymous may belong to another user.
+        if sid is not None and sid != username and is_anonymous_sid():
+            # Rows may be in either layout; see `useinfo_storage.py`. Leave the updates for the commit which logs this event, which the `spool <spool.py>` limits to its latency budget.
+            with db.session.no_autoflush:
+                for model in (Useinfo, UseinfoCompact):
+                    for _ in model[sid]:
+                        _.sid = username
+        sid = username
+        set_sid(sid)
+    elif sid is None:
+        # Create an id for a user that's not logged in.
+        sid = new_sid()
+        set_sid(sid, anonymous=True)
 
-    # We set our own session anyway to eliminate many of the extraneous anonymous
+    # Otherwise, keep the sid even after the user's login expires, to eliminate many of the extraneous anonymous
     # log entries that come from auth timing out even but the user hasn't reloaded
-    # the page.
-    session['sid'] = sid
+    # the page. ``set_sid`` sends the sid cookie only if the sid changed.
     ts = datetime.now()
 
-    # Get and validate the request args. The event is validated inside ``if is_auth``.
-    course = generic_validator('course', lambda arg: Courses[arg].q.count(), 'Unknown course {1}.')
-    div_id = generic_validator('div_id', lambda arg: Questions[arg].q.count(), 'Unknown div_id {1}.')
+    # Get and validate the request args. The event is validated inside ``if is_auth``. Look up the course while validating it, since rows refer to the course by its courses_id_ and questions belong to its base course.
+    course = generic_validator('course', None, '')
+    the_course = course_info(course)
+    if the_course is None:
+        raise RequestValidationFailure('Unknown course {}.'.format(course))
+    course_id = the_course['id']
+    base_course = the_course['base_course']
+    div_id = generic_validator('div_id', None, '')
+    # The full Questions row for this event, from the `question_cache <question_cache.py>`; this costs no query once the base course is cached.
+    question = question_cache.get(base_course, div_id)
+    if question is None:
+        raise RequestValidationFailure('Unknown div_id {}.'.format(div_id))
     # Check string sizes for parameters not validated yet.
     event = sql_validator('event', Useinfo.act)
     act = sql_validator('act', Useinfo.act)
 
-    db.session.add(Useinfo(sid=sid, act=act, div_id=div_id, event=event, timestamp=ts, course_id=course))
-    db.session.commit()
+    # If the database is unavailable or slow, this row is `spooled <spool.py>` and stored later.
+    stored = log_useinfo(sid=sid, act=act, div_id=div_id, event=event, timestamp=ts, course_id=course, courses_id=course_id)
+    count_hsblog_event(event)
 
     if is_auth:
+        # Only Useinfo is spooled, so an answer can't be saved now.
+        if not stored:
+            return jsonify(log=False, is_authenticated=is_auth, error='The database is unavailable; please try again.')
+
 
         # Common arguments used below.
-        common_kwargs = dict(timestamp=ts, sid=sid, div_id=div_id, course_name=course)
+        common_kwargs = dict(timestamp=ts, sid=sid, div_id=div_id, course_name=course, courses_id=course_id)
 
         # A common pattern: add an answer only if the current answer isn't correct.
         def add_if_incorrect(model, **kwargs):
             # Has the user already submitted a correct answer for this question?
-            if model[sid, div_id, course][True].q.count() == 0:
+            if model[sid, div_id, course_id, course][True].q.count() == 0:
                 # No, so insert this answer.
-                db.session.add(model(
+                correct = sql_validator('correct', model.correct)
+                insert_row(model,
                     answer=sql_validator('answer', model.answer),
-                    correct=sql_validator('correct', model.correct),
+                    correct=correct,
                     **common_kwargs,
                     **kwargs
-                ))
+                )
+                # Keep the per-student progress rollup in step with the answers.
+                record_answer(sid, course_id, div_id, ts, correct)
 
         # Merge
         def merge(model, **kwargs):
             # Note: We can't use `merge <http://docs.sqlalchemy.org/en/latest/orm/session_state_management.html#unitofwork-merging>`_, because the primary key of XxxAnswers models is the ID, while we want to merge based on sid, div_id, and course. So, do the merge/upsert manually.
             combined_kwargs = dict(**kwargs, **common_kwargs)
-            rows = model[sid, div_id, course].q
+            rows = model[sid, div_id, course_id, course].q
             if rows.count() == 0:
                 # This entry doesn't exist. Add a new one.
-                db.session.add(model(**combined_kwargs))
+                insert_row(model, **combined_kwargs)
             else:
                 assert rows.count() == 1
                 # Only a signal entry exists. Merge fields into it. Note: this doesn't work: ``rows[0].__dict__.update(combined_kwargs)``.
                 for key, value in combined_kwargs.items():
                     setattr(rows[0], key, value)
+            # Short answers have no score, but still count as an attempt.
+            record_answer(sid, course_id, div_id, ts, None)
 
         if event == 'timedExam':
             if act not in ('finish', 'reset'):
                 # Return log=False on an invalid ``act``.
                 return jsonify(log=False, is_authenticated=is_auth)
 
-            db.session.add(TimedExam(
+            results = dict(
                 correct=sql_validator('correct', TimedExam.correct),
                 incorrect=sql_validator('incorrect', TimedExam.incorrect),
                 skipped=sql_validator('skipped', TimedExam.skipped),
                 time_taken=sql_validator('time', TimedExam.time_taken),
                 reset=act == 'reset' or None,
-                **common_kwargs,
-            ))
+            )
+            insert_row(TimedExam, **results, **common_kwargs)
+            # Keep the exam's statistics, and the student's progress, in step with its results. A reset isn't a result.
+            record_timed_exam(course_id, div_id, **results)
+            if not results['reset']:
+                record_answer(sid, course_id, div_id, ts, exam_score(results['correct'], results['incorrect'], results['skipped']))
 
         elif event == 'mChoice':
             add_if_incorrect(MchoiceAnswers)
@@ -282,3 +319,63 @@ def log_book_event():
 
     # See `jsonify <http://flask.pocoo.org/docs/0.12/api/#flask.json.jsonify>`_.
     return jsonify(log=True, is_authenticated=is_auth)
+
+
+# course_progress endpoint
+# ========================
+# Return the progress matrix for a course; see ``progress_matrix`` in `progress.py` for its format. Only instructors for the course may request this. Arguments:
+#
+# course
+#   The course to report on, which must match an entry in Courses.course_name.
+@api.route('/course_progress')
+@login_required
+@request_validation_handler( lambda e: jsonify(error=e.args[0]) )
+def course_progress():
+    course = instructor_course_validator()
+    return jsonify(course=course, progress=progress_matrix(course_info(course)['id']))
+
+
+# Return the validated ``course`` parameter, which must name a course the current user teaches.
+def instructor_course_validator():
+    course = generic_validator('course', course_info, 'Unknown course {1}.')
+    is_instructor = CourseInstructor[db.and_(
+        CourseInstructor.course == course_info(course)['id'],
+        CourseInstructor.instructor == current_user.id,
+    )].q.count()
+    if not is_instructor:
+        raise RequestValidationFailure('Not an instructor for course {}.'.format(course))
+    return course
+
+
+# _`course_analytics endpoint`
+# ============================
+# Return statistics on every question and timed exam in a course, computed by ``course_report`` in `analytics.py`. Each report is a list of rows: ``questions`` as described by ``question_report``, ``attempts`` by ``attempt_distribution`` (with each count keyed by the number of attempts, as a string) and ``timed_exams`` by ``timed_exam_report``. Only instructors for the course may request this. Arguments:
+#
+# course
+#   The course to report on, which must match an entry in Courses.course_name.
+@api.route('/course_analytics')
+@login_required
+@request_validation_handler( lambda e: jsonify(error=e.args[0]) )
+def course_analytics():
+    from ..analytics import course_report, report_records
+
+    course = instructor_course_validator()
+    return jsonify(course=course, **{name: report_records(report) for name, report in course_report(course).items()})
+
+
+# timed_exam_stats endpoint
+# =========================
+# Return the statistics of one timed exam; see ``exam_stats`` in `exam_stats.py` for their format. This reads a single row, however many students took the exam. Only instructors for the course may request this. Arguments:
+#
+# course
+#   The course to report on, which must match an entry in Courses.course_name.
+#
+# div_id
+#   The div_id_ of the timed exam.
+@api.route('/timed_exam_stats')
+@login_required
+@request_validation_handler( lambda e: jsonify(error=e.args[0]) )
+def timed_exam_stats():
+    course = instructor_course_validator()
+    div_id = sql_validator('div_id', TimedExam.div_id)
+    return jsonify(course=course, div_id=div_id, **exam_stats(course_info(course)['id'], div_id))
@@ -0,0 +1,161 @@
+# ******************************************
+# |docname| - Columnar archive of past terms
+# ******************************************
+# Analysis of past terms scans Useinfo_ and the answer tables, which are large row stores shared with the live site. ``python manage.py archive <dir> --before <date>`` copies every row logged before a date (typically, the start of the current term) into compressed `Parquet <https://parquet.apache.org/>`_ files, one per table, course and month::
+#
+#   <dir>/<table>/course=<course name>/month=<YYYY-MM>/part-0.parquet
+#
+# ``read_archive`` then loads one course's rows from these files, reading only the columns (and, optionally, the months) asked for, without touching the database. Parquet stores each column separately and compresses repeated strings such as event and div_id_ well, so the files are much smaller than the tables.
+#
+# Archiving only reads the database. Re-running it rewrites each partition it covers in full, so moving the date later (or archiving again after late rows arrive) never duplicates rows. Useinfo_ is read through `useinfo_view`_, so both `storage layouts <useinfo_storage.py>` are archived.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from itertools import groupby
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import quote
+import os
+
+# Third-party imports
+# -------------------
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Local imports
+# -------------
+from .backfill import course_id_models
+from .model import db, Useinfo, useinfo_view, Web2PyBoolean
+
+
+# Schemas
+# =======
+# Return the table to read ``model``'s rows from.
+def source_table(model):
+    return useinfo_view if model is Useinfo else model.__table__
+
+
+# Return the column of ``table`` which holds the course name; see course_id_ and course_name_.
+def course_column(table):
+    return table.c.course_id if table.name == useinfo_view.name else table.c.course_name
+
+
+def _arrow_type(column_type):
+    if isinstance(column_type, Web2PyBoolean):
+        return pa.bool_()
+    elif isinstance(column_type, db.Integer):
+        return pa.int32()
+    elif isinstance(column_type, db.Float):
+        return pa.float64()
+    elif isinstance(column_type, db.DateTime):
+        return pa.timestamp('us')
+    else:
+        return pa.string()
+
+
+# Return the Arrow schema of the archive of ``model``.
+def arrow_schema(model):
+    return pa.schema([pa.field(column.name, _arrow_type(column.type)) for column in source_table(model).columns])
+
+
+def _archive_models():
+    return {model.__tablename__: model for model in course_id_models()}
+
+
+# Writing
+# =======
+# Write ``rows`` of ``model`` to ``path``, first to a temporary file, so that readers never see a partial file.
+def _write_partition(path, model, rows, batch_size):
+    schema = arrow_schema(model)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + '.tmp')
+    count = 0
+    with pq.ParquetWriter(str(temp_path), schema, compression='zstd') as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.write_table(pa.Table.from_pylist([dict(row) for row in batch], schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist([dict(row) for row in batch], schema))
+            count += len(batch)
+    os.replace(str(temp_path), str(path))
+    return count
+
+
+def partition_path(archive_dir, table_name, course_name, month):
+    return Path(archive_dir) / table_name / 'course={}'.format(quote(course_name, safe='')) / 'month={}'.format(month) / 'part-0.parquet'
+
+
+# Archive every row of Useinfo_ and the answer tables with a timestamp before ``before``. Return ``{table_name: rows archived}``.
+def archive(
+    # The directory to write the archive to.
+    archive_dir,
+    # A date or datetime; rows logged before this are archived.
+    before,
+    # The names of the courses to archive, or None for all courses.
+    course_names=None,
+    # The number of rows to hold in memory while writing a file.
+    batch_size=100000,
+    # True to print progress.
+    verbose=True):
+
+    archived = {}
+    for table_name, model in sorted(_archive_models().items()):
+        start = perf_counter()
+        table = source_table(model)
+        course = course_column(table)
+        month_column = db.func.to_char(table.c.timestamp, 'YYYY-MM').label('archive_month')
+        query = db.select([month_column] + list(table.columns)).where(
+            db.and_(table.c.timestamp < before, course.isnot(None))
+        ).order_by(course, month_column, table.c.id)
+        if course_names is not None:
+            query = query.where(course.in_(course_names))
+        # Stream the rows using a server-side cursor, rather than loading the whole table into memory.
+        result = db.session.execute(query.execution_options(stream_results=True))
+        columns = [column.name for column in table.columns]
+        archived[table_name] = 0
+        for (course_name, month), rows in groupby(result, key=lambda row: (row[course.name], row['archive_month'])):
+            archived[table_name] += _write_partition(
+                partition_path(archive_dir, table_name, course_name, month), model,
+                (zip(columns, row[1:]) for row in rows), batch_size
+            )
+        if verbose:
+            print('{}: archived {} rows in {:.1f} s.'.format(table_name, archived[table_name], perf_counter() - start))
+    db.session.commit()
+    return archived
+
+
+# Reading
+# =======
+# Return the archived rows of ``table_name`` for one course as a `pyarrow.Table <https://arrow.apache.org/docs/python/generated/pyarrow.Table.html>`_; call its ``to_pandas()`` method for a DataFrame. This reads only the files for that course, and only the requested columns of them.
+def read_archive(
+    # The directory passed to ``archive``.
+    archive_dir,
+    # The table to read, such as ``useinfo`` or ``mchoice_answers``.
+    table_name,
+    # The course to read.
+    course_name,
+    # The names of the columns to read, or None for all of them.
+    columns=None,
+    # A list of months to read, as ``YYYY-MM`` strings, or None for all months.
+    months=None):
+
+    schema = arrow_schema(_archive_models()[table_name])
+    columns = schema.names if columns is None else columns
+    course_dir = partition_path(archive_dir, table_name, course_name, '').parent.parent
+    if not course_dir.is_dir():
+        return schema.empty_table().select(columns)
+    dataset = ds.dataset(
+        str(course_dir), schema=schema.append(pa.field('month', pa.string())), format='parquet',
+        partitioning=ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive'),
+    )
+    return dataset.to_table(columns=columns, filter=None if months is None else ds.field('month').isin(months))
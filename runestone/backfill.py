@@ -0,0 +1,144 @@
+# *************************************************************
+# |docname| - Backfill integer course ids into existing tables
+# *************************************************************
+# `model.py` gives Useinfo_ and every AnswerMixin_ table an integer courses_id_ column that refers to ``courses.id``. ``db.create_all()`` creates it for new databases. For a live database, ``python manage.py backfill-course-ids`` runs ``backfill_course_ids`` below. It adds the column, fills it in, and prints table and index sizes before and after.
+#
+# The work is done online. Each step either takes only a brief lock or runs as a short transaction, so web2py and this server keep working throughout:
+#
+# #.  The column is added as a nullable column with a ``NOT VALID`` foreign key, which needs no table rewrite or scan.
+# #.  Rows are filled in by ``id`` range, one committed batch at a time. A table is never locked for longer than one batch.
+# #.  The index is built with ``CREATE INDEX CONCURRENTLY``, then the foreign key is validated. Validating only needs a lock which allows reads and writes.
+#
+# The string course_id_ / course_name_ columns stay, since web2py still uses them, so the tables grow by the new column and index. Dropping the string columns, once web2py reads courses_id instead, is where the savings come from; that's a follow-up migration. After the size report, the backfill prints the space those columns hold today, which is what dropping them would save (once the tables are rewritten, for example by ``VACUUM FULL``).
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from time import perf_counter
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+from .model import db, Useinfo, AnswerMixin
+
+
+# Return all models with a courses_id_ column, in a stable order.
+def course_id_models():
+    models = [Useinfo]
+    # Walk the AnswerMixin class hierarchy, keeping only mapped classes (the mixins themselves aren't tables).
+    pending = list(AnswerMixin.__subclasses__())
+    while pending:
+        cls = pending.pop(0)
+        pending.extend(cls.__subclasses__())
+        if hasattr(cls, '__table__'):
+            models.append(cls)
+    return sorted(set(models), key=lambda model: model.__tablename__)
+
+
+# Size measurement
+# ================
+# Return ``{table_name: (table_bytes, index_bytes)}`` for the given table names, measured by PostgreSQL.
+def table_sizes(table_names):
+    sizes = {}
+    for table_name in table_names:
+        sizes[table_name] = db.session.execute(
+            db.text('select pg_table_size(:t), pg_indexes_size(:t)'), dict(t=table_name)
+        ).fetchone()
+    return sizes
+
+
+# Print a before/after size comparison, as produced by two calls to ``table_sizes``.
+def print_size_report(before, after):
+    def mb(size):
+        return '{:10.2f} MB'.format(size / 2**20)
+
+    print('{:30} {:>13} {:>13} {:>13} {:>13}'.format('Table', 'Table before', 'Table after', 'Index before', 'Index after'))
+    totals = [0, 0, 0, 0]
+    for table_name in sorted(before):
+        row = (before[table_name][0], after[table_name][0], before[table_name][1], after[table_name][1])
+        totals = [a + b for a, b in zip(totals, row)]
+        print('{:30} {} {} {} {}'.format(table_name, *map(mb, row)))
+    print('{:30} {} {} {} {}'.format('Total', *map(mb, totals)))
+
+
+# Return ``{table_name: bytes}``, the space used by the string course column of each of ``models``, measured by PostgreSQL. This excludes the alignment padding a row may lose without the column, so actual savings may be slightly higher.
+def course_name_sizes(models):
+    sizes = {}
+    for model in models:
+        table = model.__table__
+        column = table.c.course_id if model is Useinfo else table.c.course_name
+        sizes[table.name] = db.session.execute(
+            db.select([db.func.coalesce(db.func.sum(db.func.pg_column_size(column)), 0)])
+        ).scalar()
+    return sizes
+
+
+# Print the savings projected by ``course_name_sizes``.
+def print_projected_savings(sizes):
+    print('{:30} {:>13}'.format('Table', 'Drop saves'))
+    for table_name in sorted(sizes):
+        print('{:30} {:10.2f} MB'.format(table_name, sizes[table_name] / 2**20))
+    print('{:30} {:10.2f} MB'.format('Total', sum(sizes.values()) / 2**20))
+
+
+# Backfill
+# ========
+def backfill_course_ids(
+    # The number of ids to update per transaction. Larger batches are faster overall, but hold row locks for longer.
+    batch_size=10000,
+    # True to print progress and a size report.
+    verbose=True):
+
+    models = course_id_models()
+    table_names = [model.__tablename__ for model in models]
+    before = table_sizes(table_names)
+    db.session.commit()
+
+    # ``CREATE INDEX CONCURRENTLY`` can't run inside a transaction, so use an autocommit connection for the DDL.
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as ddl:
+        for model in models:
+            start = perf_counter()
+            table = model.__tablename__
+            # Each model names its course column differently; see course_id_ and course_name_.
+            name_column = 'course_id' if model is Useinfo else 'course_name'
+            fk_name = '{}_courses_id_fkey'.format(table)
+            index_name = 'ix_{}_courses_id'.format(table)
+
+            # Step 1: add the column and an unvalidated foreign key.
+            ddl.execute('alter table {} add column if not exists courses_id integer'.format(table))
+            has_fk = ddl.execute(db.text('select 1 from pg_constraint where conname = :c'), c=fk_name).scalar()
+            if not has_fk:
+                ddl.execute('alter table {} add constraint {} foreign key (courses_id) references courses (id) not valid'.format(table, fk_name))
+
+            # Step 2: fill it in, one ``id`` range per transaction. A keyset over ``id`` means each batch reads only its own rows.
+            min_id, max_id = ddl.execute('select min(id), max(id) from {}'.format(table)).fetchone()
+            updated = 0
+            if min_id is not None:
+                for low in range(min_id, max_id + 1, batch_size):
+                    updated += ddl.execute(db.text(
+                        'update {0} set courses_id = courses.id from courses '
+                        'where {0}.id >= :low and {0}.id < :high and {0}.courses_id is null '
+                        'and courses.course_name = {0}.{1}'.format(table, name_column)
+                    ), low=low, high=low + batch_size).rowcount
+
+            # Step 3: build the index without blocking writes, then validate the foreign key.
+            ddl.execute('create index concurrently if not exists {} on {} (courses_id)'.format(index_name, table))
+            ddl.execute('alter table {} validate constraint {}'.format(table, fk_name))
+
+            if verbose:
+                print('{}: backfilled {} rows in {:.1f} s.'.format(table, updated, perf_counter() - start))
+
+    after = table_sizes(table_names)
+    if verbose:
+        print_size_report(before, after)
+        print('Projected savings from dropping the string course columns:')
+        print_projected_savings(course_name_sizes(models))
+    db.session.commit()
+    return before, after
@@ -22,7 +22,8 @@ from flask_user import login_required, is_authenticated
 
 # Local imports
 # -------------
-from ..model import Courses
+from ..course_cache import course_info
+from ..metrics import STATIC_BYTES
 
 # Blueprint
 # =========
@@ -58,19 +59,27 @@ def serve_page(course, pageinfo):
     :param pageinfo: the path to the page that is desired to be served
     :return: filled page template
     '''
-    # Use the handy `query <http://flask-sqlalchemy.pocoo.org/2.3/queries/#querying-records>`_ attribute.
-    the_course = Courses[course].q.first()
+    # Look up the course through the `cache <course_cache.py>`, which usually avoids a query.
+    the_course = course_info(course)
     if not the_course:
         return redirect(f'http://runestone/errors/nocourse/{course}')
-    base_course = the_course.base_course
+    base_course = the_course['base_course']
     filesystem_path = safe_join(base_course, pageinfo)
 
     # Enforce is_login_required.
-    is_login_required = the_course.login_required
+    is_login_required = the_course['login_required']
     if is_login_required and not is_authenticated():
         # Redirect to unauthenticated page
         return current_app.user_manager.unauthenticated_view_function()
 
+    # Send a `snapshot <snapshot.py>` of this page if there is one.
+    if current_app.config.get('SERVE_SNAPSHOTS') and not is_login_required:
+        # Import here, since ``snapshot`` imports this module.
+        from .snapshot import snapshot_path
+        snapshot_dir = str(snapshot_path(current_app.config['SNAPSHOT_DIR'], the_course))
+        if os.path.isfile(safe_join(snapshot_dir, pageinfo)):
+            return send_from_directory(snapshot_dir, pageinfo)
+
     # See if this is static content in the book.
     if Path(pageinfo).parts[0] in ('_static', '_images'):
         # We have to efficiently serve all of the assets, this seems a common way to do so.
@@ -83,8 +92,10 @@ def serve_page(course, pageinfo):
         #
         # Book static files are inside the templates/ folder, so build this path manually.
         templates_path = str(Path(book_server.root_path) / book_server.template_folder)
-        return send_from_directory(templates_path, filesystem_path)
+        response = send_from_directory(templates_path, filesystem_path)
+        STATIC_BYTES.inc(response.content_length or 0)
+        return response
     else:
-        python3_js = js_bool(the_course.python3)
+        python3_js = js_bool(the_course['python3'])
 
         return render_template(filesystem_path, basecourse=base_course, python3=python3_js, login_required=js_bool(is_login_required))
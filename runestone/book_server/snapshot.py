@@ -0,0 +1,121 @@
+# ******************************************
+# |docname| - Static snapshots of book pages
+# ******************************************
+# `serve_page <server.py>` renders every book page through Jinja, substituting the course's ``basecourse``, ``python3`` and ``login_required`` values. For a course which doesn't require a login, each page is therefore identical for every visitor. ``python manage.py snapshot <course>...`` renders every HTML page of these courses once, in parallel using a pool of processes, saving the results under ``SNAPSHOT_DIR``. With ``SERVE_SNAPSHOTS`` set, `serve_page <server.py>` sends a snapshot, if one exists, as a static file instead of rendering the page.
+#
+# A course's snapshot is saved in ``<SNAPSHOT_DIR>/<course>/<key>``, where the key names the values substituted into its pages (see ``snapshot_key``). If an instructor changes the course's settings, its key changes, so the server ignores the stale snapshot rather than serving it. Take a new snapshot after each book rebuild; the new snapshot is built beside the old one, then renamed into place, so the server never sends a page from a partial snapshot.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from time import perf_counter
+import os
+import shutil
+
+# Third-party imports
+# -------------------
+from flask import render_template
+
+# Local imports
+# -------------
+from ..course_cache import course_info
+from .server import book_server, js_bool
+
+
+# Naming
+# ======
+# Return the name of the directory holding a snapshot of the course described by ``info`` (as returned by ``course_info``).
+def snapshot_key(info):
+    return '{}-python3_{}'.format(info['base_course'], js_bool(info['python3']))
+
+
+# Return the directory holding the snapshot of the course described by ``info`` in ``snapshot_dir``.
+def snapshot_path(snapshot_dir, info):
+    return Path(snapshot_dir) / info['course_name'] / snapshot_key(info)
+
+
+# Return the path, relative to the templates directory, of every HTML page of ``base_course``. Static content is already served as files, so it's omitted.
+def book_pages(base_course):
+    book_dir = Path(book_server.root_path) / book_server.template_folder / base_course
+    return sorted(
+        path.relative_to(book_dir).as_posix() for path in book_dir.rglob('*.html')
+        if path.relative_to(book_dir).parts[0] not in ('_static', '_images')
+    )
+
+
+# Rendering
+# =========
+# Each process in the pool renders pages with its own app.
+_worker_app = None
+
+
+def _init_worker(config_name):
+    global _worker_app
+    # Import here, since ``runestone`` imports this package.
+    from runestone import create_app
+    _worker_app = create_app(config_name)
+
+
+# Render one page of a course, writing it to ``output_path``. Return the number of bytes written.
+def _render_page(course_name, base_course, pageinfo, values, output_path):
+    # Render in a request for this page, so that templates see the same context as when `serve_page <server.py>` renders them.
+    with _worker_app.test_request_context('{}/{}/{}'.format(book_server.url_prefix, course_name, pageinfo)):
+        html = render_template('{}/{}'.format(base_course, pageinfo), **values)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    return output_path.write_bytes(html.encode('utf-8'))
+
+
+# Snapshot every page of ``course_name`` in ``snapshot_dir``. Worker processes create an app from ``config_name``. This must run in an application context. Return a dict giving the number of ``pages`` and ``bytes`` written and the elapsed ``seconds``.
+def snapshot_course(
+    # The course to snapshot.
+    course_name,
+    # The directory holding all snapshots.
+    snapshot_dir,
+    # The name of the config the worker processes use; see ``config.config``.
+    config_name,
+    # The number of worker processes; None uses one per CPU.
+    processes=None):
+
+    start = perf_counter()
+    info = course_info(course_name)
+    if info is None:
+        raise ValueError('Unknown course {}.'.format(course_name))
+    if info['login_required']:
+        raise ValueError('Course {} requires a login, so its pages may not be served as snapshots.'.format(course_name))
+    values = dict(basecourse=info['base_course'], python3=js_bool(info['python3']), login_required=js_bool(False))
+
+    # Build the snapshot beside its final location, then move it into place.
+    final_path = snapshot_path(snapshot_dir, info)
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+    build_path = final_path.with_name('{}.building-{}'.format(final_path.name, os.getpid()))
+    shutil.rmtree(str(build_path), ignore_errors=True)
+    build_path.mkdir()
+    try:
+        pages = book_pages(info['base_course'])
+        # Start fresh processes rather than forking this one, which would share this process's database connections with its children.
+        with ProcessPoolExecutor(processes, get_context('spawn'), _init_worker, (config_name,)) as executor:
+            futures = [
+                executor.submit(_render_page, course_name, info['base_course'], pageinfo, values, str(build_path / pageinfo))
+                for pageinfo in pages
+            ]
+            byte_count = sum(future.result() for future in futures)
+
+        # Renaming over a non-empty directory fails, so move the old snapshot aside first.
+        old_path = final_path.with_name('{}.old-{}'.format(final_path.name, os.getpid()))
+        if final_path.exists():
+            final_path.rename(old_path)
+        build_path.rename(final_path)
+        shutil.rmtree(str(old_path), ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(str(build_path), ignore_errors=True)
+        raise
+
+    return dict(pages=len(pages), bytes=byte_count, seconds=perf_counter() - start)
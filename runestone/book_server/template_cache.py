@@ -0,0 +1,103 @@
+# ********************************************
+# |docname| - Precompiled Jinja book templates
+# ********************************************
+# Each page of a book is a Jinja template, which each worker compiles the first time it renders that page. A book has hundreds of pages, so a freshly started worker spends much of its time compiling. Instead, set ``JINJA_BYTECODE_CACHE_DIR`` to a directory shared by all workers, then run ``python manage.py compile-templates`` when deploying. This compiles every book template, in parallel using a pool of processes, into Jinja's `bytecode cache <https://jinja.palletsprojects.com/en/2.11.x/api/#bytecode-cache>`_. Workers then load compiled templates from the cache. A template which changes after it was compiled is recompiled by the first worker to render it, which updates the cache.
+#
+# The cache is keyed by each template's absolute path, so compile templates in the directory the server runs from.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from time import perf_counter
+import os
+import tempfile
+
+# Third-party imports
+# -------------------
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+# Local imports
+# -------------
+from .server import book_server
+
+
+# Bytecode cache
+# ==============
+# Jinja's ``FileSystemBytecodeCache`` writes each file in place, so a worker could read a file another worker is still writing. Write to a temporary file, then rename it into place, instead.
+class AtomicFileSystemBytecodeCache(FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        fd, temp_name = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(temp_name, self._get_cache_filename(bucket))
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+
+
+# Use a bytecode cache for ``app``'s templates if ``JINJA_BYTECODE_CACHE_DIR`` is set. Call this before anything uses ``app.jinja_env``, since it's created from ``app.jinja_options`` on first use.
+def init_app(app):
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=AtomicFileSystemBytecodeCache(directory))
+
+
+# Compiling
+# =========
+# Return the name of every book template: every file in the book server's templates directory, except static content.
+def book_templates():
+    templates_dir = Path(book_server.root_path) / book_server.template_folder
+    names = []
+    for path in templates_dir.rglob('*'):
+        parts = path.relative_to(templates_dir).parts
+        # Skip ``<base_course>/_static`` and ``<base_course>/_images``, which `serve_page <server.py>` sends as files.
+        if path.is_file() and parts[1:2] not in (('_static',), ('_images',)):
+            names.append('/'.join(parts))
+    return sorted(names)
+
+
+# Each process in the pool compiles templates with its own app, so that they're compiled with the same extensions and options as the server uses.
+_worker_env = None
+
+
+def _init_worker(config_name, cache_dir):
+    global _worker_env
+    # Import here, since ``runestone`` imports this package.
+    from runestone import create_app
+    _worker_env = create_app(config_name).jinja_env
+    _worker_env.bytecode_cache = AtomicFileSystemBytecodeCache(cache_dir)
+
+
+# Compile one template, storing it in the bytecode cache. Return None, or an error message if it can't be compiled.
+def _compile_template(name):
+    try:
+        _worker_env.get_template(name)
+    except (TemplateSyntaxError, UnicodeDecodeError) as e:
+        return '{}: {}'.format(name, e)
+
+
+# Compile every book template into the bytecode cache in ``cache_dir``. Worker processes create an app from ``config_name``. Return a dict giving the number of ``templates`` compiled, a list of ``errors`` for templates which couldn't be compiled, and the elapsed ``seconds``.
+def compile_templates(
+    # The bytecode cache directory.
+    cache_dir,
+    # The name of the config the worker processes use; see ``config.config``.
+    config_name,
+    # The number of worker processes; None uses one per CPU.
+    processes=None):
+
+    start = perf_counter()
+    os.makedirs(cache_dir, exist_ok=True)
+    names = book_templates()
+    # Start fresh processes rather than forking this one, which would share this process's database connections with its children.
+    with ProcessPoolExecutor(processes, get_context('spawn'), _init_worker, (config_name, cache_dir)) as executor:
+        errors = [error for error in executor.map(_compile_template, names, chunksize=16) if error]
+    return dict(templates=len(names) - len(errors), errors=errors, seconds=perf_counter() - start)
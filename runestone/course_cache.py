@@ -0,0 +1,62 @@
+# *********************************
+# |docname| - Cached course lookups
+# *********************************
+# Every book page and every `hsblog endpoint` call starts by looking up its course. These lookups go through the `cache <extensions.py>`, which the workers share when the ``redis`` backend is configured. Instructors may change a course's settings, so entries expire after ``COURSE_CACHE_TIMEOUT`` seconds. Call ``invalidate_course`` to apply a change immediately.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+# None.
+#
+# Third-party imports
+# -------------------
+from flask import current_app
+
+# Local imports
+# -------------
+from .extensions import cache
+from .model import Courses
+
+
+def _key(course_name):
+    return 'course:' + course_name
+
+
+# Return a dict describing the course ``course_name``, or None if there's no such course. The dict contains:
+#
+# id
+#   The course's ``id``; see courses_id_.
+#
+# course_name
+#   The course_name_.
+#
+# base_course
+#   The base_course_, or the course_name_ for a base course (which has no base course of its own).
+#
+# python3, login_required
+#   The course's settings.
+def course_info(course_name):
+    info = cache.get(_key(course_name))
+    if info is None:
+        the_course = Courses[course_name].q.first()
+        # Don't cache unknown courses; otherwise, a newly-created course wouldn't be found until its entry expired.
+        if the_course is None:
+            return None
+        info = dict(
+            id=the_course.id,
+            course_name=the_course.course_name,
+            base_course=the_course.base_course or the_course.course_name,
+            python3=the_course.python3,
+            login_required=the_course.login_required,
+        )
+        cache.set(_key(course_name), info, current_app.config.get('COURSE_CACHE_TIMEOUT', 300))
+    return info
+
+
+# Discard the cached information for ``course_name``.
+def invalidate_course(course_name):
+    cache.delete(_key(course_name))
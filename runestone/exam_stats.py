@@ -0,0 +1,168 @@
+# *******************************************
+# |docname| - Maintain and query exam results
+# *******************************************
+# The `hsblog endpoint` calls ``record_timed_exam`` each time it stores a TimedExam_ result, which folds that result into its exam's TimedExamStats_ row: counts and sums for the means, plus fixed-width histograms of score and time for the percentiles. ``exam_stats`` then summarizes an exam from that one row, however many students took it.
+#
+# A result with ``reset`` set records that the student restarted the exam, not a score, so it's left out. Percentiles come from the histograms, so they're exact to within one bucket: one percentage point of score, and ``TIME_BUCKET_SECONDS`` of time.
+#
+# For exams taken before this was deployed, ``python manage.py rebuild-exam-stats`` recomputes every row from TimedExam_.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+# None.
+#
+# Third-party imports
+# -------------------
+from sqlalchemy.dialects.postgresql import array, insert
+
+# Local imports
+# -------------
+from .model import db, TimedExam, TimedExamStats
+
+
+# Histograms
+# ==========
+# Scores are percentages; one bucket per whole percentage point, plus one for 100.
+SCORE_BUCKETS = 101
+# Times are in seconds. Times of three hours or more share the last bucket.
+TIME_BUCKET_SECONDS = 60
+TIME_BUCKETS = 181
+
+
+# Return the score of a result, as a percentage, or None if the exam had no questions.
+def exam_score(correct, incorrect, skipped):
+    if None in (correct, incorrect, skipped) or correct + incorrect + skipped <= 0:
+        return None
+    return 100*correct/(correct + incorrect + skipped)
+
+
+def score_bucket(score):
+    return min(max(int(score), 0), SCORE_BUCKETS - 1)
+
+
+def time_bucket(time_taken):
+    return min(max(int(time_taken // TIME_BUCKET_SECONDS), 0), TIME_BUCKETS - 1)
+
+
+# Return a SQL expression which adds one to element ``bucket`` (counting from 0) of the histogram ``column``, which has ``size`` elements. PostgreSQL arrays count from 1, and an upsert can't assign to a single element, so this splices the array.
+def _increment(column, bucket, size):
+    i = bucket + 1
+    return db.func.array_cat(db.func.array_cat(column[1:i - 1], array([column[i] + 1])), column[i + 1:size])
+
+
+# Return the value below which ``fraction`` of the values counted by ``histogram`` lie, assuming values are spread evenly across each bucket of ``width``.
+def histogram_percentile(histogram, fraction, width, highest):
+    target = fraction*sum(histogram)
+    below = 0
+    for bucket, count in enumerate(histogram):
+        if count and below + count >= target:
+            return min((bucket + (target - below)/count)*width, highest)
+        below += count
+    return None
+
+
+# Updates
+# =======
+# Fold one TimedExam_ result into its exam's statistics, using a single upsert so that concurrent results can't be lost. Like ``record_answer`` in `progress.py`, this runs in the current session's transaction.
+def record_timed_exam(
+    # See courses_id_.
+    courses_id,
+    # See div_id_.
+    div_id,
+    # The TimedExam_ columns of this result.
+    correct, incorrect, skipped, time_taken, reset):
+
+    if reset:
+        return
+    score = exam_score(correct, incorrect, skipped)
+    score_histogram = [0]*SCORE_BUCKETS
+    if score is not None:
+        score_histogram[score_bucket(score)] = 1
+    time_histogram = [0]*TIME_BUCKETS
+    if time_taken is not None:
+        time_histogram[time_bucket(time_taken)] = 1
+
+    table = TimedExamStats.__table__
+    stmt = insert(table).values(
+        courses_id=courses_id,
+        div_id=div_id,
+        attempts=1,
+        scored=int(score is not None),
+        score_sum=score or 0,
+        score_histogram=score_histogram,
+        timed=int(time_taken is not None),
+        time_sum=time_taken or 0,
+        time_histogram=time_histogram,
+    )
+    set_ = dict(attempts=table.c.attempts + 1)
+    if score is not None:
+        set_.update(
+            scored=table.c.scored + 1,
+            score_sum=table.c.score_sum + score,
+            score_histogram=_increment(table.c.score_histogram, score_bucket(score), SCORE_BUCKETS),
+        )
+    if time_taken is not None:
+        set_.update(
+            timed=table.c.timed + 1,
+            time_sum=table.c.time_sum + time_taken,
+            time_histogram=_increment(table.c.time_histogram, time_bucket(time_taken), TIME_BUCKETS),
+        )
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[table.c.courses_id, table.c.div_id], set_=set_))
+
+
+# Recompute every exam's statistics from TimedExam_, for results stored before ``record_timed_exam`` was used. This locks TimedExam_ against writes (though not reads) while it runs, so no result is missed or counted twice. Return the number of exams.
+def rebuild_timed_exam_stats():
+    db.session.execute('lock table {} in share mode'.format(TimedExam.__tablename__))
+    stats = {}
+    query = db.session.query(
+        TimedExam.courses_id, TimedExam.div_id, TimedExam.correct, TimedExam.incorrect,
+        TimedExam.skipped, TimedExam.time_taken,
+    ).filter(TimedExam.courses_id.isnot(None), db.or_(TimedExam.reset.is_(None), TimedExam.reset == False))
+    for courses_id, div_id, correct, incorrect, skipped, time_taken in query.yield_per(10000):
+        row = stats.get((courses_id, div_id))
+        if row is None:
+            row = stats[courses_id, div_id] = dict(
+                courses_id=courses_id, div_id=div_id, attempts=0, scored=0, score_sum=0, score_histogram=[0]*SCORE_BUCKETS,
+                timed=0, time_sum=0, time_histogram=[0]*TIME_BUCKETS,
+            )
+        row['attempts'] += 1
+        score = exam_score(correct, incorrect, skipped)
+        if score is not None:
+            row['scored'] += 1
+            row['score_sum'] += score
+            row['score_histogram'][score_bucket(score)] += 1
+        if time_taken is not None:
+            row['timed'] += 1
+            row['time_sum'] += time_taken
+            row['time_histogram'][time_bucket(time_taken)] += 1
+
+    TimedExamStats.query.delete()
+    if stats:
+        db.session.execute(TimedExamStats.__table__.insert(), list(stats.values()))
+    db.session.commit()
+    return len(stats)
+
+
+# Queries
+# =======
+# The percentiles reported by ``exam_stats``.
+PERCENTILES = (25, 50, 75, 90)
+
+
+# Return the statistics of one timed exam, as a dict of ``attempts``, ``mean_score``, ``score_percentiles`` (a dict of ``{percentile: score}``), ``mean_time_taken`` and ``time_percentiles``, all in percent or seconds. Values which can't be computed, since no results had a score or time, are None.
+def exam_stats(courses_id, div_id):
+    row = TimedExamStats[db.and_(TimedExamStats.courses_id == courses_id, TimedExamStats.div_id == div_id)].q.one_or_none()
+    if row is None:
+        return dict(attempts=0, mean_score=None, score_percentiles=dict.fromkeys(PERCENTILES), mean_time_taken=None, time_percentiles=dict.fromkeys(PERCENTILES))
+    return dict(
+        attempts=row.attempts,
+        mean_score=row.score_sum/row.scored if row.scored else None,
+        score_percentiles={p: histogram_percentile(row.score_histogram, p/100, 1, 100) for p in PERCENTILES},
+        mean_time_taken=row.time_sum/row.timed if row.timed else None,
+        time_percentiles={p: histogram_percentile(row.time_histogram, p/100, TIME_BUCKET_SECONDS, TIME_BUCKETS*TIME_BUCKET_SECONDS) for p in PERCENTILES},
+    )
@@ -9,20 +9,387 @@
 #
 # Standard library
 # ----------------
-# None
-#
+from threading import Lock, Thread, local
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from uuid import uuid4
+import json
+import logging
+import os
+import pickle
+import socket
+
 # Third-party imports
 # -------------------
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from pythonic_sqlalchemy_query.flask import SQLAlchemyPythonicQuery
+from sqlalchemy import orm
 
 # Local imports
 # -------------
-# None
+from .metrics import count_cache_lookup
+from .routing import RoutingSession
 #
+# Logging
+# =======
+logger = logging.getLogger(__name__)
+
+
+# Cache
+# =====
+# Caching in one worker's memory is fast. But with many gunicorn workers on several nodes, each worker caches separately, so hit rates suffer and invalidating an entry means telling every worker. This provides a cache with pluggable backends:
+#
+# -   ``memory``: a per-process cache; the default, and fine for a single worker or for testing.
+# -   ``redis``: a cache shared by every worker, kept in any server which speaks the `Redis protocol <https://redis.io/topics/protocol>`_.
+#
+# Some data (such as the `question cache <question_cache.py>`) must live in each worker's memory for speed. For these, the cache also fans out invalidations. ``Cache.invalidate`` delivers a message to every callback registered for a topic, in every worker. With the ``redis`` backend this uses its pub/sub channels.
+#
+# Backends
+# --------
+# The interface every backend provides. Values may be any picklable object; ``None`` can't be stored, since ``get`` uses it to signal a miss. Backends should log and survive connection errors rather than raise, so that an unavailable cache only makes the server slower.
+class CacheBackend:
+    # Return the value stored under ``key``, or None if there's no such value.
+    def get(self, key):
+        raise NotImplementedError
+
+    # Store ``value`` under ``key``, discarding it after ``timeout`` seconds (or never, if ``timeout`` is None).
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError
+
+    # Remove ``key``.
+    def delete(self, key):
+        raise NotImplementedError
+
+    # Add ``amount`` to the integer stored under ``key`` (treating a missing key as 0) and return the result. If this creates the key, discard it after ``timeout`` seconds.
+    def incr(self, key, amount=1, timeout=None):
+        raise NotImplementedError
+
+    # Remove every key beginning with ``prefix``.
+    def clear(self, prefix):
+        raise NotImplementedError
+
+    # Send ``message`` (a string) to every worker subscribed to ``channel``.
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    # Call ``callback(message)`` for every message published to ``channel`` by any worker.
+    def subscribe(self, channel, callback):
+        raise NotImplementedError
+
+
+# A per-process backend.
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self):
+        # ``{key: (value, expires)}``, where ``expires`` is a ``monotonic()`` time or None.
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        self._data[key] = (value, None if timeout is None else monotonic() + timeout)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def incr(self, key, amount=1, timeout=None):
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                value = amount
+                self.set(key, value, timeout)
+            else:
+                value += amount
+                # Keep the original expiration time.
+                self._data[key] = (value, self._data[key][1])
+        return value
+
+    def clear(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    # There are no other workers to tell.
+    def publish(self, channel, message):
+        pass
+
+    def subscribe(self, channel, callback):
+        pass
+
+
+# An error reported by a Redis-protocol server.
+class RedisError(Exception):
+    pass
+
+
+# A minimal client for the Redis protocol; it supports only the commands this backend needs, so it adds no dependencies.
+class RedisConnection:
+    def __init__(self, host, port, db=0, timeout=None):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        if db:
+            self.execute('SELECT', db)
+
+    # Send a command, returning the server's reply.
+    def execute(self, *args):
+        self.send(*args)
+        return self.read_reply()
+
+    # Send a command as an array of bulk strings.
+    def send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(parts))
+
+    # Read one reply. Bulk strings are returned as bytes.
+    def read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('The Redis server closed the connection.')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        elif kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        elif kind == b':':
+            return int(rest)
+        elif kind == b'$':
+            length = int(rest)
+            if length == -1:
+                return None
+            # Read the data plus its trailing ``\r\n``.
+            return self._file.read(length + 2)[:-2]
+        elif kind == b'*':
+            length = int(rest)
+            if length == -1:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        else:
+            raise RedisError('Unknown reply type {}.'.format(line))
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+# A backend shared by all workers, stored in a Redis-protocol server.
+class RedisCacheBackend(CacheBackend):
+    def __init__(self,
+        # A URL such as ``redis://localhost:6379/0``.
+        url,
+        # The socket timeout, in seconds, for cache operations.
+        timeout=1.0):
+
+        parsed = urlparse(url)
+        self._host = parsed.hostname or 'localhost'
+        self._port = parsed.port or 6379
+        self._db = int(parsed.path.lstrip('/') or 0)
+        self._timeout = timeout
+        # Each thread has its own connection, since the protocol doesn't allow interleaving requests on one.
+        self._local = local()
+        # ``{channel: [callback, ...]}`` for the subscriber thread.
+        self._subscriptions = {}
+        self._subscriber = None
+
+    def _connect(self, timeout):
+        return RedisConnection(self._host, self._port, self._db, timeout)
+
+    # Run a command, reconnecting once if the connection was dropped. Return ``default`` if the server can't be reached.
+    def _execute(self, *args, default=None):
+        for attempt in range(2):
+            try:
+                connection = getattr(self._local, 'connection', None)
+                if connection is None:
+                    connection = self._local.connection = self._connect(self._timeout)
+                return connection.execute(*args)
+            except (OSError, ConnectionError) as e:
+                self._local.connection = None
+                if attempt:
+                    logger.warning('Cache command %s failed: %s', args[0], e)
+        return default
+
+    def get(self, key):
+        value = self._execute('GET', key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if timeout is None:
+            self._execute('SET', key, value)
+        else:
+            self._execute('SET', key, value, 'PX', max(1, int(timeout*1000)))
+
+    def delete(self, key):
+        self._execute('DEL', key)
+
+    # Note that this stores the integer as a string, as Redis requires; read it back with ``incr(key, 0)``, not ``get``.
+    def incr(self, key, amount=1, timeout=None):
+        value = self._execute('INCRBY', key, amount)
+        if value is None:
+            return None
+        if value == amount and timeout is not None:
+            self._execute('PEXPIRE', key, max(1, int(timeout*1000)))
+        return value
+
+    def clear(self, prefix):
+        cursor = '0'
+        while True:
+            reply = self._execute('SCAN', cursor, 'MATCH', prefix + '*', 'COUNT', 1000)
+            if reply is None:
+                return
+            cursor, keys = reply
+            if keys:
+                self._execute('DEL', *keys)
+            cursor = cursor.decode('utf-8')
+            if cursor == '0':
+                return
+
+    def publish(self, channel, message):
+        self._execute('PUBLISH', channel, message)
+
+    def subscribe(self, channel, callback):
+        self._subscriptions.setdefault(channel, []).append(callback)
+        if self._subscriber is None:
+            self._subscriber = Thread(target=self._listen, name='cache-subscriber', daemon=True)
+            self._subscriber.start()
+
+    # The subscriber thread: deliver published messages to callbacks, reconnecting as needed. Channels subscribed after this thread starts are picked up on the next reconnect, so subscribe to all channels at startup.
+    def _listen(self):
+        while True:
+            try:
+                connection = self._connect(None)
+                try:
+                    channels = list(self._subscriptions)
+                    connection.send('SUBSCRIBE', *channels)
+                    while True:
+                        reply = connection.read_reply()
+                        if reply[0] == b'message':
+                            channel, message = reply[1].decode('utf-8'), reply[2].decode('utf-8')
+                            for callback in self._subscriptions.get(channel, []):
+                                callback(message)
+                finally:
+                    connection.close()
+            except Exception:
+                logger.exception('Cache subscriber failed; reconnecting.')
+                sleep(1)
+
+
+# The Flask extension
+# -------------------
+class Cache:
+    def __init__(self):
+        self.backend = MemoryCacheBackend()
+        self.key_prefix = 'runestone:'
+        self.default_timeout = None
+        # ``{topic: [callback, ...]}``; see ``on_invalidate``.
+        self._invalidation_callbacks = {}
+        # Identifies this cache's invalidation messages; see ``_sender``.
+        self._id = uuid4().hex
+
+    # Configuration:
+    #
+    # CACHE_TYPE
+    #   ``memory`` (the default) or ``redis``.
+    #
+    # CACHE_REDIS_URL
+    #   For the ``redis`` backend, the server to use, such as ``redis://localhost:6379/0``.
+    #
+    # CACHE_KEY_PREFIX
+    #   A prefix for all keys and channels, so several applications can share a server.
+    #
+    # CACHE_DEFAULT_TIMEOUT
+    #   The default lifetime, in seconds, of a cached value; None means forever.
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'memory')
+        if cache_type == 'memory':
+            self.backend = MemoryCacheBackend()
+        elif cache_type == 'redis':
+            self.backend = RedisCacheBackend(app.config['CACHE_REDIS_URL'])
+        else:
+            raise ValueError('Unknown CACHE_TYPE {}.'.format(cache_type))
+        self.key_prefix = app.config.get('CACHE_KEY_PREFIX', 'runestone:')
+        self.default_timeout = app.config.get('CACHE_DEFAULT_TIMEOUT')
+        app.extensions['cache'] = self
+
+        # Subscribe once the worker is serving requests. Threads started before gunicorn forks its workers (with ``--preload``) don't survive the fork, and command-line tools never need invalidations.
+        app.before_first_request(self._subscribe)
+
+    def _subscribe(self):
+        self.backend.subscribe(self.key_prefix + 'invalidate', self._dispatch)
+
+    def get(self, key):
+        value = self.backend.get(self.key_prefix + key)
+        # Keys have the form ``name:...``; count lookups by ``name``.
+        count_cache_lookup(key.split(':', 1)[0], value is not None)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(self.key_prefix + key, value, self.default_timeout if timeout is None else timeout)
+
+    def delete(self, key):
+        self.backend.delete(self.key_prefix + key)
+
+    def incr(self, key, amount=1, timeout=None):
+        return self.backend.incr(self.key_prefix + key, amount, timeout)
+
+    # Remove every cached value.
+    def clear(self):
+        self.backend.clear(self.key_prefix)
+
+    # Register ``callback(key)`` to be called in every worker when ``invalidate(topic, key)`` is called in any worker.
+    def on_invalidate(self, topic, callback):
+        self._invalidation_callbacks.setdefault(topic, []).append(callback)
+
+    # Tell every worker (including this one, immediately) that ``key`` of ``topic`` is out of date. ``key`` may be any JSON-serializable value.
+    def invalidate(self, topic, key=None):
+        self._run_callbacks(topic, key)
+        self.backend.publish(self.key_prefix + 'invalidate', json.dumps([self._sender(), topic, key]))
+
+    # Identify this worker's messages, so that it ignores its own when they come back from the server; its callbacks have already run. Workers forked from one process (by gunicorn's ``--preload``) share ``_id``, so include the process id.
+    def _sender(self):
+        return '{}:{}'.format(os.getpid(), self._id)
+
+    def _dispatch(self, message):
+        sender, topic, key = json.loads(message)
+        if sender != self._sender():
+            self._run_callbacks(topic, key)
+
+    def _run_callbacks(self, topic, key):
+        for callback in self._invalidation_callbacks.get(topic, []):
+            callback(key)
+
+
+# Database
+# ========
+# Flask-SQLAlchemy 2.3 doesn't support the ``SQLALCHEMY_ENGINE_OPTIONS`` setting of later versions, which passes keyword arguments to ``create_engine``; add it.
+class SQLAlchemy(SQLAlchemyPythonicQuery):
+    def apply_driver_hacks(self, app, info, options):
+        # Flask-SQLAlchemy 2.4 and later return ``(url, options)`` from this, which ``create_engine`` uses; earlier versions return None.
+        rv = super().apply_driver_hacks(app, info, options)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        return rv
+
+    # Send suitable reads to replicas of the database; see `routing.py`.
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # Create extensions
 # =================
 bootstrap = Bootstrap()
-db = SQLAlchemyPythonicQuery()
+cache = Cache()
+db = SQLAlchemy()
 mail = Mail()
@@ -0,0 +1,39 @@
+# ******************************
+# |docname| - Fast row insertion
+# ******************************
+# The `hsblog endpoint` writes one Useinfo_ row, and often one answer, per event. Adding ORM objects to the session costs more than the inserts themselves: building each object, tracking it in the identity map, then working out at flush time what to insert, with events at each step. ``insert_row`` instead runs a SQLAlchemy Core ``INSERT``, built once per table and compiled once per set of columns (see `compiled_cache <https://docs.sqlalchemy.org/en/13/core/connections.html#sqlalchemy.engine.Connection.execution_options>`_), on the session's connection, so it commits or rolls back with the rest of the request.
+#
+# The row isn't loaded into the session. Use the ORM instead when later code needs the object, as ``merge`` in the `hsblog endpoint` does to update an existing answer.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+# None.
+#
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+from .model import db
+
+
+# ``{model: INSERT statement}``.
+_statements = {}
+# Compiled statements, keyed by the statement, the dialect and the columns given. Each model is inserted with only a few sets of columns, so this stays small.
+_compiled_cache = {}
+
+
+# Insert a row of ``model``, given as keyword arguments, on the session's connection, without creating an ORM object.
+def insert_row(model, **values):
+    stmt = _statements.get(model)
+    if stmt is None:
+        stmt = _statements[model] = model.__table__.insert()
+    # Passing the statement lets the `session <routing.py>` choose the right database, and note that this transaction has written.
+    connection = db.session.connection(clause=stmt)
+    connection.execution_options(compiled_cache=_compiled_cache).execute(stmt, values)
@@ -0,0 +1,104 @@
+# *************************************************
+# |docname| - Per-request SQL query instrumentation
+# *************************************************
+# Record the number of SQL queries, the total time spent in the database and the slowest statement for each request. This is reported in two ways:
+#
+# -   A `Server-Timing <https://www.w3.org/TR/server-timing/>`_ response header, shown by browsers' developer tools, when ``SERVER_TIMING_HEADER`` is True. Production disables it, since it reveals details of the server.
+# -   A log warning for any request which takes longer than ``SLOW_REQUEST_MS`` milliseconds or makes more than ``SLOW_REQUEST_QUERIES`` queries.
+#
+# Set ``SQL_INSTRUMENTATION`` to False to disable all of this.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from time import perf_counter
+
+# Third-party imports
+# -------------------
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Local imports
+# -------------
+# None.
+
+
+# Statistics for one request.
+class RequestStats:
+    def __init__(self):
+        self.start = perf_counter()
+        # The number of SQL statements executed.
+        self.query_count = 0
+        # The total time spent executing them, in seconds.
+        self.db_time = 0
+        # The slowest statement and its time in seconds.
+        self.slowest_statement = None
+        self.slowest_time = 0
+
+
+# Return the current request's statistics, or None outside a request (or when instrumentation is off).
+def request_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+
+# SQLAlchemy event listeners
+# ==========================
+# These listen to every engine, so they see queries from the session and from ``db.engine`` alike.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start_time'].pop()
+    stats = request_stats()
+    if stats:
+        stats.query_count += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest_time:
+            stats.slowest_time = elapsed
+            stats.slowest_statement = statement
+
+
+# Flask request hooks
+# ===================
+def _before_request():
+    g.request_stats = RequestStats()
+
+
+def _after_request(response):
+    stats = request_stats()
+    if not stats:
+        return response
+    total_ms = (perf_counter() - stats.start)*1000
+    db_ms = stats.db_time*1000
+    config = current_app.config
+
+    if config.get('SERVER_TIMING_HEADER'):
+        response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(db_ms, stats.query_count))
+        response.headers.add('Server-Timing', 'db-slowest;dur={:.1f}'.format(stats.slowest_time*1000))
+        response.headers.add('Server-Timing', 'total;dur={:.1f}'.format(total_ms))
+
+    if total_ms > config.get('SLOW_REQUEST_MS', 500) or stats.query_count > config.get('SLOW_REQUEST_QUERIES', 20):
+        current_app.logger.warning(
+            'Slow request %s %s: %.1f ms, %d queries taking %.1f ms; slowest query (%.1f ms): %s',
+            request.method, request.full_path, total_ms, stats.query_count, db_ms, stats.slowest_time*1000,
+            (stats.slowest_statement or '')[:500]
+        )
+    return response
+
+
+# Install the instrumentation in ``app``.
+def init_app(app):
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+    # The listeners are global, so only add them once.
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,128 @@
+# ****************************************************
+# |docname| - Bulk load a book's questions into the DB
+# ****************************************************
+# When a book is built, Sphinx produces a manifest of every question in it. ``python manage.py load-questions`` runs ``load_questions`` below, which makes Questions_ for that base course match the manifest. Adding thousands of questions one ORM object at a time is slow and holds locks for a long time. Instead, this works on the whole set at once inside a single transaction:
+#
+# #.  COPY the manifest into a temporary staging table.
+# #.  Update changed questions, insert new ones, and remove ones no longer in the book, each with one statement joined against the staging table.
+#
+# Only rows which actually change are written, so rebuilding an unchanged book touches nothing.
+#
+# Manifest format
+# ===============
+# The manifest is a JSON list with one object per question. ``name`` (the question's div_id_) is required. Any other Questions_ column may also be given; see ``QUESTION_COLUMNS``. For example:
+#
+# .. code-block:: json
+#
+#   [{"name": "test_div_id", "chapter": "1", "subchapter": "2", "question_type": "mchoice"}]
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from io import StringIO
+from time import perf_counter
+import json
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+from .model import db, Questions
+from .question_cache import question_cache
+
+# The Questions_ columns a manifest may supply, in the order they're copied. ``base_course`` comes from the command line instead.
+QUESTION_COLUMNS = ('name', 'chapter', 'subchapter', 'author', 'difficulty', 'question', 'question_type', 'is_private', 'htmlsrc', 'autograde')
+
+
+# Manifest handling
+# =================
+# Read a manifest, returning a list of question dicts.
+def read_manifest(path):
+    with open(path, encoding='utf-8') as f:
+        questions = json.load(f)
+    if not isinstance(questions, list):
+        raise ValueError('The manifest must contain a JSON list of questions.')
+    return questions
+
+
+# Convert one value to PostgreSQL's COPY text format. See `COPY <https://www.postgresql.org/docs/current/static/sql-copy.html>`_.
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Produce the body of a COPY from a list of question dicts, validating the questions.
+def _copy_data(questions):
+    # Convert values the same way the ORM would, so Web2PyBoolean columns get web2py's ``T``/``F``.
+    processors = [Questions.__table__.c[column].type.bind_processor(db.engine.dialect) for column in QUESTION_COLUMNS]
+    names = set()
+    lines = []
+    for question in questions:
+        unknown = set(question) - set(QUESTION_COLUMNS)
+        if unknown:
+            raise ValueError('Unknown question field(s) {}.'.format(', '.join(sorted(unknown))))
+        name = question.get('name')
+        if not name:
+            raise ValueError('Every question must have a name.')
+        if name in names:
+            raise ValueError('Duplicate question name {}.'.format(name))
+        names.add(name)
+
+        values = [question.get(column) for column in QUESTION_COLUMNS]
+        values = [processor(value) if processor else value for processor, value in zip(processors, values)]
+        lines.append('\t'.join(map(_copy_text, values)) + '\n')
+    return ''.join(lines)
+
+
+# Loading
+# =======
+# Make the questions for ``base_course`` match ``questions``, a list of question dicts. Return a dict giving the number of questions ``inserted``, ``updated`` and ``removed``, plus the elapsed ``seconds``.
+def load_questions(base_course, questions):
+    start = perf_counter()
+    copy_data = _copy_data(questions)
+    columns = ', '.join(QUESTION_COLUMNS)
+    data_columns = [column for column in QUESTION_COLUMNS if column != 'name']
+    params = dict(base_course=base_course)
+
+    # Stage the manifest. COPY needs the DBAPI connection, which is shared with the session so that everything happens in one transaction.
+    db.session.execute('create temp table questions_staging on commit drop as select {} from questions with no data'.format(columns))
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('copy questions_staging ({}) from stdin'.format(columns), StringIO(copy_data))
+    db.session.execute('create index on questions_staging (name)')
+    db.session.execute('analyze questions_staging')
+
+    # Update only questions whose data differs, so an unchanged book writes nothing.
+    updated = db.session.execute(db.text(
+        'update questions set {} from questions_staging s '
+        'where questions.base_course = :base_course and questions.name = s.name '
+        'and ({}) is distinct from ({})'.format(
+            ', '.join('{0} = s.{0}'.format(column) for column in data_columns),
+            ', '.join('questions.{}'.format(column) for column in data_columns),
+            ', '.join('s.{}'.format(column) for column in data_columns),
+        )
+    ), params).rowcount
+
+    inserted = db.session.execute(db.text(
+        'insert into questions (base_course, {0}) select :base_course, {0} from questions_staging s '
+        'where not exists (select 1 from questions q where q.base_course = :base_course and q.name = s.name)'.format(columns)
+    ), params).rowcount
+
+    removed = db.session.execute(db.text(
+        'delete from questions where base_course = :base_course '
+        'and not exists (select 1 from questions_staging s where s.name = questions.name)'
+    ), params).rowcount
+
+    # Drop the staging table now, in case the caller's transaction outlives this commit (for example, when this runs in a savepoint).
+    db.session.execute('drop table questions_staging')
+    db.session.commit()
+    # Workers in this process must now reload this book's questions.
+    question_cache.invalidate(base_course)
+
+    return dict(inserted=inserted, updated=updated, removed=removed, seconds=perf_counter() - start)
@@ -0,0 +1,168 @@
+# ******************************************
+# |docname| - Prometheus operational metrics
+# ******************************************
+# Collect request rates and latencies, hsblog events and rejections, cache hit ratios, database pool waits, spooled rows and static bytes served, and publish them at ``/metrics`` in the `Prometheus text exposition format <https://prometheus.io/docs/instrumenting/exposition_formats/>`_.
+#
+# Multiple processes
+# ==================
+# Each gunicorn worker is a separate process with its own metrics. To publish totals over all workers, `prometheus_client <https://github.com/prometheus/client_python#multiprocess-mode-eg-gunicorn>`_ keeps every value in memory-mapped files in a shared directory. To enable this, set the ``PROMETHEUS_MULTIPROC_DIR`` environment variable to an empty directory **before** starting gunicorn (the variable must be set when ``prometheus_client`` is imported) and empty it on every restart. For example:
+#
+# .. code-block:: bash
+#
+#   rm -rf /tmp/runestone_metrics && mkdir /tmp/runestone_metrics
+#   PROMETHEUS_MULTIPROC_DIR=/tmp/runestone_metrics gunicorn wsgi:app
+#
+# Without it (the development server, tests), ``/metrics`` reports this process's metrics. Only counters and histograms are used, since these need no cleanup when a worker exits.
+#
+# ``/metrics`` reveals traffic details, so it only answers clients whose address is in ``METRICS_ALLOWED_NETWORKS``; by default, only this host. Requests carrying an ``X-Forwarded-For`` header came through a proxy, whose own address says nothing about the client, so they're refused too. Don't route ``/metrics`` through the public proxy; have Prometheus scrape the workers directly.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from ipaddress import ip_address, ip_network
+from threading import Lock
+from time import perf_counter
+import os
+
+# Third-party imports
+# -------------------
+from flask import Blueprint, Response, abort, current_app, g, request
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+    generate_latest,
+)
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy.pool import QueuePool
+
+# Local imports
+# -------------
+# None.
+
+
+# Metrics
+# =======
+REQUEST_LATENCY = Histogram(
+    'runestone_request_duration_seconds', 'Time spent handling a request.',
+    ['blueprint']
+)
+REQUESTS = Counter(
+    'runestone_requests', 'Requests handled, by response status.',
+    ['blueprint', 'status']
+)
+HSBLOG_EVENTS = Counter(
+    'runestone_hsblog_events', 'Events logged by the hsblog endpoint.',
+    ['event']
+)
+CACHE_REQUESTS = Counter(
+    'runestone_cache_requests', 'Cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result']
+)
+DB_POOL_WAIT = Histogram(
+    'runestone_db_pool_wait_seconds', 'Time spent waiting to check out a database connection from the pool.',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+USEINFO_SPOOLED = Counter(
+    'runestone_useinfo_spooled', 'Useinfo rows written to the spool because the database was unavailable or slow.'
+)
+USEINFO_REPLAYED = Counter(
+    'runestone_useinfo_replayed', 'Spooled Useinfo rows replayed into the database.'
+)
+HSBLOG_REJECTED = Counter(
+    'runestone_hsblog_rejected', 'hsblog calls rejected by the rate limits, or shed while the database pool was saturated.',
+    ['reason']
+)
+STATIC_BYTES = Counter(
+    'runestone_static_bytes', 'Bytes of book static content (``_static``, ``_images``) served.'
+)
+
+# Browsers may send any ``event``; label only the known ones, so that bogus values can't create unlimited time series.
+HSBLOG_EVENT_LABELS = frozenset((
+    'timedExam', 'mChoice', 'fillb', 'dragNdrop', 'clickableArea', 'parsons',
+    'codelensq', 'shortanswer', 'lp_build', 'page', 'activecode', 'codelens',
+    'video', 'poll',
+))
+
+
+# Record one event logged by the `hsblog endpoint`.
+def count_hsblog_event(event):
+    HSBLOG_EVENTS.labels(event if event in HSBLOG_EVENT_LABELS else 'other').inc()
+
+
+# Record a lookup in ``cache``, a short name such as ``course`` or ``questions``.
+def count_cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+# A connection pool which times each checkout. SQLAlchemy's pool events fire only after a connection is checked out, so time ``_do_get`` (which waits for a free connection, or opens a new one) instead. It also counts the threads in ``_do_get``, which the `hsblog load shedding <rate_limit.py>` uses as the pool's queue depth.
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self._waiting_lock = Lock()
+
+    def _do_get(self):
+        start = perf_counter()
+        with self._waiting_lock:
+            self.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            with self._waiting_lock:
+                self.waiting -= 1
+            DB_POOL_WAIT.observe(perf_counter() - start)
+
+
+# Flask integration
+# =================
+metrics = Blueprint('metrics', __name__)
+
+
+# Return True if the current request may read the metrics.
+def _metrics_allowed():
+    if request.headers.get('X-Forwarded-For') or not request.remote_addr:
+        return False
+    address = ip_address(request.remote_addr)
+    return any(address in ip_network(network) for network in current_app.config.get('METRICS_ALLOWED_NETWORKS', []))
+
+
+@metrics.route('/metrics')
+def serve_metrics():
+    if not _metrics_allowed():
+        abort(403)
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Gather every worker's values from the shared directory.
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def _before_request():
+    g.metrics_start = perf_counter()
+
+
+def _after_request(response):
+    start = g.get('metrics_start')
+    if start is not None:
+        blueprint = request.blueprint or 'none'
+        REQUEST_LATENCY.labels(blueprint).observe(perf_counter() - start)
+        REQUESTS.labels(blueprint, str(response.status_code)).inc()
+    return response
+
+
+# Record request metrics for ``app`` and time its database pool checkouts. Call this before the database is used, since the pool is chosen when the engine is created.
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # SQLite uses its own pool classes, which shouldn't be replaced.
+    if not (app.config.get('SQLALCHEMY_DATABASE_URI') or '').startswith('sqlite'):
+        # Copy the options, rather than changing a dict shared with the config class.
+        engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        engine_options.setdefault('poolclass', TimedQueuePool)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    app.register_blueprint(metrics)
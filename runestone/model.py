@@ -13,6 +13,8 @@ from numbers import Number
 
 # Third-party imports
 # -------------------
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declared_attr
 import sqlalchemy.types as types
@@ -117,6 +119,16 @@ class Courses(db.Model, IdMixin):
             return cls.course_name == key
 
 
+# CourseInstructor
+# ----------------
+# Records which users are instructors for a course. This matches web2py's ``course_instructor`` table.
+class CourseInstructor(db.Model, IdMixin):
+    # The Courses ``id`` this instructor teaches.
+    course = db.Column(db.Integer, db.ForeignKey('courses.id'))
+    # The AuthUser ``id`` of the instructor.
+    instructor = db.Column(db.Integer, db.ForeignKey('auth_user.id'))
+
+
 # Useinfo
 # -------
 # User info logged by the `hsblog endpoint`. See there for more info.
@@ -131,8 +143,10 @@ class Useinfo(db.Model, IdMixin):
     act = db.Column(db.String(512))
     # _`div_id`: the ID of the question which produced this entry.
     div_id = db.Column(db.String(512))
-    # _`course_id`: the Courses ``course_name`` **NOT** the ``id`` this row refers to. TODO: Use the ``id`` instead!
+    # _`course_id`: the Courses ``course_name`` **NOT** the ``id`` this row refers to. Kept for web2py, which still reads and writes it; new code should use courses_id_ instead.
     course_id = db.Column(db.String(512), db.ForeignKey('courses.course_name'))
+    # _`courses_id`: the Courses ``id`` this row refers to. An integer key makes rows and indexes much smaller than the 512-character course_id_. (The obvious name is taken by course_id_.) Existing rows are filled in by `backfill.py`.
+    courses_id = db.Column(db.Integer, db.ForeignKey('courses.id'), index=True)
 
     # Define a default query: the username if provided a string. Otherwise, automatically fall back to the id.
     @classmethod
@@ -141,6 +155,71 @@ class Useinfo(db.Model, IdMixin):
             return cls.sid == key
 
 
+# Compact Useinfo
+# ---------------
+# Useinfo_ repeats the same event, div_id_ and course_id_ strings on millions of rows. When ``USEINFO_STORAGE`` is ``compact``, the `hsblog endpoint` instead stores each known event and each question's div_id once, in a lookup table, and records its integer key in UseinfoCompact_. See `useinfo_storage.py`.
+class InternMixin(IdMixin):
+    # The string this row's ``id`` stands for.
+    value = db.Column(db.String(512), nullable=False, unique=True)
+
+
+# The known Useinfo.event values.
+class UseinfoEvent(db.Model, InternMixin):
+    pass
+
+
+# The Useinfo.div_id values which name a question.
+class UseinfoDivId(db.Model, InternMixin):
+    pass
+
+
+# _`UseinfoCompact`: a row of Useinfo_, with its strings replaced by keys where possible.
+class UseinfoCompact(db.Model):
+    # Ids come from Useinfo's sequence, so that an id identifies one row across both tables; this lets `useinfo_view`_ combine them.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False, server_default=db.text("nextval('useinfo_id_seq')"))
+    # See timestamp_.
+    timestamp = db.Column(db.DateTime)
+    # See sid_. Nearly every student has a distinct sid, so there's little to gain from a lookup table.
+    sid = db.Column(db.String(512), index=True)
+    # The UseinfoEvent ``id`` of this row's event, if it's a known event.
+    event_key = db.Column(db.Integer, db.ForeignKey('useinfo_event.id'))
+    # This row's event, if it isn't a known event.
+    event = db.Column(db.String(512))
+    # See Useinfo.act. Browsers may send any value, so it isn't interned.
+    act = db.Column(db.String(512))
+    # The UseinfoDivId ``id`` of this row's div_id_, if it names a question.
+    div_id_key = db.Column(db.Integer, db.ForeignKey('useinfo_div_id.id'))
+    # This row's div_id_, if it doesn't name a question.
+    div_id = db.Column(db.String(512))
+    # See courses_id_. This replaces course_id_, which the view recovers from Courses.
+    courses_id = db.Column(db.Integer, db.ForeignKey('courses.id'), index=True)
+
+    @classmethod
+    def default_query(cls, key):
+        if isinstance(key, str):
+            return cls.sid == key
+
+
+# _`useinfo_view`: every row of Useinfo_ and UseinfoCompact_, with the columns of Useinfo_, for code (such as web2py and reports) which reads Useinfo. It's a view, so it's not part of ``db.metadata``; `model.py` creates it along with UseinfoCompact_.
+useinfo_view = db.Table('useinfo_view', db.MetaData(), *[db.Column(column.name, column.type) for column in Useinfo.__table__.columns])
+
+USEINFO_VIEW_DDL = DDL("""\
+create or replace view useinfo_view as
+    select id, timestamp, sid, event, act, div_id, course_id, courses_id from useinfo
+    union all
+    select c.id, c.timestamp, c.sid, coalesce(e.value, c.event), c.act, coalesce(d.value, c.div_id), courses.course_name, c.courses_id
+    from useinfo_compact c
+    left join useinfo_event e on e.id = c.event_key
+    left join useinfo_div_id d on d.id = c.div_id_key
+    left join courses on courses.id = c.courses_id""")
+
+# The sequence and the view need ``useinfo``, so create it first and drop it last.
+UseinfoCompact.__table__.add_is_dependent_on(Useinfo.__table__)
+event.listen(UseinfoCompact.__table__, 'after_create', USEINFO_VIEW_DDL)
+for table in (Useinfo.__table__, UseinfoCompact.__table__):
+    event.listen(table, 'before_drop', DDL('drop view if exists useinfo_view'))
+
+
 # Questions
 # ---------
 # A question in the book; this data is provided by Sphinx.
@@ -162,6 +241,9 @@ class Questions(db.Model, IdMixin):
     htmlsrc = db.Column(db.Text)
     autograde = db.Column(db.String(512))
 
+    # Questions are looked up and loaded by book, then by div_id_.
+    __table_args__ = (db.Index('ix_questions_base_course_name', 'base_course', 'name'),)
+
     @classmethod
     def default_query(cls, key):
         if isinstance(key, str):
@@ -186,11 +268,25 @@ class AnswerMixin(IdMixin):
     def course_name(cls):
         return db.Column(db.String(512), db.ForeignKey('courses.course_name'))
 
+    # See courses_id_.
+    @declared_attr
+    def courses_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('courses.id'), index=True)
+
+    # The key is ``(sid, div_id, course)``, where the course is either a course_name_ or a courses_id_, or ``(sid, div_id, courses_id, course_name)``. The last form matches rows by their courses_id, and also rows written by web2py, which leaves courses_id NULL until they're `backfilled <backfill.py>`, by their course_name; use it when both are known.
     @classmethod
     def default_query(cls, key):
         if isinstance(key, tuple):
-            sid, div_id, course_name = key
-            return (cls.sid == sid) and (cls.div_id == div_id) and (course_name == course_name)
+            if len(key) == 4:
+                sid, div_id, courses_id, course_name = key
+                course_criteria = db.or_(
+                    cls.courses_id == courses_id,
+                    db.and_(cls.courses_id.is_(None), cls.course_name == course_name),
+                )
+            else:
+                sid, div_id, course = key
+                course_criteria = cls.courses_id == course if isinstance(course, int) else cls.course_name == course
+            return db.and_(cls.sid == sid, cls.div_id == div_id, course_criteria)
 
 
 class TimedExam(db.Model, AnswerMixin):
@@ -288,6 +384,60 @@ class LpAnswers(db.Model, AnswerMixin):
             return super().default_query(key)
 
 
+# QuestionProgress
+# ----------------
+# A rollup of every answer a student has given to one question, maintained by the `hsblog endpoint` as each answer is recorded. This answers "has student X answered question Y correctly?" for an entire course with one indexed query, rather than a scan of every CorrectAnswerMixin table. See `progress.py` for the code which maintains it.
+class QuestionProgress(db.Model, IdMixin):
+    # See sid_.
+    sid = db.Column(db.String(512), nullable=False)
+    # See courses_id_.
+    courses_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    # See div_id_.
+    div_id = db.Column(db.String(512), nullable=False)
+    # The timestamp_ of the first correct answer, or None if the student hasn't answered correctly yet.
+    first_correct_at = db.Column(db.DateTime)
+    # The number of answers recorded for this question.
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # The best score on this question, from 0 (incorrect) to 100 (correct). None if no answer provided a score.
+    best_score = db.Column(db.Float)
+
+    # The upsert in `progress.py` relies on this constraint; its index (course first) also serves the course-wide progress query.
+    __table_args__ = (db.UniqueConstraint('courses_id', 'sid', 'div_id'),)
+
+    @classmethod
+    def default_query(cls, key):
+        if isinstance(key, tuple):
+            sid, div_id, courses_id = key
+            return db.and_(cls.sid == sid, cls.div_id == div_id, cls.courses_id == courses_id)
+
+
+# TimedExamStats
+# --------------
+# The distribution of every result of one timed exam, maintained by the `hsblog endpoint` as each TimedExam_ row is stored, so that an exam's statistics are read from one row rather than computed from all its attempts. See `exam_stats.py` for the code which maintains it.
+class TimedExamStats(db.Model, IdMixin):
+    # See courses_id_.
+    courses_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    # See div_id_.
+    div_id = db.Column(db.String(512), nullable=False)
+    # The number of results, excluding resets.
+    attempts = db.Column(db.Integer, nullable=False)
+    # The number of results with a score: the percentage of the exam's questions answered correctly.
+    scored = db.Column(db.Integer, nullable=False)
+    # The sum of those scores.
+    score_sum = db.Column(db.Float, nullable=False)
+    # ``score_histogram[i]`` counts the scores from ``i`` up to (but not including) ``i + 1``; the last element counts perfect scores.
+    score_histogram = db.Column(ARRAY(db.Integer), nullable=False)
+    # The number of results with a time_taken.
+    timed = db.Column(db.Integer, nullable=False)
+    # The sum of those times, in seconds.
+    time_sum = db.Column(db.Float, nullable=False)
+    # ``time_histogram[i]`` counts the times from ``i`` up to (but not including) ``i + 1`` times ``TIME_BUCKET_SECONDS`` in `exam_stats.py`; the last element also counts every longer time.
+    time_histogram = db.Column(ARRAY(db.Integer), nullable=False)
+
+    # The upsert in `exam_stats.py` relies on this constraint.
+    __table_args__ = (db.UniqueConstraint('courses_id', 'div_id'),)
+
+
 # Flask-User customization
 # ========================
 # This can't be placed in `extensions.py`, because it needs the AuthUser_ model to be defined.
@@ -0,0 +1,190 @@
+# *****************************
+# |docname| - Profiling workers
+# *****************************
+# Two tools for finding where time goes:
+#
+# -   A sampling profiler for live workers. Every few milliseconds, it records the stack of every thread in the worker; its output, in the collapsed-stack format, is ready for `flamegraph.pl <https://github.com/brendangregg/FlameGraph>`_ or `speedscope <https://www.speedscope.app>`_. It costs nothing until triggered, so it's safe to enable in production. Set ``PROFILER_ENABLED`` to True, then either:
+#
+#     -   As a user listed in ``ADMIN_USERNAMES``, visit ``/admin/profile?seconds=N`` to download N seconds of samples. This blocks the request for N seconds, so it only sees other requests with threaded workers.
+#     -   Send ``PROFILER_SIGNAL`` (``SIGUSR2`` by default) to a worker's PID, which writes ``PROFILER_SIGNAL_SECONDS`` of samples to ``profile-<pid>-<time>.collapsed`` in ``PROFILER_OUTPUT_DIR``. This works with any worker type, but not with gunicorn's ``--preload``, since gunicorn resets the signal handlers of its workers after loading the app.
+#
+# -   `cProfile <https://docs.python.org/3/library/profile.html>`_ for one request. When ``PROFILE_REQUEST_HEADER`` is set (the development config uses ``X-Profile``), a request carrying this header is profiled. Its statistics are saved to ``<endpoint>-<time>.prof`` in ``PROFILER_OUTPUT_DIR``, whose name is returned in the response header of the same name. View them with ``python -m pstats`` or `snakeviz <https://jiffyclub.github.io/snakeviz/>`_.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from threading import Lock, Thread, get_ident
+from time import monotonic, sleep
+import cProfile
+import logging
+import os
+import signal
+import sys
+import tempfile
+
+# Third-party imports
+# -------------------
+from flask import Blueprint, Response, abort, current_app, g, request
+from flask_user import current_user, login_required
+
+# Local imports
+# -------------
+# None.
+#
+# Logging
+# =======
+logger = logging.getLogger(__name__)
+
+
+# Sampling
+# ========
+# Only one profile may run at a time; overlapping profiles would double the overhead and record each other.
+_sampling_lock = Lock()
+
+
+# Describe one stack frame.
+def _frame_name(frame):
+    code = frame.f_code
+    # Use the function's first line, not the current line, so that every sample in a function merges into one frame of the graph.
+    return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+# Sample the stacks of every other thread every ``interval`` seconds for ``seconds`` seconds. Return a ``Counter`` of ``{collapsed_stack: samples}``, where ``collapsed_stack`` lists frames from outermost to innermost, separated by semicolons.
+def sample_stacks(seconds, interval=0.005):
+    samples = Counter()
+    my_id = get_ident()
+    end = monotonic() + seconds
+    while monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == my_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            samples[';'.join(reversed(stack))] += 1
+        sleep(interval)
+    return samples
+
+
+# Format samples in the collapsed-stack format: one ``stack count`` line per stack.
+def format_collapsed(samples):
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(samples.items()))
+
+
+# Take a profile, or return None if one is already running.
+def profile(seconds, interval=0.005):
+    if not _sampling_lock.acquire(blocking=False):
+        return None
+    try:
+        return format_collapsed(sample_stacks(seconds, interval))
+    finally:
+        _sampling_lock.release()
+
+
+# Take a profile, then write it to a file in ``output_dir``.
+def profile_to_file(output_dir, seconds, interval=0.005):
+    collapsed = profile(seconds, interval)
+    if collapsed is None:
+        logger.warning('A profile is already running; ignoring this request.')
+        return None
+    path = Path(output_dir) / 'profile-{}-{}.collapsed'.format(os.getpid(), _timestamp())
+    path.write_text(collapsed)
+    logger.warning('Wrote a %s second profile to %s.', seconds, path)
+    return path
+
+
+def _output_dir(config):
+    return config.get('PROFILER_OUTPUT_DIR') or tempfile.gettempdir()
+
+
+# A timestamp for file names, precise enough to keep profiles of back-to-back requests apart.
+def _timestamp():
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+# Endpoint
+# ========
+profiling = Blueprint('profiling', __name__, url_prefix='/admin')
+
+
+# Return a collapsed-stack profile of this worker. Arguments:
+#
+# seconds
+#   How long to sample, up to ``PROFILER_MAX_SECONDS``; defaults to 10.
+#
+# interval
+#   The time between samples, in milliseconds; defaults to 5.
+@profiling.route('/profile')
+@login_required
+def profile_endpoint():
+    if current_user.username not in current_app.config.get('ADMIN_USERNAMES', []):
+        abort(403)
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 5))/1000
+    except ValueError:
+        abort(400)
+    seconds = max(0, min(seconds, current_app.config.get('PROFILER_MAX_SECONDS', 60)))
+    interval = max(interval, 0.001)
+    collapsed = profile(seconds, interval)
+    if collapsed is None:
+        return Response('A profile is already running.\n', status=409, mimetype='text/plain')
+    return Response(collapsed, mimetype='text/plain', headers={
+        'Content-Disposition': 'attachment; filename=profile-{}.collapsed'.format(os.getpid()),
+    })
+
+
+# Per-request cProfile
+# ====================
+def _start_request_profile():
+    if request.headers.get(current_app.config['PROFILE_REQUEST_HEADER']):
+        g.request_profiler = cProfile.Profile()
+        g.request_profiler.enable()
+
+
+def _finish_request_profile(response):
+    profiler = g.pop('request_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        path = Path(_output_dir(current_app.config)) / '{}-{}.prof'.format(request.endpoint or 'none', _timestamp())
+        profiler.dump_stats(str(path))
+        response.headers[current_app.config['PROFILE_REQUEST_HEADER']] = str(path)
+    return response
+
+
+# Install the profilers enabled in ``app``'s config.
+def init_app(app):
+    if app.config.get('PROFILE_REQUEST_HEADER'):
+        app.before_request(_start_request_profile)
+        app.after_request(_finish_request_profile)
+
+    if not app.config.get('PROFILER_ENABLED'):
+        return
+    app.register_blueprint(profiling)
+
+    signal_name = app.config.get('PROFILER_SIGNAL')
+    if signal_name:
+        output_dir = _output_dir(app.config)
+        seconds = app.config.get('PROFILER_SIGNAL_SECONDS', 30)
+
+        # Signal handlers must return quickly, so sample in another thread.
+        def handler(signum, frame):
+            Thread(target=profile_to_file, args=(output_dir, seconds), daemon=True).start()
+
+        signum = getattr(signal, signal_name, None)
+        if signum is None:
+            logger.warning('Unknown PROFILER_SIGNAL %s; the profiler signal handler is not installed.', signal_name)
+            return
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            # Only the main thread may install signal handlers.
+            logger.warning('Unable to install the profiler signal handler for %s outside the main thread.', signal_name)
@@ -0,0 +1,147 @@
+# ***************************************************
+# |docname| - Maintain and query per-student progress
+# ***************************************************
+# The `hsblog endpoint` calls ``record_answer`` each time it stores an answer (including a short answer or a timed exam result), which keeps the QuestionProgress_ rollup up to date one row at a time. Instructor dashboards then read an entire course's progress with ``progress_matrix``.
+#
+# For answers stored before this was deployed, ``python manage.py rebuild-progress`` recomputes the rollup from the answer tables. A short answer is stored by replacing the student's previous one, so a rebuild counts only one attempt for it.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from numbers import Number
+
+# Third-party imports
+# -------------------
+from sqlalchemy.dialects.postgresql import insert
+
+# Local imports
+# -------------
+from .backfill import course_id_models
+from .model import db, Courses, CorrectAnswerMixin, LpAnswers, QuestionProgress, ShortanswerAnswers, TimedExam, Useinfo
+
+
+# Scoring
+# =======
+# Convert the ``correct`` value of an answer to a score between 0 and 100. Answers to a CorrectAnswerMixin table supply a Boolean (or None, if the client didn't say); an LpAnswers answer supplies a grade.
+def answer_score(correct):
+    if correct is None:
+        return None
+    elif isinstance(correct, bool):
+        return 100.0 if correct else 0.0
+    else:
+        assert isinstance(correct, Number)
+        return float(correct)
+
+
+# Return a SQL expression giving the score (0 to 100, or NULL) of an answer in ``model``, matching ``answer_score``.
+def score_expression(model):
+    if model is LpAnswers:
+        return db.cast(model.correct, db.Float)
+    elif model is TimedExam:
+        # See ``exam_score`` in `exam_stats.py`.
+        return 100.0*model.correct/db.func.nullif(model.correct + model.incorrect + model.skipped, 0)
+    elif issubclass(model, CorrectAnswerMixin):
+        # Comparing a Web2PyBoolean_ to True or False compares its ``'T'`` or ``'F'``.
+        return db.case([(model.correct == True, 100.0), (model.correct == False, 0.0)], else_=None)
+    else:
+        assert model is ShortanswerAnswers
+        return db.null()
+
+
+# Updates
+# =======
+# Fold one answer into the rollup, using a single upsert so that concurrent requests for the same student and question can't lose an attempt. The statement runs in the current session's transaction, so it commits (or rolls back) along with the answer itself.
+def record_answer(
+    # See sid_.
+    sid,
+    # See courses_id_.
+    courses_id,
+    # See div_id_.
+    div_id,
+    # See timestamp_.
+    timestamp,
+    # The ``correct`` value stored with the answer, or the score of a timed exam; see ``answer_score``.
+    correct):
+
+    score = answer_score(correct)
+    first_correct_at = timestamp if score == 100 else None
+    table = QuestionProgress.__table__
+    stmt = insert(table).values(
+        sid=sid,
+        courses_id=courses_id,
+        div_id=div_id,
+        first_correct_at=first_correct_at,
+        attempts=1,
+        best_score=score,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.courses_id, table.c.sid, table.c.div_id],
+        set_=dict(
+            attempts=table.c.attempts + 1,
+            # PostgreSQL's ``GREATEST`` ignores NULLs, so an unscored answer never erases an earlier score.
+            best_score=db.func.greatest(table.c.best_score, stmt.excluded.best_score),
+            first_correct_at=db.func.coalesce(table.c.first_correct_at, stmt.excluded.first_correct_at),
+        )
+    )
+    db.session.execute(stmt)
+
+
+# Recompute the rollup from every answer table, replacing its contents. This locks the answer tables against writes (though not reads) while it runs, so no answer is missed or counted twice. Return the number of rollup rows.
+def rebuild_question_progress():
+    models = [model for model in course_id_models() if model is not Useinfo]
+    for model in models:
+        db.session.execute('lock table {} in share mode'.format(model.__tablename__))
+    answers = db.union_all(*[
+        db.select([
+            model.sid,
+            # Rows written by web2py may lack a courses_id_.
+            db.func.coalesce(model.courses_id, db.select([Courses.id]).where(Courses.course_name == model.course_name).as_scalar()).label('courses_id'),
+            model.div_id,
+            model.timestamp,
+            score_expression(model).label('score'),
+        ]).where(db.or_(model.reset.is_(None), model.reset == False) if model is TimedExam else db.true())
+        for model in models
+    ]).alias('answers')
+    query = db.select([
+        answers.c.sid,
+        answers.c.courses_id,
+        answers.c.div_id,
+        db.func.min(answers.c.timestamp).filter(answers.c.score == 100),
+        db.func.count(),
+        db.func.max(answers.c.score),
+    ]).where(db.and_(
+        answers.c.sid.isnot(None), answers.c.courses_id.isnot(None), answers.c.div_id.isnot(None),
+    )).group_by(answers.c.sid, answers.c.courses_id, answers.c.div_id)
+
+    QuestionProgress.query.delete()
+    table = QuestionProgress.__table__
+    rows = db.session.execute(table.insert().from_select(
+        ['sid', 'courses_id', 'div_id', 'first_correct_at', 'attempts', 'best_score'], query
+    )).rowcount
+    db.session.commit()
+    return rows
+
+
+# Queries
+# =======
+# Return the progress of every student in the course with courses_id_ ``courses_id`` as a dict of ``{sid: {div_id: progress}}``, where ``progress`` is a dict of the QuestionProgress_ fields. This is a single query on the ``(courses_id, sid, div_id)`` index.
+def progress_matrix(courses_id):
+    matrix = {}
+    query = db.session.query(
+        QuestionProgress.sid,
+        QuestionProgress.div_id,
+        QuestionProgress.first_correct_at,
+        QuestionProgress.attempts,
+        QuestionProgress.best_score,
+    ).filter(QuestionProgress.courses_id == courses_id)
+    for sid, div_id, first_correct_at, attempts, best_score in query:
+        matrix.setdefault(sid, {})[div_id] = dict(
+            first_correct_at=first_correct_at and first_correct_at.isoformat(),
+            attempts=attempts,
+            best_score=best_score,
+        )
+    return matrix
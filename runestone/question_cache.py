@@ -0,0 +1,80 @@
+# *******************************************
+# |docname| - A process-wide Questions cache
+# *******************************************
+# Every `hsblog endpoint` call needs information about the question being answered. Rather than querying Questions_ on each event, this cache loads all of a base course's questions in one query the first time any of them is needed, then answers from memory. The `hsblog endpoint` gets a question's full row this way, so per-event question information costs no query.
+#
+# Questions only change when a book is rebuilt, which should call ``invalidate`` for that base course. Invalidation is sent to every worker through the `cache <extensions.py>`'s invalidation fan-out. In case a rebuild doesn't (for example, one done by web2py), entries also expire after ``QUESTION_CACHE_TIMEOUT`` seconds, and asking for a question which isn't cached reloads its base course, at most once per ``QUESTION_CACHE_MISS_INTERVAL`` seconds.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from threading import Lock
+from time import monotonic
+
+# Third-party imports
+# -------------------
+from flask import current_app
+
+# Local imports
+# -------------
+from .extensions import cache
+from .metrics import count_cache_lookup
+from .model import db, Questions
+
+
+# QuestionCache
+# =============
+class QuestionCache:
+    def __init__(self):
+        # ``{base_course: (loaded_at, {name: row})}``, where ``loaded_at`` is a ``monotonic()`` time and ``row`` is a read-only, named tuple of every Questions column. Rows are plain tuples rather than ORM instances, so they can be shared between threads and sessions.
+        self._base_courses = {}
+        # Serializes loads, so concurrent first requests for a base course run only one query.
+        self._lock = Lock()
+        cache.on_invalidate('questions', self._discard)
+
+    # Return ``(loaded_at, {name: row})`` for ``base_course``, loading it if it isn't cached or was loaded at least ``max_age`` seconds ago.
+    def _load(self, base_course, max_age):
+        entry = self._base_courses.get(base_course)
+        if entry is None or monotonic() - entry[0] >= max_age:
+            with self._lock:
+                # Another thread may have loaded this while we waited for the lock.
+                entry = self._base_courses.get(base_course)
+                if entry is None or monotonic() - entry[0] >= max_age:
+                    query = db.session.query(*Questions.__table__.columns).filter(Questions.base_course == base_course)
+                    entry = self._base_courses[base_course] = (monotonic(), {row.name: row for row in query})
+        return entry
+
+    # Return ``{name: row}`` for every question in ``base_course``, loading it if necessary.
+    def get_base_course(self, base_course):
+        entry = self._base_courses.get(base_course)
+        loaded_at, questions = self._load(base_course, current_app.config.get('QUESTION_CACHE_TIMEOUT', 3600))
+        count_cache_lookup('questions', entry is not None and entry[0] == loaded_at)
+        return questions
+
+    # Return the row for question ``name`` (its div_id_) in ``base_course``, or None if there's no such question.
+    def get(self, base_course, name):
+        row = self.get_base_course(base_course).get(name)
+        if row is None:
+            # The question may have been added since the base course was loaded.
+            loaded_at, questions = self._load(base_course, current_app.config.get('QUESTION_CACHE_MISS_INTERVAL', 60))
+            row = questions.get(name)
+        return row
+
+    # Discard cached questions for ``base_course``, or for all base courses if it's None, in every worker. Call this after a book is rebuilt.
+    def invalidate(self, base_course=None):
+        cache.invalidate('questions', base_course)
+
+    # Discard cached questions in this worker only.
+    def _discard(self, base_course):
+        with self._lock:
+            if base_course is None:
+                self._base_courses.clear()
+            else:
+                self._base_courses.pop(base_course, None)
+
+
+question_cache = QuestionCache()
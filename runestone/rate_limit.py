@@ -0,0 +1,148 @@
+# ******************************************************
+# |docname| - Rate limiting and load shedding for hsblog
+# ******************************************************
+# A misbehaving client, such as a widget stuck in a loop, can flood the `hsblog endpoint` and starve everyone else of database connections. ``check_hsblog_limits`` protects it two ways, before the endpoint does any work:
+#
+# -   Rate limits. Each sid (see `sid.py`) and each client IP address has a `token bucket <https://en.wikipedia.org/wiki/Token_bucket>`_, which allows bursts of up to ``burst`` events, refilled at ``rate`` events per second. ``HSBLOG_RATE_LIMIT_SID`` and ``HSBLOG_RATE_LIMIT_IP`` give ``(rate, burst)``. Since a classroom may share one IP address, its limit should be much higher. Calls over a limit receive a 429 response. Behind a proxy, every request appears to come from the proxy's address; use Werkzeug's ``ProxyFix`` so that ``request.remote_addr`` is the client's address.
+# -   Load shedding. When ``HSBLOG_SHED_QUEUE_DEPTH`` or more threads are waiting for a connection from the database pool, calls receive a 503 response immediately, rather than joining the queue. Only threaded workers share a pool between concurrent requests, so this has no effect with gunicorn's default sync workers.
+#
+# Both responses have the endpoint's usual form, with ``log=False``, and a ``Retry-After`` header. The ``is_authenticated`` value comes from the session, without loading the user from the database.
+#
+# ``HSBLOG_RATE_LIMITER`` selects where buckets are kept:
+#
+# -   ``memory``: in each worker, with exact token buckets. A client's calls spread over several workers are each limited separately.
+# -   ``cache``: in the `cache <extensions.py>`, shared by all workers when it uses the ``redis`` backend. Each bucket is approximated by a counter of the calls in a window of ``burst/rate`` seconds, which allows the same average rate and burst size. If the cache is unreachable, calls are allowed.
+# -   None: no rate limits; load shedding still applies.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from math import ceil
+from threading import Lock
+from time import monotonic, time
+
+# Third-party imports
+# -------------------
+from flask import current_app, jsonify, request, session
+
+# Local imports
+# -------------
+from .extensions import cache, db
+from .metrics import HSBLOG_REJECTED
+from .sessions import session_user_id
+from .sid import get_sid
+
+
+# Limiters
+# ========
+# Each limiter provides ``allow(key, rate, burst)``, which returns True if the bucket named ``key`` has a token, taking it, and ``refund(key, rate, burst)``, which returns a token taken by ``allow``.
+#
+# Token buckets in this worker's memory.
+class MemoryRateLimiter:
+    def __init__(self,
+        # Forget full buckets when there are more than this many.
+        max_buckets=100000):
+
+        self.max_buckets = max_buckets
+        # ``{key: (tokens, updated, full)}``, where ``updated`` is the ``monotonic()`` time ``tokens`` was computed, and ``full`` is the time the bucket will be full again.
+        self._buckets = {}
+        self._lock = Lock()
+
+    def allow(self, key, rate, burst):
+        now = monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated)*rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens)/rate)
+            if len(self._buckets) > self.max_buckets:
+                # A full bucket is the same as a missing one, so forget those.
+                self._buckets = {name: bucket for name, bucket in self._buckets.items() if bucket[2] > now}
+        return allowed
+
+    def refund(self, key, rate, burst):
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                tokens, updated, _ = bucket
+                tokens = min(burst, tokens + (now - updated)*rate + 1)
+                self._buckets[key] = (tokens, now, now + (burst - tokens)/rate)
+
+
+# Counters in the cache, shared by every worker.
+class CacheRateLimiter:
+    def allow(self, key, rate, burst):
+        window = burst/rate
+        count = cache.incr(self._key(key, window), 1, window)
+        return count is None or count <= burst
+
+    # If the window ended since ``allow``, this takes a call from the next one's count instead, allowing one extra call then.
+    def refund(self, key, rate, burst):
+        window = burst/rate
+        cache.incr(self._key(key, window), -1, window)
+
+    @staticmethod
+    def _key(key, window):
+        return 'ratelimit:{}:{}'.format(key, int(time()//window))
+
+
+# Checks
+# ======
+def _reject(status, reason, retry_after):
+    HSBLOG_REJECTED.labels(reason).inc()
+    response = jsonify(
+        log=False,
+        is_authenticated=session_user_id(session) is not None,
+        error='Too many requests; please try again later.' if status == 429 else 'The server is busy; please try again.',
+    )
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# Return a response rejecting this hsblog call, or None to accept it.
+def check_hsblog_limits():
+    config = current_app.config
+
+    # Check the database pool first, since that's what's being protected.
+    depth = config.get('HSBLOG_SHED_QUEUE_DEPTH')
+    if depth and getattr(db.engine.pool, 'waiting', 0) >= depth:
+        return _reject(503, 'overload', 1)
+
+    limiter = current_app.extensions.get('hsblog_rate_limiter')
+    if limiter is None:
+        return None
+    checks = [('ip', str(request.remote_addr), config['HSBLOG_RATE_LIMIT_IP'])]
+    sid = get_sid()
+    if sid:
+        checks.insert(0, ('sid', sid, config['HSBLOG_RATE_LIMIT_SID']))
+    taken = []
+    for kind, name, limit in checks:
+        if limit:
+            rate, burst = limit
+            key = '{}:{}'.format(kind, name)
+            if not limiter.allow(key, rate, burst):
+                # A rejected call shouldn't count against the limits it passed, so return the tokens it took.
+                for args in taken:
+                    limiter.refund(*args)
+                # Suggest waiting for one token to arrive.
+                return _reject(429, kind, ceil(1/rate))
+            taken.append((key, rate, burst))
+    return None
+
+
+def init_app(app):
+    limiter_type = app.config.get('HSBLOG_RATE_LIMITER')
+    if limiter_type == 'memory':
+        app.extensions['hsblog_rate_limiter'] = MemoryRateLimiter()
+    elif limiter_type == 'cache':
+        app.extensions['hsblog_rate_limiter'] = CacheRateLimiter()
+    elif limiter_type:
+        raise ValueError('Unknown HSBLOG_RATE_LIMITER {}.'.format(limiter_type))
@@ -0,0 +1,191 @@
+# *****************************************
+# |docname| - Read replicas of the database
+# *****************************************
+# Most queries made by book pages and the `hsblog endpoint` only read tables which rarely change: a course's settings, and a question's base course. ``READ_REPLICA_URLS`` lists read-only replicas of the database (for example, PostgreSQL streaming replicas); ``init_app`` adds each as a Flask-SQLAlchemy bind named ``replica0``, ``replica1``, and so on. The session (see `extensions.py`) then sends a query to a replica when:
+#
+# -   it's a plain ``SELECT`` (not ``SELECT ... FOR UPDATE``) which reads only tables listed in ``READ_REPLICA_TABLES``; and
+# -   the session hasn't written anything in its current transaction, so that a transaction always reads its own writes.
+#
+# Everything else, including all writes and reads of answer tables such as the check made by ``add_if_incorrect``, goes to the primary. Replicas lag slightly behind the primary, so only list tables in ``READ_REPLICA_TABLES`` whose readers can tolerate a change arriving a moment late. For that reason, ``auth_user`` isn't listed by default: logging in reads it, so a user who just signed up or changed their password might not be able to log in with a lagging replica.
+#
+# Replicas are used in turn. Each replica's health is checked at most every ``READ_REPLICA_CHECK_INTERVAL`` seconds, when it's next chosen: a replica which can't be reached, or which lags more than ``READ_REPLICA_MAX_LAG`` seconds behind the primary, isn't used until a later check succeeds. A replica which fails while running a query is marked unhealthy immediately; that query fails, but later ones go elsewhere. When no replica is healthy, queries go to the primary.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from itertools import count
+from time import monotonic
+import logging
+
+# Third-party imports
+# -------------------
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+
+# Local imports
+# -------------
+# None.
+#
+# Logging
+# =======
+logger = logging.getLogger(__name__)
+
+
+# Replicas
+# ========
+# The replication lag of a PostgreSQL replica, in seconds. This is NULL on a server which isn't a replica. The time since the last replayed transaction keeps growing while the primary is idle, so a replica which has replayed everything it has received reports no lag. A replica cut off from its primary also reports no lag; monitor replication itself to catch that.
+LAG_QUERY = (
+    'select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0 '
+    'else extract(epoch from now() - pg_last_xact_replay_timestamp()) end'
+)
+
+
+class Replica:
+    def __init__(self, bind_key):
+        self.bind_key = bind_key
+        self.healthy = True
+        # The ``monotonic()`` time of the last health check; a replica starts unchecked.
+        self.checked = None
+
+
+class ReplicaSet:
+    def __init__(self,
+        # The Flask-SQLAlchemy bind key of each replica.
+        bind_keys,
+        # Check a replica's health at most this often, in seconds.
+        check_interval=10,
+        # The most replication lag, in seconds, a healthy replica may have; None accepts any lag.
+        max_lag=None):
+
+        self.replicas = [Replica(bind_key) for bind_key in bind_keys]
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._next = count()
+        # The engines already listening for errors; see ``_engine``.
+        self._watched = set()
+
+    # Return the engine of the next healthy replica, or None if there are none.
+    def choose(self, app):
+        if not self.replicas:
+            return None
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            engine = self._engine(app, replica)
+            if self._is_healthy(engine, replica):
+                return engine
+        return None
+
+    def _engine(self, app, replica):
+        engine = get_state(app).db.get_engine(app, bind=replica.bind_key)
+        if engine not in self._watched:
+            self._watched.add(engine)
+
+            def handle_error(context):
+                # Errors in the query itself (a typo, a constraint) say nothing about the replica's health.
+                if context.is_disconnect or isinstance(context.original_exception, exc.OperationalError):
+                    logger.warning('Read replica %s failed: %s', replica.bind_key, context.original_exception)
+                    self.mark_failed(replica)
+
+            event.listen(engine, 'handle_error', handle_error)
+        return engine
+
+    def _is_healthy(self, engine, replica):
+        now = monotonic()
+        if replica.checked is None or now - replica.checked >= self.check_interval:
+            replica.checked = now
+            was_healthy = replica.healthy
+            replica.healthy = self._check(replica, engine)
+            if replica.healthy and not was_healthy:
+                logger.info('Read replica %s recovered.', replica.bind_key)
+        return replica.healthy
+
+    # Return True if the replica behind ``engine`` is reachable and not too far behind.
+    def _check(self, replica, engine):
+        # An unhealthy replica may have left broken connections in the pool; start afresh.
+        if not replica.healthy:
+            engine.dispose()
+        try:
+            with engine.connect() as connection:
+                lag = connection.scalar(LAG_QUERY)
+        except exc.DBAPIError:
+            # ``handle_error`` has already logged this.
+            return False
+        if lag is not None and self.max_lag is not None and lag > self.max_lag:
+            logger.warning('Read replica %s lags by %.1f seconds.', replica.bind_key, lag)
+            return False
+        return True
+
+    # Stop using ``replica`` until its next health check.
+    def mark_failed(self, replica):
+        replica.healthy = False
+        replica.checked = monotonic()
+
+
+# Routing
+# =======
+# Return True if ``clause`` only reads from ``tables``.
+def _is_replica_read(clause, tables):
+    if not isinstance(clause, Select) or clause._for_update_arg is not None:
+        return False
+    names = {table.name for table in find_tables(clause)}
+    return bool(names) and names <= tables
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # A write run directly, such as by `insert_row <inserts.py>`, rather than by a flush; see ``_after_flush``.
+        if isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        replicas = self.app.extensions.get('read_replicas')
+        if (
+            replicas is not None
+            # A session bound to a connection (as in the tests, which run each test in a transaction) must use only that connection.
+            and isinstance(self.bind, Engine)
+            and not self.info.get('wrote')
+            and _is_replica_read(clause, self.app.config['READ_REPLICA_TABLES'])
+        ):
+            engine = replicas.choose(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+# Once a transaction writes, send the rest of its queries to the primary, which is the only server that can see its writes.
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('wrote', None)
+
+
+# Add a bind for each replica in ``READ_REPLICA_URLS``. Call this before the database is used.
+def init_app(app):
+    urls = app.config.get('READ_REPLICA_URLS')
+    if not urls:
+        return
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    bind_keys = []
+    for index, url in enumerate(urls):
+        bind_key = 'replica{}'.format(index)
+        binds[bind_key] = url
+        bind_keys.append(bind_key)
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['READ_REPLICA_TABLES'] = set(app.config.get('READ_REPLICA_TABLES') or ())
+    app.extensions['read_replicas'] = ReplicaSet(
+        bind_keys,
+        app.config.get('READ_REPLICA_CHECK_INTERVAL', 10),
+        app.config.get('READ_REPLICA_MAX_LAG'),
+    )
@@ -0,0 +1,244 @@
+# ********************************
+# |docname| - Server-side sessions
+# ********************************
+# Flask keeps its session in a signed cookie, which is re-serialized, re-signed and re-sent on every request that changes it; Flask-Login and Flask-User keep several keys there. This optional replacement keeps each session's data on the server instead, so the cookie holds only a random session id. Set ``SESSION_TYPE`` to:
+#
+# -   ``cookie``: Flask's signed cookie; the default.
+# -   ``memory``: a least-recently-used store in each worker's memory, holding up to ``SESSION_MEMORY_MAX`` sessions. This is only suitable for a single worker, since other workers can't see its sessions.
+# -   ``redis``: a store shared by every worker, in the Redis-protocol server at ``SESSION_REDIS_URL`` (by default, the cache's server).
+#
+# A session is loaded from the store only when the request first reads or writes it, so requests which never touch the session, such as book pages and static content from courses which don't require a login, cost nothing. It's written back only if it changed. Sessions expire from the store ``PERMANENT_SESSION_LIFETIME`` after they last changed, or (for permanent sessions, with ``SESSION_REFRESH_EACH_REQUEST``) after they were last used.
+#
+# Session data is stored in Python's compact `marshal <https://docs.python.org/3/library/marshal.html>`_ format, which supports only basic types (str, bytes, numbers, booleans, None, and lists, tuples and dicts of these) -- which is all Flask-Login and Flask-User store.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import logging
+import marshal
+import secrets
+
+# Third-party imports
+# -------------------
+from flask.sessions import SessionInterface, SessionMixin
+
+# Local imports
+# -------------
+from .extensions import RedisCacheBackend
+#
+# Logging
+# =======
+logger = logging.getLogger(__name__)
+
+
+# Encoding
+# ========
+# The first byte gives the format, so that it can change later.
+_FORMAT_MARSHAL = b'\x01'
+
+
+def encode_session(data):
+    return _FORMAT_MARSHAL + marshal.dumps(data, 4)
+
+
+def decode_session(value):
+    if value[:1] != _FORMAT_MARSHAL:
+        raise ValueError('Unknown session format.')
+    data = marshal.loads(value[1:])
+    if not isinstance(data, dict):
+        raise ValueError('Session data must be a dict.')
+    return data
+
+
+# Stores
+# ======
+# Each store provides ``get(key)``, returning the bytes stored under ``key`` or None; ``set(key, value, timeout)``, which stores ``value`` for ``timeout`` seconds; and ``delete(key)``.
+#
+# A store in this worker's memory, which discards the least recently used session when full.
+class LRUSessionStore:
+    def __init__(self,
+        # The most sessions to keep.
+        max_sessions=10000):
+
+        self.max_sessions = max_sessions
+        # ``{key: (value, expires)}``, least recently used first, where ``expires`` is a ``monotonic()`` time.
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (value, monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# A store shared by all workers, in a Redis-protocol server. This uses the cache's client, but stores bytes as they are rather than pickling them. If the server can't be reached, sessions appear empty.
+class RedisSessionStore(RedisCacheBackend):
+    def get(self, key):
+        return self._execute('GET', key)
+
+    def set(self, key, value, timeout):
+        self._execute('SET', key, value, 'PX', max(1, int(timeout*1000)))
+
+
+# Sessions
+# ========
+# Return the id of the user logged in to a session's ``data``. Flask-Login 0.4 stores it as ``user_id``; later versions use ``_user_id``.
+def session_user_id(data):
+    return data.get('_user_id', data.get('user_id'))
+
+
+# A session which is loaded from its store on first use.
+class ServerSideSession(SessionMixin):
+    def __init__(self,
+        # A function which returns the data of the session with id ``sid``, as a dict.
+        load,
+        # This session's id, from the cookie; None for a new session.
+        sid):
+
+        self._load = load
+        self.sid = sid
+        self._data = None
+        self.modified = False
+        self.accessed = False
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = self._load(self.sid) if self.sid else {}
+            # See ``ServerSideSessionInterface.save_session``.
+            self.loaded_user_id = session_user_id(self._data)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    # Flask-Login checks for ``remember`` after every request. It sets this key only in a request which has already loaded the session, then removes it at the end of that request, so a session which hasn't been loaded can't contain it. Answer without loading.
+    def __contains__(self, key):
+        if self._data is None and key == 'remember':
+            return False
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self,
+        # The store for session data.
+        store,
+        # A prefix for the keys of stored sessions.
+        key_prefix='session:'):
+
+        self.store = store
+        self.key_prefix = key_prefix
+
+    def _load(self, sid):
+        value = self.store.get(self.key_prefix + sid)
+        if value is None:
+            return {}
+        try:
+            return decode_session(value)
+        except Exception:
+            logger.exception('Discarding an unreadable session.')
+            return {}
+
+    def open_session(self, app, request):
+        return ServerSideSession(self._load, request.cookies.get(app.session_cookie_name))
+
+    def save_session(self, app, session, response):
+        # Don't touch the store or the cookie if this request didn't use the session.
+        if not session.is_loaded:
+            return
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # If the session is modified to be empty, remove it and its cookie.
+        if not session:
+            if session.modified and session.sid:
+                self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        # Add a "Vary: Cookie" header if the session was accessed at all.
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        # Give the session a new id when it's new, or when its user changes (usually by logging in), so that an id planted in a browser before login can't be used to share the logged-in session.
+        new_sid = session.sid is None or session_user_id(session) != session.loaded_user_id
+        if new_sid:
+            if session.sid:
+                self.store.delete(self.key_prefix + session.sid)
+            session.sid = secrets.token_urlsafe(24)
+            session.loaded_user_id = session_user_id(session)
+        self.store.set(self.key_prefix + session.sid, encode_session(dict(session)), app.permanent_session_lifetime.total_seconds())
+
+        # The cookie's value only changes with the id. A permanent session's cookie is also sent again to extend its expiration time, if ``SESSION_REFRESH_EACH_REQUEST`` is set.
+        if new_sid or session.permanent:
+            response.set_cookie(
+                app.session_cookie_name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+# Replace ``app``'s session interface according to ``SESSION_TYPE``.
+def init_app(app):
+    session_type = app.config.get('SESSION_TYPE', 'cookie')
+    if session_type == 'cookie':
+        return
+    elif session_type == 'memory':
+        store = LRUSessionStore(app.config.get('SESSION_MEMORY_MAX', 10000))
+    elif session_type == 'redis':
+        store = RedisSessionStore(app.config.get('SESSION_REDIS_URL') or app.config['CACHE_REDIS_URL'])
+    else:
+        raise ValueError('Unknown SESSION_TYPE {}.'.format(session_type))
+    app.session_interface = ServerSideSessionInterface(store, app.config.get('SESSION_KEY_PREFIX', 'runestone:session:'))
@@ -0,0 +1,116 @@
+# *****************************
+# |docname| - Signed sid cookie
+# *****************************
+# The `hsblog endpoint` records every event with a sid: the username of a logged-in user, or a random id for anyone else. The sid is kept in its own small cookie, ``SID_COOKIE_NAME``, signed with the app's secret key so that it can't be forged. Unlike Flask's session cookie, which is re-serialized, re-signed and re-sent whenever it's assigned to, this cookie is only sent when the sid changes: when an anonymous visitor is first seen, or logs in. Even after a login expires, the sid stays the same, so that the visitor's later events aren't scattered across new anonymous sids.
+#
+# The cookie also records whether the sid is anonymous, that is, made by ``new_sid``. Only an anonymous sid's events are moved to the username of a user who logs in, so that a visitor can't claim another user's events, and one user's events are never moved to the next person to log in on a shared computer. For the same reason, logging out replaces the sid with a new anonymous one.
+#
+# Earlier versions kept the sid in Flask's session; a sid found there is moved to this cookie, but it isn't known to be anonymous.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import secrets
+
+# Third-party imports
+# -------------------
+from flask import current_app, g, request, session
+from flask_user.signals import user_logged_out
+from itsdangerous import BadSignature, Signer
+
+# Local imports
+# -------------
+# None.
+
+
+def _signer():
+    return current_app.extensions['sid_signer']
+
+
+# The cookie holds ``<kind>:<sid>``, where ``<kind>`` is ``ANONYMOUS`` or ``USER``.
+ANONYMOUS = 'a'
+USER = 'u'
+
+
+# Read the sid, and whether it's anonymous, into ``g``.
+def _load_sid():
+    sid = None
+    anonymous = False
+    value = request.cookies.get(current_app.config['SID_COOKIE_NAME'])
+    if value:
+        try:
+            kind, _, sid = _signer().unsign(value).decode('utf-8').partition(':')
+            anonymous = kind == ANONYMOUS
+            # A cookie written before sids were marked has no kind.
+            if kind not in (ANONYMOUS, USER):
+                sid = None
+        except BadSignature:
+            pass
+    if not sid:
+        sid = session.get('sid')
+        # Move a sid from Flask's session to the cookie.
+        g.sid_changed = sid is not None
+    g.sid = sid
+    g.sid_anonymous = anonymous
+
+
+# Return this request's sid, or None if it has none.
+def get_sid():
+    if 'sid' not in g:
+        _load_sid()
+    return g.sid
+
+
+# Return True if this request's sid was made by ``new_sid``.
+def is_anonymous_sid():
+    if 'sid' not in g:
+        _load_sid()
+    return g.sid_anonymous
+
+
+# Set this request's sid, sending the cookie only if it changed.
+def set_sid(sid, anonymous=False):
+    if sid != get_sid() or anonymous != is_anonymous_sid():
+        g.sid = sid
+        g.sid_anonymous = anonymous
+        g.sid_changed = True
+
+
+# Return a new random sid for an anonymous visitor; pass it to ``set_sid`` with ``anonymous=True``.
+def new_sid():
+    return secrets.token_urlsafe(12)
+
+
+# ``g`` lasts as long as the application context, which may span several requests (as in the tests), so start each request afresh.
+def _before_request():
+    g.pop('sid', None)
+    g.pop('sid_anonymous', None)
+    g.pop('sid_changed', None)
+
+
+def _after_request(response):
+    if g.get('sid_changed'):
+        config = current_app.config
+        response.set_cookie(
+            config['SID_COOKIE_NAME'], _signer().sign('{}:{}'.format(ANONYMOUS if g.sid_anonymous else USER, g.sid).encode('utf-8')).decode('utf-8'),
+            max_age=config.get('SID_COOKIE_MAX_AGE'),
+            domain=current_app.session_interface.get_cookie_domain(current_app),
+            secure=config['SESSION_COOKIE_SECURE'], httponly=True,
+            samesite=config['SESSION_COOKIE_SAMESITE'],
+        )
+    return response
+
+
+def _logged_out(app, **kwargs):
+    set_sid(new_sid(), anonymous=True)
+
+
+def init_app(app):
+    app.extensions['sid_signer'] = Signer(app.secret_key, salt='runestone.sid')
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    user_logged_out.connect(_logged_out, app)
@@ -0,0 +1,308 @@
+# *******************************************
+# |docname| - A write-ahead spool for Useinfo
+# *******************************************
+# Every page view and answer is logged to Useinfo by the `hsblog endpoint`. If the database is down, or too slow to answer within ``SPOOL_LATENCY_BUDGET_MS`` milliseconds, the row is appended to a spool on local disk instead, and the request succeeds. A background thread in each worker replays the spool into the database, in bulk, once it's reachable again.
+#
+# Set ``SPOOL_DIR`` to a directory on local disk to enable this; the workers on one machine should share it.
+#
+# The budget covers getting a connection as well as running the insert. With spooling enabled, ``init_app`` sets the pool's checkout timeout to the budget, and libpq's ``connect_timeout`` to the budget in whole seconds (libpq's minimum is 2), unless ``SQLALCHEMY_ENGINE_OPTIONS`` sets them. These apply to every request, so with spooling enabled, a request which can't get a connection within the budget fails instead of queuing.
+#
+# Format
+# ======
+# The spool is a set of segment files, each ``SPOOL_SEGMENT_SIZE`` bytes long and memory-mapped while being written. Each process appends to its own segment, named ``<time>-<pid>.open``; names sort in the order the segments were created. A segment is a sequence of records, each of which is:
+#
+# -   The payload's length, as a little-endian, 4-byte unsigned integer. A length of 0 marks the end of the segment's records.
+# -   The payload's CRC-32, in the same format.
+# -   The payload: a row of Useinfo, as UTF-8 encoded JSON.
+#
+# A record's header is written after its payload, so a crash mid-write leaves either no record or one whose checksum doesn't match; reading stops there.
+#
+# Replay
+# ======
+# The replayer first closes its own process's segment, renaming it to ``.ready``; segments left ``.open`` by processes which no longer exist are treated the same way. Any process may then claim a ready segment by renaming it to ``.replaying-<pid>``, insert its rows, and delete it. If the database fails again, the segment is renamed back to ``.ready`` to be retried later. A crash between inserting a segment's rows and deleting it replays those rows twice.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from datetime import datetime
+from math import ceil
+from pathlib import Path
+from threading import Lock, Thread
+from time import sleep, time_ns
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+# Third-party imports
+# -------------------
+from flask import current_app
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeoutError
+
+# Local imports
+# -------------
+from .metrics import USEINFO_SPOOLED, USEINFO_REPLAYED
+from .model import db
+from .useinfo_storage import add_useinfo, insert_useinfo
+#
+# Logging
+# =======
+logger = logging.getLogger(__name__)
+
+
+# Segment files
+# =============
+_HEADER = struct.Struct('<II')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Return ``(records, complete)`` for the segment at ``path``, where ``records`` is a list of payloads (as bytes). ``complete`` is False if reading stopped at a damaged record.
+def read_segment(path):
+    data = Path(path).read_bytes()
+    records = []
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        length, crc = _HEADER.unpack_from(data, offset)
+        if length == 0:
+            return records, True
+        payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            return records, False
+        records.append(payload)
+        offset += _HEADER.size + length
+    return records, True
+
+
+class Spool:
+    def __init__(self,
+        # The directory holding the segment files.
+        directory,
+        # The size of each segment file, in bytes.
+        segment_size=4*2**20,
+        # True to flush each record to disk before returning. This survives a crash of the machine, not just of the process, but is slower.
+        sync=False):
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.sync = sync
+        self._lock = Lock()
+        self._path = None
+        self._file = None
+        self._map = None
+        self._offset = 0
+
+    # Append ``payload`` (bytes) to this process's segment, starting a new segment if it's full.
+    def append(self, payload):
+        size = _HEADER.size + len(payload)
+        # Leave room for the end marker.
+        if size + _HEADER.size > self.segment_size:
+            raise ValueError('A record of {} bytes is larger than the segment size.'.format(len(payload)))
+        with self._lock:
+            if self._map is None or self._offset + size + _HEADER.size > self.segment_size:
+                self._close_segment()
+                self._open_segment()
+            offset = self._offset
+            self._map[offset + _HEADER.size:offset + size] = payload
+            self._map[offset:offset + _HEADER.size] = _HEADER.pack(len(payload), zlib.crc32(payload))
+            self._offset += size
+            if self.sync:
+                self._map.flush()
+
+    def _open_segment(self):
+        self._path = self.directory / '{:020d}-{}.open'.format(time_ns(), os.getpid())
+        self._file = open(str(self._path), 'w+b')
+        # The file starts out full of zeros, so the first record's length of 0 marks the end.
+        self._file.truncate(self.segment_size)
+        self._map = mmap.mmap(self._file.fileno(), self.segment_size)
+        self._offset = 0
+
+    # Close this process's segment, making it ready to replay.
+    def _close_segment(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._path.rename(self._path.with_suffix('.ready'))
+        self._map = self._file = self._path = None
+        self._offset = 0
+
+    # Return True if there are records waiting to be replayed.
+    def pending(self):
+        with self._lock:
+            if self._offset:
+                return True
+        return any(path.suffix in ('.ready', '.open') for path in self.directory.iterdir())
+
+    # Make every finished segment ready to replay: this process's current segment (if it has any records), plus segments left behind by processes which have exited.
+    def _collect(self):
+        with self._lock:
+            if self._offset:
+                self._close_segment()
+        for path in self.directory.iterdir():
+            # Find the process using this segment: the writer of an open segment, or the replayer of a claimed one.
+            if path.suffix == '.open':
+                pid = int(path.stem.split('-')[1])
+            elif path.suffix.startswith('.replaying-'):
+                pid = int(path.suffix.split('-')[1])
+            else:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                path.rename(path.with_suffix('.ready'))
+
+    # Replay every ready segment, oldest first, by passing its records to ``insert(payloads)``, which should raise an exception if they can't be stored. Return the number of records replayed.
+    def replay(self, insert):
+        self._collect()
+        replayed = 0
+        for path in sorted(self.directory.glob('*.ready')):
+            claimed = path.with_suffix('.replaying-{}'.format(os.getpid()))
+            try:
+                path.rename(claimed)
+            except FileNotFoundError:
+                # Another process claimed it first.
+                continue
+            records, complete = read_segment(claimed)
+            if not complete:
+                logger.error('Spool segment %s is damaged; replaying the %d records before the damage.', path, len(records))
+            try:
+                insert(records)
+            except Exception:
+                claimed.rename(path)
+                raise
+            claimed.unlink()
+            replayed += len(records)
+        return replayed
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+# Useinfo spooling
+# ================
+def _encode(row):
+    row = dict(row)
+    if row.get('timestamp') is not None:
+        row['timestamp'] = row['timestamp'].isoformat()
+    return json.dumps(row, separators=(',', ':')).encode('utf-8')
+
+
+def _decode(payload):
+    row = json.loads(payload.decode('utf-8'))
+    if row.get('timestamp') is not None:
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    return row
+
+
+# Write one row of Useinfo, given as keyword arguments. Return True if it was stored in the database, or False if it was spooled instead.
+def log_useinfo(**row):
+    spool = current_app.extensions.get('useinfo_spool')
+    if spool is None:
+        add_useinfo(**row)
+        db.session.commit()
+        return True
+
+    try:
+        # Limit the time this transaction's statements may run. ``SET LOCAL`` lasts only until the commit.
+        db.session.execute('set local statement_timeout = {:d}'.format(current_app.config['SPOOL_LATENCY_BUDGET_MS']))
+        add_useinfo(**row)
+        db.session.commit()
+        return True
+    except (OperationalError, PoolTimeoutError) as e:
+        # The database is unreachable, canceled the statement for taking too long, or no connection was free in time.
+        logger.warning('Spooling a Useinfo row: %s', getattr(e, 'orig', e))
+        try:
+            db.session.rollback()
+        except DBAPIError:
+            pass
+        spool.append(_encode(row))
+        USEINFO_SPOOLED.inc()
+        return False
+
+
+# Insert spooled rows, in one transaction.
+def _insert_rows(payloads):
+    rows = [_decode(payload) for payload in payloads]
+    if not rows:
+        return
+    # An ``OperationalError`` means the database is still unavailable; let it propagate, so the rows are retried later.
+    try:
+        with db.engine.begin() as connection:
+            insert_useinfo(connection, rows)
+        USEINFO_REPLAYED.inc(len(rows))
+        return
+    except OperationalError:
+        raise
+    except DBAPIError:
+        pass
+
+    # At least one row is invalid. Insert the rows one at a time, discarding the invalid rows, so they can't block replay forever.
+    for row in rows:
+        try:
+            with db.engine.begin() as connection:
+                insert_useinfo(connection, [row])
+            USEINFO_REPLAYED.inc()
+        except OperationalError:
+            raise
+        except DBAPIError as e:
+            logger.error('Discarding spooled Useinfo row %s: %s', row, e.orig)
+
+
+# Replay ``app``'s spool. Return the number of rows replayed.
+def replay(app):
+    spool = app.extensions['useinfo_spool']
+    with app.app_context():
+        return spool.replay(_insert_rows)
+
+
+def _replay_forever(app, interval):
+    spool = app.extensions['useinfo_spool']
+    while True:
+        sleep(interval)
+        if spool.pending():
+            try:
+                count = replay(app)
+                if count:
+                    logger.warning('Replayed %d spooled Useinfo rows.', count)
+            except OperationalError as e:
+                logger.warning('Unable to replay spooled Useinfo rows yet: %s', e.orig)
+            except Exception:
+                logger.exception('Unable to replay spooled Useinfo rows.')
+
+
+# Enable spooling for ``app`` if ``SPOOL_DIR`` is set.
+def init_app(app):
+    directory = app.config.get('SPOOL_DIR')
+    if not directory:
+        return
+    app.extensions['useinfo_spool'] = Spool(directory, app.config.get('SPOOL_SEGMENT_SIZE', 4*2**20), app.config.get('SPOOL_SYNC', False))
+    # SQLite has neither a checkout timeout nor ``connect_timeout``.
+    if not (app.config.get('SQLALCHEMY_DATABASE_URI') or '').startswith('sqlite'):
+        budget = app.config.get('SPOOL_LATENCY_BUDGET_MS', 250)/1000
+        # Copy the options, rather than changing a dict shared with the config class.
+        engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        engine_options.setdefault('pool_timeout', budget)
+        connect_args = dict(engine_options.get('connect_args') or {})
+        connect_args.setdefault('connect_timeout', max(2, ceil(budget)))
+        engine_options['connect_args'] = connect_args
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    interval = app.config.get('SPOOL_REPLAY_INTERVAL')
+    if interval:
+        # Start the replayer once the worker is serving requests, since threads don't survive gunicorn's fork (see ``Cache.init_app``).
+        app.before_first_request(lambda: Thread(target=_replay_forever, args=(app, interval), daemon=True).start())
@@ -0,0 +1,237 @@
+# ***********************************
+# |docname| - Compact Useinfo storage
+# ***********************************
+# Each Useinfo_ row stores its event, act, div_id_ and course_id_ as strings of up to 512 characters, though a course logs only a few dozen distinct events and a few thousand questions across millions of rows. Setting ``USEINFO_STORAGE`` to ``compact`` makes the `hsblog endpoint` (and the `spool <spool.py>`) write UseinfoCompact_ rows instead, which store:
+#
+# -   a known event (see ``HSBLOG_EVENT_LABELS`` in `metrics.py`) as an integer key into UseinfoEvent, and a div_id which names a question as a key into UseinfoDivId. Each lookup table holds each string once.
+# -   the course only as its courses_id_, since Courses already holds its name.
+#
+# Browsers may send any event, act or div_id, so only these validated values are interned; anything else is stored as a string, as before. This bounds the lookup tables by the number of known events and questions, whatever clients send.
+#
+# Every worker keeps an intern cache, ``useinfo_interns``, mapping strings to keys, so resolving a key normally costs no query. A string seen for the first time is added to its lookup table using the request's own transaction, so it costs no extra connection and stays within the `spool's <spool.py>` latency budget. Its key is added to the cache only once that transaction commits, since a rollback also removes the new lookup row.
+#
+# `useinfo_view`_ combines both tables with the columns of Useinfo_, so code which reads Useinfo -- web2py, and reports -- should read the view instead. To switch an existing database to this layout, run ``python manage.py compact-useinfo``, which creates the new tables and the view, then set ``USEINFO_STORAGE=compact`` and run ``compact-useinfo`` again to move the rows written meanwhile. It prints the storage used by each layout.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from threading import Lock
+from time import perf_counter
+
+# Third-party imports
+# -------------------
+from flask import current_app
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+# Local imports
+# -------------
+from .backfill import print_size_report, table_sizes
+from .course_cache import course_info
+from .extensions import cache
+from .inserts import insert_row
+from .metrics import HSBLOG_EVENT_LABELS, count_cache_lookup
+from .model import db, Useinfo, UseinfoCompact, UseinfoDivId, UseinfoEvent, USEINFO_VIEW_DDL
+from .question_cache import question_cache
+
+
+# Intern cache
+# ============
+class UseinfoInterns:
+    def __init__(self,
+        # The most strings to remember for each lookup table. When full, a table's strings are forgotten, then reloaded as they're used.
+        max_size=100000):
+
+        self.max_size = max_size
+        # ``{model: {value: key}}``.
+        self._keys = {UseinfoEvent: {}, UseinfoDivId: {}}
+        self._lock = Lock()
+        cache.on_invalidate('useinfo_interns', self._discard)
+
+    # Return the key of ``value`` in the lookup table ``model``, adding it if necessary, using ``connection`` or (if it's None) the session.
+    def key(self, model, value, connection=None):
+        key = self._keys[model].get(value)
+        count_cache_lookup('useinfo_interns', key is not None)
+        if key is None:
+            key = self._add(model, value, db.session if connection is None else connection)
+            # A key added using a connection isn't cached, since this doesn't know when its transaction commits.
+            if connection is None:
+                db.session.info.setdefault('useinfo_interns', []).append((model, value, key))
+        return key
+
+    @staticmethod
+    def _add(model, value, connection):
+        table = model.__table__
+        # ``on conflict do nothing`` can't fail, so there's no need for a savepoint. If another transaction is adding the same value, this waits for it to finish.
+        key = connection.execute(insert(table).values(value=value).on_conflict_do_nothing().returning(table.c.id)).scalar()
+        # It's already there.
+        if key is None:
+            key = connection.execute(select([table.c.id]).where(table.c.value == value)).scalar()
+        return key
+
+    # Remember keys added by a transaction which committed.
+    def _publish(self, added):
+        with self._lock:
+            for model, value, key in added:
+                keys = self._keys[model]
+                if len(keys) >= self.max_size:
+                    keys.clear()
+                keys[value] = key
+
+    # Convert ``row``, a dict of Useinfo column values, to a dict of UseinfoCompact column values, adding any lookup rows needed using ``connection`` or (if it's None) the session.
+    def compact_row(self, row, connection=None):
+        row = dict(row)
+        course_name = row.pop('course_id', None)
+        info = None if course_name is None else course_info(course_name)
+        if row.get('courses_id') is None:
+            row['courses_id'] = info and info['id']
+        event = row.pop('event', None)
+        if event in HSBLOG_EVENT_LABELS:
+            row['event_key'] = self.key(UseinfoEvent, event, connection)
+        else:
+            row['event'] = event
+        div_id = row.pop('div_id', None)
+        if div_id is not None and info and question_cache.get(info['base_course'], div_id) is not None:
+            row['div_id_key'] = self.key(UseinfoDivId, div_id, connection)
+        else:
+            row['div_id'] = div_id
+        return row
+
+    # Forget every key, in every worker. Keys never change, so this is only needed if the lookup tables are emptied, as the tests do.
+    def invalidate(self):
+        cache.invalidate('useinfo_interns')
+
+    def _discard(self, _):
+        with self._lock:
+            for keys in self._keys.values():
+                keys.clear()
+
+
+useinfo_interns = UseinfoInterns()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    added = session.info.pop('useinfo_interns', None)
+    if added:
+        useinfo_interns._publish(added)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('useinfo_interns', None)
+
+
+# Writing
+# =======
+def is_compact():
+    return current_app.config.get('USEINFO_STORAGE') == 'compact'
+
+
+# Insert a row of Useinfo, given as keyword arguments, in the session's transaction, in the configured layout.
+def add_useinfo(**row):
+    if is_compact():
+        insert_row(UseinfoCompact, **useinfo_interns.compact_row(row))
+    else:
+        insert_row(Useinfo, **row)
+
+
+# Insert ``rows``, a list of dicts of Useinfo column values, using ``connection``, in the configured layout.
+def insert_useinfo(connection, rows):
+    if is_compact():
+        connection.execute(UseinfoCompact.__table__.insert(), [useinfo_interns.compact_row(row, connection) for row in rows])
+    else:
+        connection.execute(Useinfo.__table__.insert(), rows)
+
+
+# Migration
+# =========
+# Return ``{table_name: (rows, average bytes per row)}`` for each layout, measured by PostgreSQL. A row's size includes its header, but not its share of indexes or the lookup tables.
+def row_sizes():
+    sizes = {}
+    for model in (Useinfo, UseinfoCompact):
+        table_name = model.__tablename__
+        sizes[table_name] = db.session.execute(
+            'select count(*), coalesce(avg(pg_column_size(t.*)), 0)::float8 from {} as t'.format(table_name)
+        ).fetchone()
+    return sizes
+
+
+def print_row_sizes(sizes):
+    print('{:30} {:>13} {:>13}'.format('Table', 'Rows', 'Bytes per row'))
+    for table_name, (rows, row_bytes) in sorted(sizes.items()):
+        print('{:30} {:13} {:13.1f}'.format(table_name, rows, row_bytes))
+
+
+# Create the compact layout's tables and `useinfo_view`_ in an existing database, if they don't exist yet. ``db.create_all()`` creates them in new databases.
+def create_compact_tables():
+    db.metadata.create_all(db.engine, tables=[UseinfoEvent.__table__, UseinfoDivId.__table__, UseinfoCompact.__table__])
+    # Replacing the view would wait for every transaction reading it, so only create it if it's missing.
+    if 'useinfo_view' not in inspect(db.engine).get_view_names():
+        with db.engine.begin() as connection:
+            connection.execute(USEINFO_VIEW_DDL)
+
+
+# Move rows from Useinfo to UseinfoCompact, first creating the tables they need. Like `backfill.py`, this runs against a live database: each batch of ids is moved in one short transaction. Rows written while this runs are left for the next run. PostgreSQL reuses the space freed in ``useinfo`` for new rows after the next vacuum; to return it to the operating system instead, run ``VACUUM FULL useinfo`` when the server is idle. Return the number of rows moved.
+def compact_useinfo(
+    # The number of ids to move per transaction.
+    batch_size=10000,
+    # True to print progress and a size report.
+    verbose=True):
+
+    start = perf_counter()
+    create_compact_tables()
+    table_names = [model.__tablename__ for model in (Useinfo, UseinfoCompact, UseinfoEvent, UseinfoDivId)]
+    before = table_sizes(table_names)
+    db.session.commit()
+
+    moved = 0
+    with db.engine.connect() as connection:
+        min_id, max_id = connection.execute('select min(id), max(id) from useinfo').fetchone()
+        if min_id is not None:
+            for low in range(min_id, max_id + 1, batch_size):
+                with connection.begin():
+                    # Delete the batch first, keeping a copy, so that each row is moved exactly once even if others are written meanwhile.
+                    connection.execute(db.text(
+                        'create temporary table moving on commit drop as '
+                        'with deleted as (delete from useinfo where id >= :low and id < :high returning *) '
+                        'select * from deleted'
+                    ), low=low, high=low + batch_size)
+                    # Intern the same values the `hsblog endpoint` does.
+                    connection.execute(db.text(
+                        'insert into useinfo_event (value) select distinct event from moving where event = any(:events) '
+                        'on conflict (value) do nothing'
+                    ), events=sorted(HSBLOG_EVENT_LABELS))
+                    connection.execute(
+                        'insert into useinfo_div_id (value) select distinct m.div_id from moving as m '
+                        'where exists (select 1 from questions as q where q.name = m.div_id) '
+                        'on conflict (value) do nothing'
+                    )
+                    moved += connection.execute(
+                        'insert into useinfo_compact (id, timestamp, sid, event_key, event, act, div_id_key, div_id, courses_id) '
+                        'select m.id, m.timestamp, m.sid, e.id, case when e.id is null then m.event end, m.act, '
+                        'd.id, case when d.id is null then m.div_id end, coalesce(m.courses_id, c.id) from moving as m '
+                        'left join useinfo_event as e on e.value = m.event '
+                        'left join useinfo_div_id as d on d.value = m.div_id '
+                        'left join courses as c on c.course_name = m.course_id'
+                    ).rowcount
+
+    after = table_sizes(table_names)
+    db.session.commit()
+    if verbose:
+        print('Moved {} rows in {:.1f} s.'.format(moved, perf_counter() - start))
+        print_size_report(before, after)
+        print_row_sizes(row_sizes())
+    return moved
+
+
+def init_app(app):
+    storage = app.config.get('USEINFO_STORAGE', 'table')
+    if storage not in ('table', 'compact'):
+        raise ValueError('Unknown USEINFO_STORAGE {}.'.format(storage))
+    useinfo_interns.max_size = app.config.get('USEINFO_INTERN_CACHE_SIZE', 100000)
@@ -17,6 +17,8 @@ import json
 # -------------------
 import pytest
 from flask import url_for
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 # Local imports
 # -------------
@@ -94,6 +96,32 @@ def result_remove_usual(model):
     return result_remove(model.query.order_by(model.timestamp), 'id', 'timestamp')
 
 
+# Count the SQL statements executed inside a ``with`` block, ignoring the savepoints which isolate each test (see ``rollback_transaction`` in `conftest.py`). For example:
+#
+# .. code-block:: python
+#
+#   with QueryCounter() as qc:
+#       ...
+#   assert qc.count == 2
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            return
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(Engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
 # Apply these fixes to every test `automatically <https://docs.pytest.org/en/latest/fixture.html#using-fixtures-from-classes-modules-or-projects>`_.
 @pytest.mark.usefixtures("BaseTest_setup_common")
 # Group everything in a class, so it's easy to share the ``test_client``.
@@ -10,27 +10,43 @@
 #
 # Standard library
 # ----------------
-# None
+from contextlib import contextmanager, nullcontext
+import os
 
 # Third-party imports
 # -------------------
 import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 
 # Local imports
 # -------------
-from runestone import db
-from runestone.model import AuthUser, Courses, Questions
+from ephemeral_postgres import EphemeralPostgres, create_database, database_names, drop_database, replace_url
+from runestone import create_app, db, cache
+from runestone.question_cache import question_cache
+from runestone.useinfo_storage import useinfo_interns
+from runestone.model import AuthUser, Courses, CourseInstructor, Questions
 
 
 # Data
 # ----
+# Hashing a password is deliberately slow, so hash each test password only once per session.
+_hashed_passwords = {}
+
+
+def hash_password(app, password):
+    if password not in _hashed_passwords:
+        _hashed_passwords[password] = app.user_manager.hash_password(password)
+    return _hashed_passwords[password]
+
+
 # Create a user if they don't exist, or return the existing user.
 def make_user(app, username, password):
     u = AuthUser[username].q
     if not u.count():
         user = AuthUser(
             username=username,
-            password=app.user_manager.hash_password(password),
+            password=hash_password(app, password),
             active=True,
         )
         db.session.add(user)
@@ -43,7 +59,7 @@ def make_user(app, username, password):
 # Creates some fake data which the tests use.
 def create_test_data(app):
     # A test user.
-    make_user(app, 'brad@test.user', 'grouplens')
+    test_user = make_user(app, 'brad@test.user', 'grouplens')
 
     # Test courses.
     test_base_course = Courses(
@@ -75,45 +91,173 @@ def create_test_data(app):
 
     db.session.commit()
 
+    # The test user is an instructor for the first child course.
+    db.session.add(CourseInstructor(
+        course=test_child_course1.id,
+        instructor=test_user.id,
+    ))
+    db.session.commit()
+
+
+# Create a larger data set, for load tests and benchmarks. This makes a base course named ``<prefix>_base`` with ``questions`` questions, ``courses`` courses derived from it, and ``users`` students who all share ``password``. Every other derived course requires a login. Rows are inserted in bulk, and the password is hashed only once, so that large data sets load quickly. Returns a dict of the names created.
+def create_scale_data(app, courses=10, questions=100, users=100, password='grouplens', prefix='scale'):
+    base_course = prefix + '_base'
+    db.session.add(Courses(course_name=base_course, python3=True, login_required=False))
+    db.session.flush()
+
+    course_names = ['{}_course{}'.format(prefix, i) for i in range(courses)]
+    db.session.bulk_insert_mappings(Courses, [dict(
+        course_name=course_name,
+        base_course=base_course,
+        python3=True,
+        login_required=bool(i % 2),
+    ) for i, course_name in enumerate(course_names)])
+
+    question_names = ['{}_q{}'.format(prefix, i) for i in range(questions)]
+    db.session.bulk_insert_mappings(Questions, [dict(
+        base_course=base_course,
+        name=name,
+        chapter=str(i // 10),
+        subchapter=str(i % 10),
+    ) for i, name in enumerate(question_names)])
+
+    usernames = ['{}_student{}@test.user'.format(prefix, i) for i in range(users)]
+    hashed_password = hash_password(app, password)
+    db.session.bulk_insert_mappings(AuthUser, [dict(
+        username=username,
+        password=hashed_password,
+        active=True,
+    ) for username in usernames])
+
+    db.session.commit()
+    return dict(
+        base_course=base_course,
+        public_courses=course_names[::2],
+        login_courses=course_names[1::2],
+        questions=question_names,
+        users=usernames,
+        password=password,
+    )
+
+
+# The database server
+# ===================
+# Unless the ``TEST_DBURL`` environment variable names a database, run the tests on a throwaway `PostgreSQL server <ephemeral_postgres.py>`. Either way, build a template database holding the schema and the test data, from which the test database (and, under pytest-xdist, each worker's database; see ``TestingConfig``) is cloned. Under pytest-xdist, only the controlling process does this; the workers inherit its ``TEST_DBURL``.
+#
+# So, given ``TEST_DBURL=.../runestone_test``, the tests drop and create the databases ``runestone_test``, ``runestone_test_template`` and ``runestone_test_gw<n>`` on that server; its role needs the ``CREATEDB`` privilege.
+_ephemeral_postgres = None
+
+
+# Return the name of the template database for the database at ``url``.
+def template_name(url):
+    return make_url(url).database + '_template'
+
+
+def create_template(url):
+    template_url = replace_url(url, database=template_name(url))
+    # Rebuild it every session, since the schema may have changed.
+    drop_database(template_url)
+    create_database(template_url)
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = template_url
+    with app.app_context():
+        db.create_all()
+        create_test_data(app)
+        db.session.remove()
+        # PostgreSQL can't copy a template while it has connections.
+        db.engine.dispose()
+
+    # Drop databases cloned from the previous template, so that each is cloned again from this one.
+    database = make_url(url).database
+    for clone in [database] + database_names(url, database.replace('_', r'\_') + r'\_gw%'):
+        drop_database(replace_url(url, database=clone))
+
+
+def pytest_configure(config):
+    global _ephemeral_postgres
+    config.addinivalue_line('markers', "commits: the test commits data for other connections to see, so rolling back a transaction can't isolate it. These tests are slower.")
+
+    if os.environ.get('PYTEST_XDIST_WORKER'):
+        return
+    if not os.environ.get('TEST_DBURL'):
+        _ephemeral_postgres = EphemeralPostgres().start()
+        os.environ['TEST_DBURL'] = _ephemeral_postgres.url('runestone_test')
+    create_template(os.environ['TEST_DBURL'])
+
+
+def pytest_unconfigure(config):
+    global _ephemeral_postgres
+    if _ephemeral_postgres:
+        _ephemeral_postgres.stop()
+        _ephemeral_postgres = None
+        del os.environ['TEST_DBURL']
+
 
 # Fixtures
 # ========
-# Set up the database for the test session. Do this just once for all tests, rather than every test (module scope). This significantly reduces test time.
+
+
+# Set up the database for each test module: a clone of the template, which already holds the tables and the test data. Tests change this data only inside a transaction which is rolled back (see ``test_client``), so setting it up once per module is enough. A later module reuses the database cloned for an earlier one, so reset its data instead.
 @pytest.fixture(scope='module')
 def test_db(request):
     app = request.module.app
-    with app.app_context():
-        # Start with a (fairly clean) set of tables.
-        db.drop_all()
-        db.create_all()
+    # Under pytest-xdist, this is the worker's database.
+    if not create_database(app.config['SQLALCHEMY_DATABASE_URI'], template_name(os.environ['TEST_DBURL'])):
+        with app.app_context():
+            reset_test_data(app)
 
 
-# Define `per-function setup # Define `per-function setup and teardown <http://doc.pytest.org/en/latest/fixture.html#fixture-finalization-executing-teardown-code>`_ which places test data in an empty database, then removes all data from the database when the test finishes.
-#
-# Note: http://docs.sqlalchemy.org/en/latest/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites describes another approach, which seems more complex, so I'm not using it.
-@pytest.fixture()
-def test_client(request, test_db):
-    # Setup
-    app = request.module.app
+# Run the body inside a transaction which is rolled back afterwards, discarding its changes. The session works in a savepoint, which is restarted whenever the code commits or rolls back. See `joining a session into an external transaction <https://docs.sqlalchemy.org/en/13/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites>`_. This must run inside an application context.
+@contextmanager
+def rollback_transaction():
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    saved_session = db.session
+    db.session = db.create_scoped_session(options=dict(bind=connection, binds={}))
 
-    # Establish an application context before running the tests.
-    ctx = app.app_context()
-    ctx.push()
+    @event.listens_for(db.session, 'after_transaction_end')
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
 
-    # Set up the database. In case something went wrong last test, drop everything first.
+    db.session.begin_nested()
+    try:
+        yield
+    finally:
+        db.session.remove()
+        db.session = saved_session
+        transaction.rollback()
+        connection.close()
+
+
+# Remove all data, then recreate the test data. This must run inside an application context.
+def reset_test_data(app):
+    # Without a commit or rollback, PostgreSQL will `hang <https://stackoverflow.com/questions/13882407/sqlalchemy-blocked-on-dropping-tables>`_. Using a rollback cleans up if a transaction was rejected by the backend database.
+    db.session.rollback()
+    # Adapted from http://stackoverflow.com/a/5003705. This removes all data, but keeps the schema.
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+    db.session.commit()
     create_test_data(app)
 
-    def teardown():
-        # Without a commit or rollback, PostgreSQL will `hang <https://stackoverflow.com/questions/13882407/sqlalchemy-blocked-on-dropping-tables>`_. Using a rollback cleans up if a transaction was rejected by the backend database.
-        db.session.rollback()
 
-        # Teardown. Adapted from http://stackoverflow.com/a/5003705. A simple db.drop_all() works, but doubles test time. This should remove all data, but keep the schema.
-        for table in reversed(db.metadata.sorted_tables):
-            db.session.execute(table.delete())
-        db.session.commit()
+# Define `per-function setup and teardown <http://doc.pytest.org/en/latest/fixture.html#fixture-finalization-executing-teardown-code>`_ which provides the test data, then discards any changes when the test finishes. Tests marked ``commits`` really commit their changes, so all data is deleted and recreated after them instead.
+@pytest.fixture()
+def test_client(request, test_db):
+    app = request.module.app
+    commits = request.node.get_closest_marker('commits')
 
-        ctx.pop()
-    request.addfinalizer(teardown)
+    # Establish an application context before running the tests.
+    with app.app_context():
+        with (nullcontext() if commits else rollback_transaction()):
+            # A `test client <http://flask.pocoo.org/docs/0.11/api/#flask.Flask.test_client>`_ to request pages from.
+            yield app.test_client()
+            db.session.rollback()
 
-    # A `test client <http://flask.pocoo.org/docs/0.11/api/#flask.Flask.test_client>`_ to request pages from.
-    return app.test_client()
+        if commits:
+            reset_test_data(app)
+        # Forget anything cached from this test's data.
+        question_cache.invalidate()
+        useinfo_interns.invalidate()
+        cache.clear()
@@ -0,0 +1,165 @@
+# ***************************************************
+# |docname| - A throwaway PostgreSQL server for tests
+# ***************************************************
+# This starts a private PostgreSQL server in a temporary directory, using the locally installed ``initdb`` and ``pg_ctl``, so that the tests and load tests need no database setup. The server trades durability for speed (no ``fsync``), and everything is deleted when it stops.
+#
+# The PostgreSQL programs are found in the directory named by the ``PG_BIN`` environment variable, else on the ``PATH``, else in the usual Debian and Red Hat install locations.
+#
+# .. code-block:: python
+#
+#   server = EphemeralPostgres().start()
+#   create_database(server.url('runestone_test'))
+#   ...
+#   server.stop()
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from copy import copy
+from glob import glob
+from pathlib import Path
+import os
+import pwd
+import shutil
+import socket
+import subprocess
+import tempfile
+
+# Third-party imports
+# -------------------
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+# Local imports
+# -------------
+# None.
+
+
+# Return the directory holding ``initdb`` and ``pg_ctl``.
+def find_pg_bin():
+    candidates = [os.environ.get('PG_BIN')]
+    initdb = shutil.which('initdb')
+    if initdb:
+        candidates.append(os.path.dirname(initdb))
+    # Newest versions first.
+    candidates += sorted(glob('/usr/lib/postgresql/*/bin'), reverse=True)
+    candidates += sorted(glob('/usr/pgsql-*/bin'), reverse=True)
+    for candidate in candidates:
+        if candidate and (Path(candidate) / 'initdb').exists() and (Path(candidate) / 'pg_ctl').exists():
+            return candidate
+    raise RuntimeError('Unable to find initdb and pg_ctl. Install PostgreSQL, or set PG_BIN to the directory containing them.')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class EphemeralPostgres:
+    def __init__(self,
+        # The directory containing the PostgreSQL programs; None to search for it.
+        bin_dir=None,
+        # The TCP port to listen on; None picks a free one.
+        port=None):
+
+        self.bin_dir = Path(bin_dir or find_pg_bin())
+        self.port = port or _free_port()
+        self.base_dir = None
+        # PostgreSQL refuses to run as root, so run it as ``nobody`` instead.
+        self._user = pwd.getpwnam('nobody') if os.geteuid() == 0 else None
+
+    def _run(self, *args):
+        def demote():
+            os.setgid(self._user.pw_gid)
+            os.setuid(self._user.pw_uid)
+        subprocess.run(
+            [str(self.bin_dir / args[0])] + list(args[1:]), check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            preexec_fn=demote if self._user else None,
+        )
+
+    def start(self):
+        self.base_dir = Path(tempfile.mkdtemp(prefix='runestone_pg_'))
+        if self._user:
+            os.chown(str(self.base_dir), self._user.pw_uid, self._user.pw_gid)
+        data_dir = str(self.base_dir / 'data')
+        try:
+            self._run('initdb', '--pgdata', data_dir, '--username', 'postgres', '--auth', 'trust', '--encoding', 'UTF8', '--no-sync')
+            options = ' '.join((
+                '-p {}'.format(self.port),
+                "-c listen_addresses=localhost",
+                # Put the Unix socket here, rather than in a system directory which may not be writable.
+                '-k {}'.format(self.base_dir),
+                # Durability doesn't matter for test data.
+                '-c fsync=off -c synchronous_commit=off -c full_page_writes=off',
+            ))
+            self._run('pg_ctl', 'start', '--pgdata', data_dir, '--wait', '--log', str(self.base_dir / 'postgres.log'), '-o', options)
+        except subprocess.CalledProcessError as e:
+            self._remove()
+            raise RuntimeError('Unable to start PostgreSQL: {}'.format(e.stderr.decode('utf-8', 'replace'))) from e
+        return self
+
+    def stop(self):
+        if self.base_dir:
+            try:
+                self._run('pg_ctl', 'stop', '--pgdata', str(self.base_dir / 'data'), '--mode', 'immediate', '--wait')
+            finally:
+                self._remove()
+
+    def _remove(self):
+        shutil.rmtree(str(self.base_dir), ignore_errors=True)
+        self.base_dir = None
+
+    # Return the URL for ``database`` on this server.
+    def url(self, database):
+        return 'postgresql://postgres@localhost:{}/{}'.format(self.port, database)
+
+
+# Database management
+# ===================
+# Return ``url`` (a string or URL) with the given parts, such as ``database`` or ``port``, replaced, as a string which includes the password. SQLAlchemy 1.3 changes a URL in place; 1.4 and later make URLs immutable, adding ``set``, and hide the password in ``str()``.
+def replace_url(url, **changes):
+    url = make_url(url)
+    if hasattr(url, 'set'):
+        return url.set(**changes).render_as_string(hide_password=False)
+    url = copy(url)
+    for name, value in changes.items():
+        setattr(url, name, value)
+    return str(url)
+
+
+# These work with any PostgreSQL server, given a role which may create databases. Run ``func(connection)`` on an autocommit connection to the maintenance database of the server at ``url``.
+def _maintenance(url, func):
+    engine = create_engine(replace_url(url, database='postgres'))
+    try:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            return func(connection)
+    finally:
+        engine.dispose()
+
+
+# Create the database at ``url`` if it doesn't exist, optionally as a copy of the database named ``template``. PostgreSQL copies a template file by file, which is much faster than creating its tables again. Return True if this created the database, or False if it already existed.
+def create_database(url, template=None):
+    database = make_url(url).database
+
+    def create(connection):
+        if connection.scalar('select 1 from pg_database where datname = %s', database):
+            return False
+        connection.execute('create database "{}"{}'.format(database, ' template "{}"'.format(template) if template else ''))
+        return True
+    return _maintenance(url, create)
+
+
+# Return the names of the databases on the server at ``url`` which match the SQL ``LIKE`` pattern ``like``.
+def database_names(url, like):
+    return [row[0] for row in _maintenance(url, lambda connection: connection.execute('select datname from pg_database where datname like %s', like).fetchall())]
+
+
+# Drop the database at ``url`` if it exists.
+def drop_database(url):
+    _maintenance(url, lambda connection: connection.execute('drop database if exists "{}"'.format(make_url(url).database)))
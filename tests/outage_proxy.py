@@ -0,0 +1,99 @@
+# ********************************************************
+# |docname| - A TCP proxy which simulates database outages
+# ********************************************************
+# Connect the server to the database through this proxy, then call ``down()`` to simulate an outage: existing connections are cut and new ones are refused, just as when the database server stops. ``up()`` restores service.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from threading import Lock, Thread
+import socket
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+# None.
+
+
+class OutageProxyHandler(BaseRequestHandler):
+    def handle(self):
+        if self.server.is_down:
+            return
+        try:
+            upstream = socket.create_connection(self.server.target)
+        except OSError:
+            return
+        self.server.track(self.request, upstream)
+        Thread(target=self.pump, args=(upstream, self.request), daemon=True).start()
+        self.pump(self.request, upstream)
+
+    # Copy data from ``source`` to ``destination`` until either closes.
+    def pump(self, source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for s in (source, destination):
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class OutageProxy(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,
+        # The ``(host, port)`` to forward connections to.
+        target):
+
+        super().__init__(('localhost', 0), OutageProxyHandler)
+        self.target = target
+        self.is_down = False
+        self._sockets = []
+        self._lock = Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def track(self, *sockets):
+        with self._lock:
+            self._sockets.extend(sockets)
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.down()
+        self.shutdown()
+        self.server_close()
+
+    # Cut every connection, and refuse new ones.
+    def down(self):
+        self.is_down = True
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+        for s in sockets:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def up(self):
+        self.is_down = False
@@ -0,0 +1,176 @@
+# ****************************************************
+# |docname| - A stand-in Redis server for unit testing
+# ****************************************************
+# This implements just enough of the `Redis protocol <https://redis.io/topics/protocol>`_ to test this server's Redis-protocol clients without installing Redis. Everything lives in memory, in one process.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from fnmatch import fnmatchcase
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Lock, Thread
+from time import monotonic
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+# None.
+
+
+# Protocol encoding
+# =================
+def encode_reply(value):
+    if value is None:
+        return b'$-1\r\n'
+    elif isinstance(value, int):
+        return b':%d\r\n' % value
+    elif isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    elif isinstance(value, str):
+        return b'+%s\r\n' % value.encode('utf-8')
+    elif isinstance(value, Exception):
+        return b'-ERR %s\r\n' % str(value).encode('utf-8')
+    else:
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+
+
+# The server
+# ==========
+class RedisStandinHandler(StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[:1] == b'*'
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+
+    def handle(self):
+        self.write_lock = Lock()
+        while True:
+            args = self.read_command()
+            if args is None:
+                break
+            command = args[0].decode('utf-8').upper()
+            try:
+                reply = getattr(self.server, 'do_' + command)(self, *args[1:])
+            except Exception as e:
+                reply = e
+            if command != 'SUBSCRIBE':
+                self.write(encode_reply(reply))
+
+    def finish(self):
+        self.server.unsubscribe(self)
+        super().finish()
+
+
+class RedisStandin(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=0):
+        super().__init__((host, port), RedisStandinHandler)
+        # ``{key: (value, expires)}``, where ``expires`` is a ``monotonic()`` time or None.
+        self.data = {}
+        # ``{channel: [handler, ...]}``.
+        self.subscribers = {}
+        self.lock = Lock()
+
+    @property
+    def url(self):
+        return 'redis://{}:{}/0'.format(*self.server_address)
+
+    # Start serving in a background thread; call ``shutdown`` to stop.
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= monotonic():
+            del self.data[key]
+            item = None
+        return item
+
+    # Commands
+    # --------
+    def do_PING(self, handler):
+        return 'PONG'
+
+    def do_SELECT(self, handler, db):
+        return 'OK'
+
+    def do_GET(self, handler, key):
+        with self.lock:
+            item = self._get(key)
+            return None if item is None else item[0]
+
+    def do_SET(self, handler, key, value, *options):
+        expires = None
+        if options:
+            assert options[0].upper() == b'PX'
+            expires = monotonic() + int(options[1])/1000
+        with self.lock:
+            self.data[key] = (value, expires)
+        return 'OK'
+
+    def do_DEL(self, handler, *keys):
+        with self.lock:
+            return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def do_INCRBY(self, handler, key, amount):
+        with self.lock:
+            item = self._get(key)
+            value, expires = (0, None) if item is None else (int(item[0]), item[1])
+            value += int(amount)
+            self.data[key] = (str(value).encode('utf-8'), expires)
+            return value
+
+    def do_PEXPIRE(self, handler, key, milliseconds):
+        with self.lock:
+            item = self._get(key)
+            if item is None:
+                return 0
+            self.data[key] = (item[0], monotonic() + int(milliseconds)/1000)
+            return 1
+
+    # Return every match at once, with a cursor of 0.
+    def do_SCAN(self, handler, cursor, *options):
+        options = dict(zip(options[::2], options[1::2]))
+        pattern = options.get(b'MATCH', b'*').decode('utf-8')
+        with self.lock:
+            return [b'0', [key for key in list(self.data) if self._get(key) and fnmatchcase(key.decode('utf-8'), pattern)]]
+
+    def do_PUBLISH(self, handler, channel, message):
+        handlers = list(self.subscribers.get(channel, []))
+        for subscriber in handlers:
+            subscriber.write(encode_reply([b'message', channel, message]))
+        return len(handlers)
+
+    def do_SUBSCRIBE(self, handler, *channels):
+        for index, channel in enumerate(channels):
+            self.subscribers.setdefault(channel, []).append(handler)
+            handler.write(encode_reply([b'subscribe', channel, index + 1]))
+
+    def unsubscribe(self, handler):
+        for handlers in self.subscribers.values():
+            if handler in handlers:
+                handlers.remove(handler)
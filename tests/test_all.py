@@ -13,18 +13,56 @@
 from unittest.mock import patch
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Event, Thread
+from time import monotonic, perf_counter, sleep
+import json
+import os
+import pstats
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
 
 # Third-party imports
 # -------------------
+from flask import Flask, Response, render_template, url_for
+from itsdangerous import Signer
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+import numpy as np
 import pytest
 
 # Local imports
 # -------------
+from config import config
 # The ``app`` import is required for the fixtures to work.
 from base_test import BaseTest, app, LoginContext, url_joiner, result_remove_usual
 from runestone.book_server.server import book_server
+from runestone.book_server.snapshot import snapshot_course
+from runestone.book_server.template_cache import AtomicFileSystemBytecodeCache, compile_templates
+from runestone.course_cache import invalidate_course
 from runestone.api.endpoints import api, generic_validator, sql_validator, RequestValidationFailure
-from runestone.model import db, Courses, Useinfo, TimedExam, IdMixin, Web2PyBoolean, MchoiceAnswers, FitbAnswers, DragndropAnswers, ClickableareaAnswers, ParsonsAnswers, CodelensAnswers, ShortanswerAnswers, LpAnswers
+from runestone.analytics import course_report, load_columns, web2py_boolean_array
+from runestone.archive import archive, read_archive
+from runestone.backfill import backfill_course_ids, course_name_sizes
+from runestone.exam_stats import exam_stats, rebuild_timed_exam_stats
+from runestone.inserts import insert_row
+from runestone.progress import rebuild_question_progress
+from runestone import cache, create_app, profiling, routing, sessions, spool
+from runestone.question_cache import question_cache
+from runestone.load_questions import load_questions
+from redis_standin import RedisStandin
+from outage_proxy import OutageProxy
+from ephemeral_postgres import replace_url
+from runestone.spool import Spool, read_segment
+from runestone.useinfo_storage import compact_useinfo, row_sizes, useinfo_interns
+from runestone.rate_limit import MemoryRateLimiter, CacheRateLimiter
+from runestone.metrics import TimedQueuePool
+from runestone.sessions import LRUSessionStore, RedisSessionStore, ServerSideSessionInterface, decode_session, encode_session
+from runestone.extensions import Cache, MemoryCacheBackend, RedisCacheBackend
+from runestone.model import db, Courses, Questions, Useinfo, UseinfoCompact, UseinfoDivId, UseinfoEvent, useinfo_view, TimedExam, TimedExamStats, QuestionProgress, IdMixin, Web2PyBoolean, MchoiceAnswers, FitbAnswers, DragndropAnswers, ClickableareaAnswers, ParsonsAnswers, CodelensAnswers, ShortanswerAnswers, LpAnswers
 
 
 # Utilities
@@ -76,7 +114,7 @@ class TestRunestoneServer(BaseTest):
     # Check that static assets are passed through.
     def test_4(self):
         with self.login_context:
-            with patch('runestone.book_server.server.send_from_directory', return_value='') as mock_send_from_directory:
+            with patch('runestone.book_server.server.send_from_directory', return_value=Response('')) as mock_send_from_directory:
                 self.get_valid(sp('test_child_course1/_static/foo.css'))
                 # Check only the second arg. Note that ``call_args`` `returns <https://docs.python.org/3/library/unittest.mock.html#calls-as-tuples>`_ ``(args, kwargs)``.
                 assert mock_send_from_directory.call_args[0][1] == 'test_base_course/_static/foo.css'
@@ -84,6 +122,222 @@ class TestRunestoneServer(BaseTest):
                 self.get_valid(sp('test_child_course1/_images/foo.png'))
                 assert mock_send_from_directory.call_args[0][1] == 'test_base_course/_images/foo.png'
 
+    # Check the per-request SQL instrumentation. The savepoints used to isolate tests would add to the counts, so commit instead.
+    @pytest.mark.commits
+    def test_5(self, caplog):
+        url = hsblog(act='', event='xxx', **TestRunestoneApi.common_params)
+        # The first request loads the course and its questions, then inserts into Useinfo.
+        rv = self.get_valid(url)
+        timings = rv.headers.getlist('Server-Timing')
+        assert timings[0].startswith('db;dur=') and timings[0].endswith(';desc="3 queries"')
+        assert timings[1].startswith('db-slowest;dur=')
+        assert timings[2].startswith('total;dur=')
+        # Later requests use the cache.
+        assert self.get_valid(url).headers['Server-Timing'].endswith(';desc="1 queries"')
+
+        # Check slow request logging.
+        app.config['SLOW_REQUEST_QUERIES'] = 0
+        try:
+            self.get_valid(url)
+        finally:
+            app.config['SLOW_REQUEST_QUERIES'] = 20
+        assert 'Slow request GET /api/hsblog?' in caplog.text
+        assert '1 queries' in caplog.text
+        assert 'INSERT INTO useinfo' in caplog.text
+
+        # The header can be disabled.
+        app.config['SERVER_TIMING_HEADER'] = False
+        try:
+            assert 'Server-Timing' not in self.get_valid(url).headers
+        finally:
+            app.config['SERVER_TIMING_HEADER'] = True
+
+    # Check the Prometheus metrics. A test isolated by a transaction holds one connection throughout, so commit instead in order to check pool checkouts.
+    @pytest.mark.commits
+    def test_6(self, tmpdir, monkeypatch):
+        def metric_value(text, line_start):
+            for line in text.splitlines():
+                if line.startswith(line_start + ' '):
+                    return float(line.split()[-1])
+            return 0
+
+        def get_metrics():
+            rv = self.get_valid('/metrics')
+            assert rv.content_type.startswith('text/plain')
+            return rv.get_data(as_text=True)
+
+        checks = [
+            'runestone_request_duration_seconds_count{blueprint="api"}',
+            'runestone_requests_total{blueprint="api",status="200"}',
+            'runestone_hsblog_events_total{event="mChoice"}',
+            'runestone_hsblog_events_total{event="other"}',
+            'runestone_cache_requests_total{cache="questions",result="hit"}',
+            'runestone_static_bytes_total',
+            'runestone_db_pool_wait_seconds_count',
+        ]
+        before = get_metrics()
+        url = hsblog(act='', event='mChoice', **TestRunestoneApi.common_params)
+        self.get_valid(url)
+        self.get_valid(url.replace('mChoice', 'not_an_event'))
+        with self.login_context:
+            with patch('runestone.book_server.server.send_from_directory', return_value=Response('12345')):
+                self.get_valid(sp('test_child_course1/_static/foo.css'))
+        after = get_metrics()
+        for check in checks:
+            assert metric_value(after, check) > metric_value(before, check), check
+        assert metric_value(after, 'runestone_static_bytes_total') - metric_value(before, 'runestone_static_bytes_total') == 5
+
+        # In multiprocess mode, report the values every worker stored in the shared directory.
+        monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmpdir))
+        code = 'from runestone.metrics import count_hsblog_event\nfor _ in range(3): count_hsblog_event("parsons")'
+        for _ in range(2):
+            subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+        assert metric_value(get_metrics(), 'runestone_hsblog_events_total{event="parsons"}') == 6
+
+    # Only allowed networks may read the metrics, and not through a proxy.
+    def test_6a(self):
+        remote = dict(environ_base=dict(REMOTE_ADDR='10.1.2.3'))
+        self.get_check('/metrics', 403, **remote)
+        self.get_check('/metrics', 403, headers={'X-Forwarded-For': '127.0.0.1'})
+        allowed = app.config['METRICS_ALLOWED_NETWORKS']
+        app.config['METRICS_ALLOWED_NETWORKS'] = ['10.0.0.0/8']
+        try:
+            self.get_check('/metrics', 200, **remote)
+            self.get_check('/metrics', 403)
+        finally:
+            app.config['METRICS_ALLOWED_NETWORKS'] = allowed
+
+    # Check the sampling profiler.
+    def test_7(self, tmpdir):
+        url = '/admin/profile?seconds=0.3&interval=1'
+        # Only admins may profile.
+        self.get_check(url, 302)
+        with self.login_context:
+            self.get_check(url, 403)
+            app.config['ADMIN_USERNAMES'] = [self.username]
+            try:
+                # Profile a busy thread.
+                stop = Event()
+                def busy_wait_for_profiler():
+                    while not stop.is_set():
+                        pass
+                thread = Thread(target=busy_wait_for_profiler)
+                thread.start()
+                try:
+                    rv = self.get_valid(url)
+                finally:
+                    stop.set()
+                    thread.join()
+            finally:
+                app.config['ADMIN_USERNAMES'] = []
+        assert rv.headers['Content-Disposition'].startswith('attachment; filename=profile-')
+        lines = rv.get_data(as_text=True).splitlines()
+        busy = [line for line in lines if 'busy_wait_for_profiler (' in line]
+        assert busy
+        # Each line is a semicolon-separated stack, outermost first, then a count.
+        stack, count = busy[0].rsplit(' ', 1)
+        assert int(count) > 0
+        assert stack.split(';')[-1].startswith('busy_wait_for_profiler (')
+
+        # The signal writes a profile to a file.
+        signal_profile = tmpdir.join('signal')
+        signal_profile.mkdir()
+        profiling.profile_to_file(str(signal_profile), 0.05)
+        assert len(signal_profile.listdir()) == 1
+
+        # Check per-request cProfile captures.
+        app.config['PROFILER_OUTPUT_DIR'] = str(tmpdir)
+        try:
+            assert 'X-Profile' not in self.get_valid(hsblog(act='', event='xxx', **TestRunestoneApi.common_params)).headers
+            rv = self.test_client.get(hsblog(act='', event='xxx', **TestRunestoneApi.common_params), headers={'X-Profile': '1'})
+        finally:
+            app.config['PROFILER_OUTPUT_DIR'] = None
+        stats_file = rv.headers['X-Profile']
+        assert os.path.basename(stats_file).startswith('api.log_book_event-')
+        assert 'log_book_event' in str(pstats.Stats(stats_file).stats)
+
+    # Provide a book for ``test_base_course``, removing it afterwards.
+    @pytest.fixture()
+    def book_dir(self):
+        book_dir = Path(book_server.root_path) / book_server.template_folder / 'test_base_course'
+        assert not book_dir.exists()
+        book_dir.mkdir()
+        yield book_dir
+        shutil.rmtree(str(book_dir), ignore_errors=True)
+
+    # Check snapshots of book pages.
+    def test_8(self, tmpdir, monkeypatch, book_dir):
+        (book_dir / 'chapter' / '_static').mkdir(parents=True)
+        (book_dir / '_static').mkdir()
+        (book_dir / 'index.html').write_text('{{ basecourse }} {{ python3 }} {{ login_required }}')
+        (book_dir / 'chapter' / 'page.html').write_text('{{ basecourse }} page')
+        (book_dir / 'chapter' / '_static' / 'nested.html').write_text('nested')
+        (book_dir / '_static' / 'skip.html').write_text('skip')
+        (book_dir / 'searchindex.js').write_text('skip')
+
+        # Only courses which don't require a login may be snapshotted.
+        with pytest.raises(ValueError):
+            snapshot_course('test_child_course1', str(tmpdir), 'testing', 2)
+        assert snapshot_course('test_child_course2', str(tmpdir), 'testing', 2)['pages'] == 3
+        # Taking a snapshot again replaces the old one.
+        assert snapshot_course('test_child_course2', str(tmpdir), 'testing', 2)['pages'] == 3
+        course_dir = tmpdir.join('test_child_course2')
+        assert course_dir.listdir() == [course_dir.join('test_base_course-python3_false')]
+        snapshot_dir = course_dir.join('test_base_course-python3_false')
+        assert snapshot_dir.join('index.html').read() == 'test_base_course false false'
+        assert snapshot_dir.join('chapter', 'page.html').read() == 'test_base_course page'
+        assert snapshot_dir.join('chapter', '_static', 'nested.html').read() == 'nested'
+
+        # Serve the snapshot without rendering.
+        monkeypatch.setitem(app.config, 'SNAPSHOT_DIR', str(tmpdir))
+        monkeypatch.setitem(app.config, 'SERVE_SNAPSHOTS', True)
+        snapshot_dir.join('index.html').write('from the snapshot')
+        with patch('runestone.book_server.server.render_template', return_value='') as mock_render:
+            assert self.get_valid(sp('test_child_course2/index.html')).data == b'from the snapshot'
+            mock_render.assert_not_called()
+            # Pages not in the snapshot are rendered.
+            self.get_valid(sp('test_child_course2/other.html'))
+            mock_render.assert_called_once_with('test_base_course/other.html', basecourse='test_base_course', login_required='false', python3='false')
+
+            # A change to the course's settings makes the snapshot stale.
+            Courses['test_child_course2'].q.one().python3 = True
+            db.session.commit()
+            invalidate_course('test_child_course2')
+            mock_render.reset_mock()
+            self.get_valid(sp('test_child_course2/index.html'))
+            mock_render.assert_called_once_with('test_base_course/index.html', basecourse='test_base_course', login_required='false', python3='true')
+
+    # Check precompiling book templates.
+    def test_9(self, tmpdir, monkeypatch, book_dir):
+        (book_dir / '_static').mkdir()
+        (book_dir / 'index.html').write_text('{{ basecourse }}')
+        (book_dir / 'bad.html').write_text('{% if %}')
+        (book_dir / '_static' / 'skip.js').write_text('{% if %}')
+
+        cache_dir = str(tmpdir)
+        result = compile_templates(cache_dir, 'testing', 2)
+        assert (result['templates'], len(result['errors'])) == (1, 1)
+        assert result['errors'][0].startswith('test_base_course/bad.html: ')
+        assert len(tmpdir.listdir('__jinja2_*.cache')) == 1
+
+        # An app using the cache loads compiled templates from it.
+        monkeypatch.setattr(config['testing'], 'JINJA_BYTECODE_CACHE_DIR', cache_dir)
+        cached_app = create_app('testing')
+        env = cached_app.jinja_env
+        assert isinstance(env.bytecode_cache, AtomicFileSystemBytecodeCache)
+        with patch.object(env, 'compile', wraps=env.compile) as mock_compile:
+            with cached_app.test_request_context():
+                assert render_template('test_base_course/index.html', basecourse='x') == 'x'
+                mock_compile.assert_not_called()
+
+                # A changed template is recompiled, and the cache updated.
+                (book_dir / 'index.html').write_text('new {{ basecourse }}')
+                env.cache.clear()
+                assert render_template('test_base_course/index.html', basecourse='x') == 'new x'
+                mock_compile.assert_called_once()
+        assert len(tmpdir.listdir('__jinja2_*.cache')) == 1
+        assert not tmpdir.listdir('.tmp-*')
+
 
 # API tests
 # =========
@@ -98,10 +352,12 @@ class TestRunestoneApi(BaseTest):
 
     @pytest.fixture()
     def TestRunestoneApi_setup_common(self):
+        self.course_id = Courses['test_child_course1'].id.q.scalar()
         self.common_results = dict(
             sid=self.username,
             div_id='test_div_id',
             course_name='test_child_course1',
+            courses_id=self.course_id,
         )
 
     # Check the consistency of values put in Useinfo.
@@ -128,6 +384,7 @@ class TestRunestoneApi(BaseTest):
                 div_id='test_div_id',
                 event='mChoice',
                 course_id='test_child_course1',
+                courses_id=self.course_id,
             )]
 
     # Check that unauthenticed access produces a consistent sid.
@@ -268,6 +525,7 @@ class TestRunestoneApi(BaseTest):
         common_items = dict(
             sid=self.username,
             course_name='test_child_course1',
+            courses_id=self.course_id,
             correct=1,
             incorrect=2,
             skipped=3,
@@ -554,6 +812,436 @@ class TestRunestoneApi(BaseTest):
 
             assert go(**second_answer_dict) == [second_results_dict]
 
+    # Check the per-student progress rollup and the course_progress endpoint.
+    def test_8(self):
+        def go(**kwargs):
+            self.get_valid_json(
+                hsblog(
+                    act='',
+                    event='mChoice',
+                    **kwargs,
+                    **self.common_params
+                ), dict(
+                    log=True,
+                    is_authenticated=True,
+                )
+            )
+            return QuestionProgress[self.username, 'test_div_id', self.course_id].q.one()
+
+        with self.login_context:
+            # A wrong answer counts as an attempt, but isn't correct.
+            qp = go(answer='A', correct='F')
+            assert (qp.attempts, qp.best_score, qp.first_correct_at) == (1, 0, None)
+
+            # A correct answer records when the question was first answered correctly.
+            qp = go(answer='B', correct='T')
+            assert (qp.attempts, qp.best_score) == (2, 100)
+            first_correct_at = qp.first_correct_at
+            assert (first_correct_at - datetime.now()) < timedelta(seconds=2)
+
+            # Once correct, later answers aren't stored, so the rollup doesn't change.
+            qp = go(answer='A', correct='F')
+            assert (qp.attempts, qp.best_score, qp.first_correct_at) == (2, 100, first_correct_at)
+
+            # The test user is an instructor for this course, so can view its progress.
+            self.get_valid_json(ap('course_progress', course='test_child_course1'), dict(
+                course='test_child_course1',
+                progress={
+                    self.username: dict(
+                        test_div_id=dict(
+                            first_correct_at=first_correct_at.isoformat(),
+                            attempts=2,
+                            best_score=100,
+                        ),
+                    ),
+                },
+            ))
+
+            # But isn't an instructor for other courses.
+            self.get_valid_json(ap('course_progress', course='test_child_course2'), dict(
+                error='Not an instructor for course test_child_course2.',
+            ))
+
+        # Only logged-in users may request progress.
+        self.must_login(ap('course_progress', course='test_child_course1'))
+
+    # Check that short answers and timed exams also update the progress rollup, and that rebuilding the rollup from the answer tables gives the same result.
+    def test_8a(self):
+        def go(**kwargs):
+            self.get_valid_json(hsblog(**kwargs, course='test_child_course1'), dict(log=True, is_authenticated=True))
+
+        db.session.add_all([Questions(base_course='test_base_course', name=name) for name in ('test_div_id2', 'test_div_id3')])
+        db.session.commit()
+        question_cache.invalidate('test_base_course')
+        with self.login_context:
+            go(act='', event='mChoice', answer='A', correct='F', div_id='test_div_id')
+            go(act='', event='mChoice', answer='B', correct='T', div_id='test_div_id')
+            go(act='', event='shortanswer', answer='text', div_id='test_div_id2')
+            go(act='finish', event='timedExam', correct=3, incorrect=1, skipped=0, time=60, div_id='test_div_id3')
+            # A reset isn't a result.
+            go(act='reset', event='timedExam', correct=0, incorrect=0, skipped=4, time=0, div_id='test_div_id3')
+
+        def rollup():
+            return {qp.div_id: (qp.attempts, qp.best_score, qp.first_correct_at) for qp in QuestionProgress[QuestionProgress.sid == self.username].q}
+        before = rollup()
+        assert before['test_div_id2'] == (1, None, None)
+        assert before['test_div_id3'] == (1, 75, None)
+        assert before['test_div_id'][:2] == (2, 100)
+
+        # An answer written by web2py, without a courses_id, is included in a rebuild.
+        db.session.add(FitbAnswers(timestamp=datetime.now(), sid=self.username, div_id='test_div_id4', course_name='test_child_course1', answer='x', correct=True))
+        assert rebuild_question_progress() == 4
+        after = rollup()
+        assert after.pop('test_div_id4')[:2] == (1, 100)
+        assert after == before
+
+    # Check that existing rows which lack a courses_id are backfilled. The backfill runs on its own connection, so it must see committed data.
+    @pytest.mark.commits
+    def test_9(self):
+        # Simulate rows written before the courses_id column existed (or by web2py).
+        db.session.add(Useinfo(sid='old', course_id='test_child_course1'))
+        db.session.add(Useinfo(sid='old', course_id='test_child_course2'))
+        db.session.add(MchoiceAnswers(sid='old', course_name='test_child_course1'))
+        # A row for a non-existent course can't be backfilled.
+        db.session.add(Useinfo(sid='old'))
+        db.session.commit()
+
+        # Use tiny batches to exercise the batching.
+        backfill_course_ids(batch_size=1, verbose=False)
+        db.session.expire_all()
+        assert db.session.query(Useinfo.course_id, Useinfo.courses_id).order_by(Useinfo.id).all() == [
+            ('test_child_course1', self.course_id),
+            ('test_child_course2', Courses['test_child_course2'].id.q.scalar()),
+            (None, None),
+        ]
+        assert MchoiceAnswers[MchoiceAnswers.sid == 'old'].courses_id.q.scalar() == self.course_id
+
+        # The projected savings count each non-NULL course name.
+        sizes = course_name_sizes([Useinfo, MchoiceAnswers, FitbAnswers])
+        assert sizes['useinfo'] > sizes['mchoice_answers'] > 0
+        assert sizes['fitb_answers'] == 0
+
+    # Check that the `hsblog endpoint` finds answers written by web2py, which have no courses_id.
+    def test_9a(self):
+        db.session.add(MchoiceAnswers(timestamp=datetime.now(), sid=self.username, div_id='test_div_id', course_name='test_child_course1', answer='A', correct=True))
+        db.session.add(ShortanswerAnswers(timestamp=datetime.now(), sid=self.username, div_id='test_div_id', course_name='test_child_course1', answer='old'))
+        db.session.commit()
+
+        with self.login_context:
+            for kwargs in (dict(event='mChoice', answer='B', correct='F'), dict(event='shortanswer', answer='new')):
+                self.get_valid_json(hsblog(act='', div_id='test_div_id', course='test_child_course1', **kwargs), dict(log=True, is_authenticated=True))
+
+        # The earlier correct answer means the incorrect one isn't stored.
+        assert MchoiceAnswers[MchoiceAnswers.sid == self.username].answer.q.all() == [('A',)]
+        # The short answer is merged into the existing row, which gains a courses_id.
+        assert db.session.query(ShortanswerAnswers.answer, ShortanswerAnswers.courses_id).filter_by(sid=self.username).all() == [('new', self.course_id)]
+
+    # Check the Questions cache.
+    def test_10(self):
+        question = question_cache.get('test_base_course', 'test_div_id')
+        assert (question.name, question.chapter, question.subchapter) == ('test_div_id', '1', '2')
+        assert question_cache.get('test_base_course', 'new_div_id') is None
+
+        # A question added by a book rebuild is visible once the base course's entries are invalidated.
+        db.session.add(Questions(base_course='test_base_course', name='new_div_id'))
+        db.session.commit()
+        assert question_cache.get('test_base_course', 'new_div_id') is None
+        question_cache.invalidate('test_base_course')
+        assert question_cache.get('test_base_course', 'new_div_id').name == 'new_div_id'
+
+        # Without an invalidation, a miss reloads the base course, though only once ``QUESTION_CACHE_MISS_INTERVAL`` has passed since it was loaded.
+        db.session.add(Questions(base_course='test_base_course', name='newer_div_id'))
+        db.session.commit()
+        assert question_cache.get('test_base_course', 'newer_div_id') is None
+        later = monotonic() + app.config['QUESTION_CACHE_MISS_INTERVAL'] + 1
+        with patch('runestone.question_cache.monotonic', return_value=later):
+            assert question_cache.get('test_base_course', 'newer_div_id').name == 'newer_div_id'
+
+        # Entries expire after ``QUESTION_CACHE_TIMEOUT``.
+        db.session.query(Questions).filter_by(name='newer_div_id').delete()
+        db.session.commit()
+        with patch('runestone.question_cache.monotonic', return_value=later):
+            assert 'newer_div_id' in question_cache.get_base_course('test_base_course')
+        with patch('runestone.question_cache.monotonic', return_value=later + app.config['QUESTION_CACHE_TIMEOUT'] + 1):
+            assert 'newer_div_id' not in question_cache.get_base_course('test_base_course')
+
+        # Questions are per base course.
+        assert question_cache.get('other_base_course', 'test_div_id') is None
+
+    # Check bulk loading of questions.
+    def test_11(self):
+        def go(questions, **expected):
+            result = load_questions('test_base_course', questions)
+            del result['seconds']
+            assert result == expected
+
+        manifest = [
+            # An updated question.
+            dict(name='test_div_id', chapter='1', subchapter='3', is_private=True),
+            # A new question, with characters that need escaping.
+            dict(name='new_div_id', question='Tab\there,\nnewline \\N', difficulty=2),
+        ]
+        # Prime the question cache, to check that loading invalidates it.
+        assert question_cache.get('test_base_course', 'new_div_id') is None
+        go(manifest, inserted=1, updated=1, removed=0)
+        assert question_cache.get('test_base_course', 'test_div_id').subchapter == '3'
+        new_question = question_cache.get('test_base_course', 'new_div_id')
+        assert (new_question.question, new_question.difficulty, new_question.is_private) == ('Tab\there,\nnewline \\N', 2, None)
+        assert question_cache.get('test_base_course', 'test_div_id').is_private is True
+
+        # Loading the same manifest again changes nothing.
+        go(manifest, inserted=0, updated=0, removed=0)
+
+        # Questions no longer in the book are removed; other books are untouched.
+        db.session.add(Questions(base_course='other_base_course', name='test_div_id'))
+        db.session.commit()
+        go(manifest[1:], inserted=0, updated=0, removed=1)
+        assert Questions['test_div_id'].base_course.q.all() == [('other_base_course',)]
+
+        # Invalid manifests are rejected.
+        with pytest.raises(ValueError):
+            load_questions('test_base_course', [dict(name='x'), dict(name='x')])
+        with pytest.raises(ValueError):
+            load_questions('test_base_course', [dict(name='x', unknown=1)])
+
+    # Check the sid cookie.
+    def test_12(self):
+        url = hsblog(act='sid', event='mChoice', answer='A', correct='F', **self.common_params)
+        def go(is_auth=False):
+            rv = self.get_valid_json(url, dict(log=True, is_authenticated=is_auth))
+            return [cookie for cookie in rv.headers.getlist('Set-Cookie') if cookie.startswith('runestone_sid=')]
+        def last_sid():
+            return db.session.query(Useinfo.sid).order_by(Useinfo.id.desc()).limit(1).scalar()
+
+        # An anonymous visitor gets a sid, which is sent once.
+        cookie, = go()
+        assert 'HttpOnly' in cookie
+        sid = last_sid()
+        assert len(sid) == 16
+        assert not go()
+        assert last_sid() == sid
+
+        # A forged sid is replaced.
+        self.test_client.set_cookie('localhost', 'runestone_sid', 'forged.xxx')
+        assert go()
+        assert last_sid() not in (sid, 'forged')
+        # So is a sid signed with another key.
+        forged_sid = Signer('another key', salt='runestone.sid').sign(b'forged').decode('utf-8')
+        self.test_client.set_cookie('localhost', 'runestone_sid', forged_sid)
+        assert go()
+        assert last_sid() != 'forged'
+
+        # A sid in Flask's session, from earlier versions, is moved to the cookie.
+        self.test_client.delete_cookie('localhost', 'runestone_sid')
+        with self.test_client.session_transaction() as sess:
+            sess['sid'] = 'legacy'
+        assert go()
+        assert last_sid() == 'legacy'
+        # It isn't known to be anonymous, so logging in doesn't move its events.
+        with self.login_context:
+            assert go(True)
+        assert Useinfo['legacy'].q.count() == 1
+
+        # Logging out replaces the username with a new anonymous sid, sent by the logout response.
+        assert not go()
+        anonymous_sid = last_sid()
+        assert anonymous_sid not in (self.username, 'legacy')
+        # Logging in moves the anonymous visitor's events to their username. The cookie is only sent when the sid changes.
+        with self.login_context:
+            assert go(True)
+            assert not go(True)
+        assert Useinfo[anonymous_sid].q.count() == 0
+
+        # Logging out, then in again, works the same way.
+        assert not go()
+        anonymous_sid = last_sid()
+        assert anonymous_sid != self.username
+        with self.login_context:
+            assert go(True)
+        assert Useinfo[anonymous_sid].q.count() == 0
+
+    # Check that a sid which isn't anonymous, such as the username kept after a login expires, is never moved to another user.
+    def test_12a(self):
+        url = hsblog(act='sid', event='mChoice', answer='A', correct='F', **self.common_params)
+        with self.login_context:
+            self.get_valid_json(url, dict(log=True, is_authenticated=True))
+        # Simulate an expired login, rather than logging out, by sending a cookie naming another user.
+        other = Signer(app.secret_key, salt='runestone.sid').sign(b'u:other@test.user').decode('utf-8')
+        db.session.add(Useinfo(sid='other@test.user', act='other', course_id='test_child_course1'))
+        db.session.commit()
+        with self.login_context:
+            self.test_client.set_cookie('localhost', 'runestone_sid', other)
+            self.get_valid_json(url, dict(log=True, is_authenticated=True))
+        assert Useinfo['other@test.user'].q.count() == 1
+
+    # Check the rate limits and load shedding.
+    def test_13(self, monkeypatch):
+        url = hsblog(act='limit', event='page', **self.common_params)
+        def go(status=200):
+            rv = self.test_client.get(url)
+            assert rv.status_code == status
+            return rv
+        def check_rejected(rv, retry_after, error):
+            assert rv.get_json() == dict(log=False, is_authenticated=False, error=error)
+            assert rv.headers['Retry-After'] == retry_after
+
+        # Limit each sid.
+        monkeypatch.setitem(app.extensions, 'hsblog_rate_limiter', MemoryRateLimiter())
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_SID', (1, 2))
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_IP', None)
+        # The first call has no sid yet.
+        go()
+        go()
+        go()
+        check_rejected(go(429), '1', 'Too many requests; please try again later.')
+        assert Useinfo[Useinfo.act == 'limit'].q.count() == 3
+        # Another visitor isn't limited.
+        self.test_client.delete_cookie('localhost', 'runestone_sid')
+        go()
+
+        # Limit each IP address.
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_SID', None)
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_IP', (0.5, 1))
+        go()
+        check_rejected(go(429), '2', 'Too many requests; please try again later.')
+
+        # A call rejected by the IP address limit doesn't use up its sid's limit.
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_SID', (0.001, 1))
+        go(429)
+        monkeypatch.setitem(app.config, 'HSBLOG_RATE_LIMIT_IP', None)
+        go()
+        go(429)
+
+        # Shed load when the pool is saturated.
+        monkeypatch.setitem(app.config, 'HSBLOG_SHED_QUEUE_DEPTH', 2)
+        monkeypatch.setitem(app.extensions, 'hsblog_rate_limiter', None)
+        monkeypatch.setattr(db.engine.pool, 'waiting', 2)
+        check_rejected(go(503), '1', 'The server is busy; please try again.')
+        monkeypatch.setattr(db.engine.pool, 'waiting', 1)
+        go()
+
+    # Check the rate limiters and the pool's queue depth.
+    def test_14(self):
+        # Pin the clocks, so that the results don't depend on how quickly this runs.
+        now = [1000.0]
+        with patch('runestone.rate_limit.monotonic', lambda: now[0]):
+            limiter = MemoryRateLimiter(max_buckets=2)
+            assert limiter.allow('a', 20, 1)
+            assert not limiter.allow('a', 20, 1)
+            now[0] += 0.1
+            assert limiter.allow('a', 20, 1)
+            # A refunded token may be taken again.
+            limiter.refund('a', 20, 1)
+            assert limiter.allow('a', 20, 1)
+            # Full buckets are forgotten when there are too many.
+            limiter.allow('b', 1000, 2)
+            now[0] += 0.01
+            limiter.allow('c', 1000, 2)
+            assert set(limiter._buckets) == {'a', 'c'}
+
+        # Start at the beginning of a 200-second window.
+        with patch('runestone.rate_limit.time', return_value=200*10**7):
+            limiter = CacheRateLimiter()
+            assert [limiter.allow('a', 0.01, 2) for _ in range(3)] == [True, True, False]
+            limiter.refund('a', 0.01, 2)
+            limiter.refund('a', 0.01, 2)
+            assert [limiter.allow('a', 0.01, 2) for _ in range(2)] == [True, False]
+
+        # The pool counts the threads waiting for a connection.
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=5)
+        connection = pool.connect()
+        thread = Thread(target=lambda: pool.connect().close())
+        thread.start()
+        for _ in range(100):
+            if pool.waiting:
+                break
+            sleep(0.01)
+        assert pool.waiting == 1
+        connection.close()
+        thread.join()
+        assert pool.waiting == 0
+
+
+# Session tests
+# =============
+class TestSessions(BaseTest):
+    # Run each test with each store.
+    @pytest.fixture(params=['memory', 'redis'])
+    def store(self, request):
+        if request.param == 'memory':
+            yield LRUSessionStore()
+        else:
+            server = RedisStandin().start()
+            yield RedisSessionStore(server.url)
+            server.stop()
+
+    def session_id(self):
+        ids = [cookie.value for cookie in self.test_client.cookie_jar if cookie.name == 'session']
+        return ids[0] if ids else None
+
+    # Check server-side sessions.
+    def test_1(self, store, monkeypatch):
+        monkeypatch.setattr(app, 'session_interface', ServerSideSessionInterface(store))
+        # A session started before logging in.
+        with self.test_client.session_transaction() as sess:
+            sess['planted'] = True
+        planted_id = self.session_id()
+        assert store.get('session:' + planted_id)
+
+        with self.login_context:
+            # The cookie holds only the id, which changes on login.
+            session_id = self.session_id()
+            assert len(session_id) == 32
+            assert session_id != planted_id
+            assert store.get('session:' + planted_id) is None
+            assert decode_session(store.get('session:' + session_id))['user_id']
+
+            with patch.object(store, 'get', wraps=store.get) as mock_get:
+                # Requests which don't use the session don't load it.
+                with patch('runestone.book_server.server.send_from_directory', return_value=Response('')):
+                    self.get_valid(sp('test_child_course2/_static/foo.css'))
+                mock_get.assert_not_called()
+                # Requests which use it load it once, and don't send the cookie again if it's unchanged.
+                rv = self.get_valid_json(hsblog(act='', event='mChoice', answer='A', correct='F', **TestRunestoneApi.common_params), dict(log=True, is_authenticated=True))
+                mock_get.assert_called_once_with('session:' + session_id)
+                assert not [cookie for cookie in rv.headers.getlist('Set-Cookie') if cookie.startswith('session=')]
+        # Logging out changes the id again.
+        assert self.session_id() not in (session_id, None)
+        self.must_login(sp())
+
+    def test_2(self):
+        # The memory store discards the least recently used sessions.
+        store = LRUSessionStore(2)
+        store.set('a', b'1', 60)
+        store.set('b', b'2', 60)
+        store.get('a')
+        store.set('c', b'3', 60)
+        assert (store.get('a'), store.get('b'), store.get('c')) == (b'1', None, b'3')
+        store.set('d', b'4', 0.05)
+        sleep(0.1)
+        assert store.get('d') is None
+        store.delete('a')
+        assert store.get('a') is None
+
+        data = dict(_user_id='1', _fresh=True, _flashes=[('message', 'Hello')])
+        assert decode_session(encode_session(data)) == data
+        with pytest.raises(ValueError):
+            decode_session(b'\x00')
+
+        # Check the configuration.
+        flask_app = Flask(__name__)
+        sessions.init_app(flask_app)
+        assert not isinstance(flask_app.session_interface, ServerSideSessionInterface)
+        flask_app.config.update(SESSION_TYPE='memory', SESSION_MEMORY_MAX=5)
+        sessions.init_app(flask_app)
+        assert flask_app.session_interface.store.max_sessions == 5
+        flask_app.config.update(SESSION_TYPE='redis', CACHE_REDIS_URL='redis://localhost:1/0')
+        sessions.init_app(flask_app)
+        assert isinstance(flask_app.session_interface.store, RedisSessionStore)
+        flask_app.config.update(SESSION_TYPE='xxx')
+        with pytest.raises(ValueError):
+            sessions.init_app(flask_app)
+
 
 # Web2PyBoolean tests
 # ===================
@@ -568,9 +1256,10 @@ class TestWeb2PyBoolean(BaseTest):
         else:
             assert bool_ is None
 
-        db.engine.execute(db.text("insert into courses (course_name, python3) values ('bool_test', :bool_)"), bool_=bool_)
+        # Use the session's connection, so that these statements run in the test's transaction.
+        db.session.execute(db.text("insert into courses (course_name, python3) values ('bool_test', :bool_)"), dict(bool_=bool_))
         yield
-        db.engine.execute(db.text("delete from courses where course_name='bool_test';"))
+        db.session.execute(db.text("delete from courses where course_name='bool_test';"))
 
     @contextmanager
     def orm_write_bool(self, bool_):
@@ -582,7 +1271,7 @@ class TestWeb2PyBoolean(BaseTest):
         db.session.commit()
 
     def manual_read_bool(self):
-        result = db.engine.execute(db.text("select python3 from courses where course_name='bool_test'")).fetchall()
+        result = db.session.execute(db.text("select python3 from courses where course_name='bool_test'")).fetchall()
         assert len(result) == 1
         assert len(result[0].items()) == 1
         return result[0][0]
@@ -609,3 +1298,558 @@ class TestWeb2PyBoolean(BaseTest):
             assert self.manual_read_bool() == 'F'
         with self.orm_write_bool(None):
             assert self.manual_read_bool() is None
+
+
+# Cache tests
+# ===========
+class TestCache:
+    @pytest.fixture()
+    def redis_standin(self):
+        server = RedisStandin().start()
+        yield server
+        server.stop()
+
+    # Run each test with each backend.
+    @pytest.fixture(params=['memory', 'redis'])
+    def backend(self, request, redis_standin):
+        if request.param == 'memory':
+            return MemoryCacheBackend()
+        else:
+            return RedisCacheBackend(redis_standin.url)
+
+    def test_1(self, backend):
+        assert backend.get('a') is None
+        backend.set('a', dict(x=[1, 2]))
+        assert backend.get('a') == dict(x=[1, 2])
+        backend.delete('a')
+        assert backend.get('a') is None
+
+        # Check timeouts.
+        backend.set('b', 1, 0.05)
+        assert backend.get('b') == 1
+        sleep(0.1)
+        assert backend.get('b') is None
+
+        # Check counters.
+        assert backend.incr('c') == 1
+        assert backend.incr('c', 2) == 3
+        assert backend.incr('c', 0) == 3
+        assert backend.incr('d', 1, 0.05) == 1
+        sleep(0.1)
+        assert backend.incr('d') == 1
+
+        # Clear only affects keys with the given prefix.
+        backend.set('p:1', 1)
+        backend.set('p:2', 2)
+        backend.set('q:1', 3)
+        backend.clear('p:')
+        assert (backend.get('p:1'), backend.get('p:2'), backend.get('q:1')) == (None, None, 3)
+
+    # Check that invalidations reach every worker.
+    def test_2(self, redis_standin):
+        def make_worker():
+            worker = Cache()
+            worker.backend = RedisCacheBackend(redis_standin.url)
+            received = []
+            worker.on_invalidate('topic', received.append)
+            worker._subscribe()
+            return worker, received
+
+        worker1, received1 = make_worker()
+        worker2, received2 = make_worker()
+        # Wait for the subscriber threads to connect.
+        for _ in range(100):
+            if len(redis_standin.subscribers.get(b'runestone:invalidate', [])) == 2:
+                break
+            sleep(0.01)
+
+        def wait_for(received, length):
+            for _ in range(100):
+                if len(received) >= length:
+                    break
+                sleep(0.01)
+
+        worker1.invalidate('topic', 'key')
+        worker1.invalidate('other_topic', 'key')
+        # The invalidating worker sees the invalidation immediately.
+        assert received1 == ['key']
+        # Other workers see it shortly.
+        wait_for(received2, 1)
+        assert received2 == ['key']
+
+        # The server delivers messages in order, so once worker1 sees this one, it has also seen its own message above, which it must ignore: each callback runs exactly once per invalidation.
+        worker2.invalidate('topic', 'key2')
+        wait_for(received1, 2)
+        assert received1 == ['key', 'key2']
+        assert received2 == ['key', 'key2']
+
+    # An unreachable server makes the cache miss, but doesn't raise.
+    def test_3(self):
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            port = s.getsockname()[1]
+        backend = RedisCacheBackend('redis://localhost:{}/0'.format(port))
+        backend.set('a', 1)
+        assert backend.get('a') is None
+
+
+# Spool tests
+# ===========
+class TestSpool(BaseTest):
+    # Check the segment format.
+    def test_1(self, tmpdir):
+        # Each record takes 8 + 20 bytes, so two fit in a segment with the end marker.
+        spool = Spool(str(tmpdir), segment_size=64)
+        payloads = [b'x'*20, b'y'*20, b'z'*20]
+        assert not spool.pending()
+        for payload in payloads:
+            spool.append(payload)
+        assert spool.pending()
+        assert len(tmpdir.listdir()) == 2
+        with pytest.raises(ValueError):
+            spool.append(b'a'*50)
+
+        # A failed insert leaves the segments to retry.
+        def fail(records):
+            raise OSError
+        with pytest.raises(OSError):
+            spool.replay(fail)
+        assert sorted(path.ext for path in tmpdir.listdir()) == ['.ready', '.ready']
+
+        replayed = []
+        assert spool.replay(replayed.extend) == 3
+        assert replayed == payloads
+        assert not tmpdir.listdir()
+        assert not spool.pending()
+
+        # Reading stops at a damaged record.
+        spool.append(b'good')
+        spool.append(b'bad')
+        spool.close()
+        path, = tmpdir.listdir()
+        data = bytearray(path.read_binary())
+        data[8 + 4 + 8] ^= 0xFF
+        path.write_binary(bytes(data))
+        assert read_segment(str(path)) == ([b'good'], False)
+
+        # Segments left open by an exited process are replayed.
+        orphan = tmpdir.join('{:020d}-{}.open'.format(0, 2**22 + 1))
+        orphan.write_binary(path.read_binary())
+        path.remove()
+        replayed = []
+        assert spool.replay(replayed.extend) == 1
+        assert replayed == [b'good']
+
+    # Check that hsblog succeeds when the database is down or slow, then that the spooled rows are replayed.
+    @pytest.mark.commits
+    def test_2(self, tmpdir):
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        proxy = OutageProxy((url.host, url.port or 5432)).start()
+        proxied_url = replace_url(url, host='localhost', port=proxy.port)
+        spool_app = create_app('testing')
+        spool_app.config.update(
+            SQLALCHEMY_DATABASE_URI=proxied_url,
+            SPOOL_DIR=str(tmpdir),
+            SPOOL_REPLAY_INTERVAL=None,
+            SPOOL_LATENCY_BUDGET_MS=200,
+        )
+        spool.init_app(spool_app)
+        client = spool_app.test_client()
+        # This thread's session belongs to ``app``; start a new one for ``spool_app``.
+        db.session.remove()
+
+        def go(act):
+            rv = client.get(hsblog(act=act, event='page', **TestRunestoneApi.common_params))
+            assert rv.status_code == 200
+            return rv.get_json()
+
+        try:
+            assert go('before') == dict(log=True, is_authenticated=False)
+
+            # With the database down, anonymous page views still succeed.
+            proxy.down()
+            assert go('outage1') == dict(log=True, is_authenticated=False)
+            assert go('outage2') == dict(log=True, is_authenticated=False)
+            proxy.up()
+            assert Useinfo[Useinfo.act.in_(['outage1', 'outage2'])].q.count() == 0
+            assert spool.replay(spool_app) == 2
+            assert spool.replay(spool_app) == 0
+            before, outage1, outage2 = db.session.query(Useinfo).filter(Useinfo.act.in_(['before', 'outage1', 'outage2'])).order_by(Useinfo.id).all()
+            assert (outage1.act, outage2.act) == ('outage1', 'outage2')
+            assert outage1.sid == before.sid
+            assert outage1.courses_id == before.courses_id
+            assert before.timestamp <= outage1.timestamp <= outage2.timestamp
+
+            # A slow database is treated the same way; logged-in users are told their answer wasn't saved.
+            rv = client.post(url_for('user.login'), data=dict(username=self.username, password='grouplens'))
+            assert rv.status_code == 302
+            db.session.remove()
+            with db.engine.connect() as connection:
+                with connection.begin():
+                    connection.execute('lock table useinfo in exclusive mode')
+                    assert go('slow') == dict(
+                        log=False,
+                        is_authenticated=True,
+                        error='The database is unavailable; please try again.',
+                    )
+            assert Useinfo[Useinfo.act == 'slow'].q.count() == 0
+            assert spool.replay(spool_app) == 1
+            assert Useinfo[Useinfo.act == 'slow'].sid.q.scalar() == self.username
+        finally:
+            proxy.stop()
+            db.get_engine(spool_app).dispose()
+
+    # Check that waiting for a connection counts against the latency budget.
+    @pytest.mark.commits
+    def test_3(self, tmpdir):
+        spool_app = create_app('testing')
+        spool_app.config.update(
+            SQLALCHEMY_ENGINE_OPTIONS=dict(pool_size=1, max_overflow=0),
+            SPOOL_DIR=str(tmpdir),
+            SPOOL_REPLAY_INTERVAL=None,
+            SPOOL_LATENCY_BUDGET_MS=200,
+        )
+        spool.init_app(spool_app)
+        assert spool_app.config['SQLALCHEMY_ENGINE_OPTIONS'] == dict(pool_size=1, max_overflow=0, pool_timeout=0.2, connect_args=dict(connect_timeout=2))
+        client = spool_app.test_client()
+        db.session.remove()
+        engine = db.get_engine(spool_app)
+        url = hsblog(act='pool', event='page', **TestRunestoneApi.common_params)
+        try:
+            # Cache the course, so that only logging needs the database.
+            assert client.get(url).get_json() == dict(log=True, is_authenticated=False)
+            # Take the only connection, so that hsblog can't get one.
+            with engine.connect():
+                start = perf_counter()
+                rv = client.get(url)
+                assert perf_counter() - start < 2
+                assert rv.get_json() == dict(log=True, is_authenticated=False)
+            assert spool.replay(spool_app) == 1
+            assert Useinfo[Useinfo.act == 'pool'].q.count() == 2
+        finally:
+            engine.dispose()
+
+
+# Read replica tests
+# ==================
+class TestRouting(BaseTest):
+    # Route reads to a replica: here, the test database reached through a proxy, so that it can fail independently.
+    @pytest.mark.commits
+    def test_1(self, monkeypatch):
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        proxy = OutageProxy((url.host, url.port or 5432)).start()
+        replica_url = replace_url(url, host='localhost', port=proxy.port)
+        monkeypatch.setattr(config['testing'], 'READ_REPLICA_URLS', [replica_url])
+        monkeypatch.setattr(config['testing'], 'READ_REPLICA_CHECK_INTERVAL', 3600)
+        routing_app = create_app('testing')
+        replicas = routing_app.extensions['read_replicas']
+        replica_engine = db.get_engine(routing_app, 'replica0')
+        replica_sql = []
+
+        @event.listens_for(replica_engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement != routing.LAG_QUERY:
+                replica_sql.append(statement)
+
+        client = routing_app.test_client()
+        # This thread's session belongs to ``app``; start a new one for ``routing_app``.
+        db.session.remove()
+        cache.clear()
+
+        try:
+            # Loading the course and the question read from the replica; loading the user, and checking and recording the answer, use the primary.
+            rv = client.post(url_for('user.login'), data=dict(username=self.username, password='grouplens'))
+            assert rv.status_code == 302
+            rv = client.get(hsblog(act='routed', event='mChoice', answer='A', correct='T', **TestRunestoneApi.common_params))
+            assert rv.get_json() == dict(log=True, is_authenticated=True)
+            assert not any('FROM auth_user' in sql for sql in replica_sql)
+            assert any('FROM courses' in sql for sql in replica_sql)
+            assert not any('mchoice_answers' in sql or 'useinfo' in sql for sql in replica_sql)
+            assert MchoiceAnswers[MchoiceAnswers.sid == self.username].q.count() == 1
+
+            db.session.remove()
+            with routing_app.app_context():
+                # A transaction reads its own writes from the primary.
+                db.session.add(Courses(course_name='routing_course', python3=True, login_required=False))
+                db.session.flush()
+                del replica_sql[:]
+                assert Courses['routing_course'].q.count() == 1
+                assert not replica_sql
+                db.session.rollback()
+                assert Courses['routing_course'].q.count() == 0
+                assert replica_sql
+
+                # ``SELECT ... FOR UPDATE`` and reads of other tables use the primary.
+                del replica_sql[:]
+                db.session.query(Courses).filter_by(course_name='test_child_course1').with_for_update().one()
+                Useinfo[Useinfo.sid == self.username].q.count()
+                assert not replica_sql
+                db.session.rollback()
+
+                # A replica which fails during a query is abandoned immediately.
+                proxy.down()
+                with pytest.raises(exc.OperationalError):
+                    Courses['test_child_course1'].q.one()
+                db.session.rollback()
+                assert not replicas.replicas[0].healthy
+                del replica_sql[:]
+                assert Courses['test_child_course1'].q.one()
+                assert not replica_sql
+
+                # It stays unused until a health check succeeds.
+                replicas.replicas[0].checked = None
+                assert Courses['test_child_course1'].q.one()
+                assert not replicas.replicas[0].healthy
+                proxy.up()
+                replicas.replicas[0].checked = None
+                assert Courses['test_child_course1'].q.one()
+                assert replicas.replicas[0].healthy
+                assert replica_sql
+
+                # The primary isn't a replica, so it reports no lag.
+                assert db.session.scalar(routing.LAG_QUERY) is None
+
+                # A replica which lags too far behind isn't used.
+                replicas.max_lag = 5
+                replicas.replicas[0].checked = None
+                with patch.object(routing, 'LAG_QUERY', 'select 60'):
+                    del replica_sql[:]
+                    assert Courses['test_child_course1'].q.one()
+                assert not replica_sql
+                assert not replicas.replicas[0].healthy
+        finally:
+            db.session.remove()
+            proxy.stop()
+            replica_engine.dispose()
+            db.get_engine(routing_app).dispose()
+
+
+# Compact Useinfo tests
+# =====================
+class TestUseinfoStorage(BaseTest):
+    # Check writing compact rows, and reading them through the view.
+    def test_1(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'USEINFO_STORAGE', 'compact')
+        # A row already in Useinfo.
+        db.session.add(Useinfo(sid='legacy', event='page', act='old', div_id='test_div_id', course_id='test_child_course1', courses_id=Courses['test_child_course1'].q.one().id))
+        db.session.commit()
+
+        # A known event and a question's div_id are added to the lookup tables once; later rows find them in the intern cache. Other events aren't interned.
+        with patch.object(useinfo_interns, '_add', wraps=useinfo_interns._add) as add:
+            self.get_valid_json(hsblog(act='one', event='page', **TestRunestoneApi.common_params), dict(log=True, is_authenticated=False))
+            assert add.call_count == 2
+            self.get_valid_json(hsblog(act='two', event='page', **TestRunestoneApi.common_params), dict(log=True, is_authenticated=False))
+            self.get_valid_json(hsblog(act='bogus', event='xxx', **TestRunestoneApi.common_params), dict(log=True, is_authenticated=False))
+            assert add.call_count == 2
+        assert Useinfo[Useinfo.act.in_(['one', 'two', 'bogus'])].q.count() == 0
+        one, two, bogus = db.session.query(UseinfoCompact).order_by(UseinfoCompact.id).all()
+        assert one.event_key == two.event_key and one.div_id_key == two.div_id_key
+        assert (one.event, one.act, one.div_id) == (None, 'one', None)
+        assert (bogus.event_key, bogus.event, bogus.div_id_key) == (None, 'xxx', one.div_id_key)
+        assert UseinfoEvent.query.count() == UseinfoDivId.query.count() == 1
+
+        # The view presents both layouts as Useinfo rows.
+        columns = [useinfo_view.c[name] for name in ('sid', 'event', 'act', 'div_id', 'course_id', 'courses_id')]
+        rows = db.session.query(*columns).order_by(useinfo_view.c.id).all()
+        course_id = Courses['test_child_course1'].q.one().id
+        assert rows == [
+            ('legacy', 'page', 'old', 'test_div_id', 'test_child_course1', course_id),
+            (one.sid, 'page', 'one', 'test_div_id', 'test_child_course1', course_id),
+            (one.sid, 'page', 'two', 'test_div_id', 'test_child_course1', course_id),
+            (one.sid, 'xxx', 'bogus', 'test_div_id', 'test_child_course1', course_id),
+        ]
+        assert db.session.query(useinfo_view.c.id).filter(useinfo_view.c.act == 'one').scalar() == one.id
+
+        # Logging in moves the visitor's compact rows to their username.
+        self.login(self.username, 'grouplens')
+        self.get_valid_json(hsblog(act='three', event='mChoice', answer='A', correct='F', **TestRunestoneApi.common_params), dict(log=True, is_authenticated=True))
+        assert [row.sid for row in db.session.query(UseinfoCompact)] == [self.username]*4
+
+    # Check moving existing rows to the compact layout, and the space saved.
+    @pytest.mark.commits
+    def test_2(self):
+        course_id = Courses['test_child_course1'].q.one().id
+        db.session.bulk_insert_mappings(Useinfo, [dict(
+            timestamp=datetime(2020, 1, 1) + timedelta(minutes=i),
+            sid='student{}@test.user'.format(i % 20),
+            event='page',
+            act='/runestone/static/test_base_course/Chapter{}/Section{}.html'.format(i % 5, i % 7),
+            div_id='test_div_id' if i % 3 else 'not_a_question',
+            course_id='test_child_course1',
+            courses_id=course_id if i % 2 else None,
+        ) for i in range(250)])
+        db.session.commit()
+        columns = [useinfo_view.c[column.name] for column in Useinfo.__table__.columns]
+        before = db.session.query(*columns).order_by(useinfo_view.c.id).all()
+        legacy_rows, legacy_bytes = row_sizes()['useinfo']
+
+        assert compact_useinfo(batch_size=100, verbose=False) == 250
+        assert Useinfo.query.count() == 0
+        # The view is unchanged, except that every row now has a courses_id.
+        assert db.session.query(*columns).order_by(useinfo_view.c.id).all() == [row[:-1] + (course_id,) for row in before]
+        assert [row.value for row in UseinfoEvent.query] == ['page']
+        assert [row.value for row in UseinfoDivId.query] == ['test_div_id']
+        compact_rows, compact_bytes = row_sizes()['useinfo_compact']
+        assert (legacy_rows, compact_rows) == (250, 250)
+        assert compact_bytes < legacy_bytes*0.95
+
+        # Running it again moves nothing.
+        assert compact_useinfo() == 0
+
+
+# Archive tests
+# =============
+class TestArchive(BaseTest):
+    def test_1(self, tmp_path):
+        course_id = Courses['test_child_course1'].q.one().id
+        for i, month in enumerate((1, 1, 2, 3)):
+            db.session.add(Useinfo(timestamp=datetime(2020, month, 10 + i), sid='student{}'.format(i), event='page', act='act{}'.format(i), div_id='test_div_id', course_id='test_child_course1', courses_id=course_id))
+        db.session.add(MchoiceAnswers(timestamp=datetime(2020, 1, 5), sid='student0', div_id='test_div_id', course_name='test_child_course1', answer='A', correct=True))
+        db.session.add(MchoiceAnswers(timestamp=datetime(2020, 2, 5), sid='student1', div_id='test_div_id', course_name='test_child_course1', answer='B', correct=False))
+        db.session.flush()
+
+        # Only rows before the date are archived, one file per course and month.
+        archived = archive(tmp_path, datetime(2020, 3, 1), verbose=False)
+        assert (archived['useinfo'], archived['mchoice_answers'], archived['fitb_answers']) == (3, 2, 0)
+        assert sorted(str(path.relative_to(tmp_path)) for path in tmp_path.glob('useinfo/**/*.parquet')) == [
+            'useinfo/course=test_child_course1/month=2020-01/part-0.parquet',
+            'useinfo/course=test_child_course1/month=2020-02/part-0.parquet',
+        ]
+
+        # Read back only some columns, and optionally some months.
+        table = read_archive(tmp_path, 'useinfo', 'test_child_course1', ['sid', 'act'])
+        assert table.column_names == ['sid', 'act']
+        assert sorted(table.to_pydict()['act']) == ['act0', 'act1', 'act2']
+        assert read_archive(tmp_path, 'useinfo', 'test_child_course1', ['act'], months=['2020-02']).to_pydict() == dict(act=['act2'])
+        answers = read_archive(tmp_path, 'mchoice_answers', 'test_child_course1', ['answer', 'correct']).sort_by('answer')
+        assert answers.to_pydict() == dict(answer=['A', 'B'], correct=[True, False])
+        # A course with no archive has no rows, but the same columns.
+        assert read_archive(tmp_path, 'useinfo', 'test_child_course2', ['sid']).num_rows == 0
+
+        # Archiving again with a later date rewrites the partitions it covers, without duplicating rows.
+        assert archive(tmp_path, datetime(2020, 4, 1), ['test_child_course1'], verbose=False)['useinfo'] == 4
+        assert read_archive(tmp_path, 'useinfo', 'test_child_course1', ['sid']).num_rows == 4
+
+
+# Analytics tests
+# ===============
+class TestAnalytics(BaseTest):
+    def test_1(self):
+        start = datetime(2020, 1, 1)
+        common = dict(course_name='test_child_course1')
+        for sid, seconds, correct in (('s1', 0, False), ('s1', 60, False), ('s1', 120, True), ('s2', 30, True)):
+            db.session.add(MchoiceAnswers(timestamp=start + timedelta(seconds=seconds), sid=sid, div_id='q1', correct=correct, **common))
+        db.session.add(FitbAnswers(timestamp=start, sid='s1', div_id='q2', correct=False, **common))
+        db.session.add(LpAnswers(timestamp=start, sid='s1', div_id='q3', correct=100, **common))
+        # Another course's answers are ignored.
+        db.session.add(MchoiceAnswers(timestamp=start, sid='s3', div_id='q1', correct=False, course_name='test_child_course2'))
+        for sid, correct, incorrect, time_taken, reset in (('s1', 8, 1, 300, None), ('s2', 5, 5, 100, None), ('s2', 0, 0, 10, True)):
+            db.session.add(TimedExam(timestamp=start, sid=sid, div_id='exam', correct=correct, incorrect=incorrect, skipped=10 - correct - incorrect, time_taken=time_taken, reset=reset, **common))
+        db.session.flush()
+
+        report = course_report('test_child_course1')
+        questions = report['questions']
+        assert questions.loc['q1'].to_dict() == dict(attempts=4, students=2, correct_rate=0.5, students_correct=2, mean_attempts_to_correct=2, median_seconds_to_correct=60)
+        assert questions.loc['q2', 'students_correct'] == 0 and questions['mean_attempts_to_correct'].isna()['q2']
+        assert questions.loc['q3', ['correct_rate', 'students_correct', 'mean_attempts_to_correct']].tolist() == [1, 1, 1]
+        assert report['attempts'].loc['q1'].tolist() == [1, 0, 1, 0, 0, 0, 0, 0, 0, 0]
+        # The reset attempt isn't a result.
+        assert report['timed_exams'].loc['exam'].to_dict() == dict(attempts=2, students=2, mean_score=65, median_score=65, mean_time_taken=200)
+
+        with self.login_context:
+            rv = self.get_valid(ap('course_analytics', course='test_child_course1'))
+            data = json.loads(rv.get_data(as_text=True))
+            assert data['questions'][1] == dict(div_id='q2', attempts=1, students=1, correct_rate=0, students_correct=0, mean_attempts_to_correct=None, median_seconds_to_correct=None)
+            assert data['attempts'][0]['3'] == 1
+            assert data['timed_exams'] == [dict(div_id='exam', attempts=2, students=2, mean_score=65, median_score=65, mean_time_taken=200)]
+            self.get_valid_json(ap('course_analytics', course='test_child_course2'), dict(
+                error='Not an instructor for course test_child_course2.',
+            ))
+        self.must_login(ap('course_analytics', course='test_child_course1'))
+
+
+    # Check bulk loading of columns, including Web2PyBoolean columns.
+    def test_2(self):
+        assert web2py_boolean_array('TF-T').tolist() == [True, False, None, True]
+        for i, correct in enumerate((True, None, False)):
+            db.session.add(MchoiceAnswers(timestamp=datetime(2020, 1, 1 + i), sid='s{}'.format(i), div_id='q1', correct=correct, course_name='test_child_course1'))
+        db.session.flush()
+        columns = [MchoiceAnswers.sid, MchoiceAnswers.timestamp, MchoiceAnswers.correct, MchoiceAnswers.courses_id]
+        arrays = load_columns(columns, MchoiceAnswers.course_name == 'test_child_course1', MchoiceAnswers.id.desc())
+        assert arrays['sid'].tolist() == ['s2', 's1', 's0']
+        assert arrays['timestamp'][0] == np.datetime64('2020-01-03')
+        # The same values the ORM loads, with NULL masked.
+        assert arrays['correct'].tolist() == [row.correct for row in MchoiceAnswers.query.order_by(MchoiceAnswers.id.desc())]
+        assert np.isnan(arrays['courses_id']).all()
+        # No rows give empty arrays.
+        assert len(load_columns(columns, MchoiceAnswers.course_name == 'test_child_course2', MchoiceAnswers.id)['correct']) == 0
+
+
+# Core insert tests
+# =================
+class TestInserts(BaseTest):
+    # Check that ``insert_row`` stores the same rows the ORM does, for Useinfo and every answer table.
+    def test_1(self):
+        course_id = Courses['test_child_course1'].q.one().id
+        common = dict(timestamp=datetime(2020, 1, 1), sid='student', div_id='test_div_id', courses_id=course_id)
+        values = {
+            Useinfo: dict(event='page', act='view', course_id='test_child_course1', **common),
+            TimedExam: dict(correct=1, incorrect=2, skipped=3, time_taken=4, reset=True, course_name='test_child_course1', **common),
+            LpAnswers: dict(answer='{}', correct=87.5, course_name='test_child_course1', **common),
+            ShortanswerAnswers: dict(answer='text', course_name='test_child_course1', **common),
+        }
+        for model in (MchoiceAnswers, FitbAnswers, DragndropAnswers, ClickableareaAnswers):
+            values[model] = dict(answer='A', correct=False, course_name='test_child_course1', **common)
+        for model in (ParsonsAnswers, CodelensAnswers):
+            values[model] = dict(answer='A', correct=None, source='src', course_name='test_child_course1', **common)
+
+        for model, row in values.items():
+            db.session.add(model(**row))
+            db.session.flush()
+            insert_row(model, **row)
+            orm_row, core_row = [
+                {column.name: value for column, value in zip(model.__table__.columns, r) if column.name != 'id'}
+                for r in db.session.query(*model.__table__.columns).order_by(model.id)
+            ]
+            assert core_row == orm_row == {column.name: row.get(column.name) for column in model.__table__.columns if column.name != 'id'}, model
+
+# Timed exam statistics tests
+# ===========================
+class TestExamStats(BaseTest):
+    def test_1(self):
+        def go(act, correct, incorrect, skipped, time):
+            self.get_valid_json(hsblog(act=act, event='timedExam', correct=correct, incorrect=incorrect, skipped=skipped, time=time, **TestRunestoneApi.common_params), dict(log=True, is_authenticated=True))
+
+        course_id = Courses['test_child_course1'].q.one().id
+        with self.login_context:
+            go('finish', 8, 2, 0, 90)
+            go('finish', 5, 5, 0, 150)
+            go('finish', 10, 0, 0, 30)
+            # A reset isn't a result.
+            go('reset', 0, 0, 10, 5)
+
+        stats = exam_stats(course_id, 'test_div_id')
+        assert stats['attempts'] == 3
+        assert stats['mean_score'] == pytest.approx(230/3)
+        assert stats['mean_time_taken'] == 90
+        # Each percentile is exact to within one bucket.
+        assert stats['score_percentiles'] == {25: 50.75, 50: 80.5, 75: 100, 90: 100}
+        assert stats['time_percentiles'] == {25: 45, 50: 90, 75: 135, 90: 162}
+        assert exam_stats(course_id, 'no_such_exam')['attempts'] == 0
+
+        with self.login_context:
+            self.get_valid_json(ap('timed_exam_stats', course='test_child_course1', div_id='test_div_id'), dict(
+                course='test_child_course1', div_id='test_div_id', attempts=3, mean_score=stats['mean_score'], mean_time_taken=90,
+                score_percentiles={'25': 50.75, '50': 80.5, '75': 100, '90': 100}, time_percentiles={'25': 45, '50': 90, '75': 135, '90': 162},
+            ))
+            self.get_valid_json(ap('timed_exam_stats', course='test_child_course2', div_id='test_div_id'), dict(
+                error='Not an instructor for course test_child_course2.',
+            ))
+
+        # Rebuilding from TimedExam gives the same statistics.
+        def row():
+            return {column.name: getattr(TimedExamStats.query.one(), column.name) for column in TimedExamStats.__table__.columns if column.name != 'id'}
+        before = row()
+        assert rebuild_timed_exam_stats() == 1
+        assert row() == before
+
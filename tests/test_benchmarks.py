@@ -0,0 +1,275 @@
+# ****************************************
+# |docname| - Micro-benchmarks of hot paths
+# ****************************************
+# These time the code which runs on nearly every request, using `pytest-benchmark <https://pytest-benchmark.readthedocs.io>`_. They also count the SQL queries each call makes. A query count above the budget in ``QUERY_BUDGETS`` fails the test on every run, since an extra query usually costs more than any CPU regression these benchmarks could catch.
+#
+# To save a baseline, then later compare with it and fail if any benchmark's mean time regressed by more than 10%:
+#
+# .. code-block:: text
+#
+#   python -m pytest tests/test_benchmarks.py --benchmark-autosave
+#   python -m pytest tests/test_benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:10%
+#
+# Baselines are saved in ``.benchmarks/``, along with each benchmark's query count (in its ``extra_info``). Use ``--benchmark-skip`` to run only the unit tests, or ``--benchmark-disable`` to run each benchmark just once, as a test.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from datetime import datetime
+from pathlib import Path
+from time import process_time
+import os
+import shutil
+
+# Third-party imports
+# -------------------
+from flask import Response
+import pandas as pd
+import pytest
+pytest.importorskip('pytest_benchmark')
+
+# Local imports
+# -------------
+# The ``app`` import is required for the fixtures to work.
+from base_test import BaseTest, app, QueryCounter, url_joiner
+from runestone.api.endpoints import api, sql_validator
+from runestone.book_server.server import book_server
+from runestone import metrics, sid
+from runestone.inserts import insert_row
+from runestone.analytics import load_answers, load_columns, question_report, scored_answer_models
+from runestone.model import db, Useinfo, MchoiceAnswers, Web2PyBoolean
+from runestone.progress import answer_score
+
+
+# Utilities
+# =========
+# The maximum number of queries each benchmark may make per call, measured once all caches are warm.
+QUERY_BUDGETS = dict(
+    # The course comes from the cache, so an anonymous page needs no queries.
+    serve_page=0,
+    serve_static=0,
+    # Insert into Useinfo.
+    hsblog_anonymous=1,
+    # Load the user, insert into Useinfo, check for a correct answer, insert the answer and update the progress rollup.
+    hsblog_authenticated=5,
+)
+
+
+def sp(_str='', **kwargs):
+    return url_joiner(book_server.url_prefix, _str, **kwargs)
+def hsblog(**kwargs):
+    return url_joiner(api.url_prefix, 'hsblog', **kwargs)
+
+
+# Create a small book for test_base_course in the book server's templates folder, removing it afterwards. A book left behind by an interrupted run is overwritten.
+@pytest.fixture(scope='module')
+def test_book():
+    templates_path = Path(book_server.root_path) / book_server.template_folder
+    created_templates = not templates_path.exists()
+    book_path = templates_path / 'test_base_course'
+    (book_path / '_static').mkdir(parents=True, exist_ok=True)
+    (book_path / 'bench.html').write_text(
+        '<html><head><link rel="stylesheet" href="_static/bench.css"></head><body>'
+        '<script>eBookConfig = {course: "{{ basecourse }}", python3: {{ python3 }}, loginRequired: {{ login_required }}};</script>'
+        + '<p>Text.</p>'*1000 + '</body></html>'
+    )
+    (book_path / '_static' / 'bench.css').write_text('p { color: black; }\n'*1000)
+    yield
+    shutil.rmtree(str(templates_path if created_templates else book_path))
+
+
+# Benchmarks
+# ==========
+@pytest.mark.usefixtures('test_book')
+class TestBenchmarks(BaseTest):
+    # Check the number of queries ``func`` makes against ``QUERY_BUDGETS[name]``, then benchmark it.
+    def run_benchmark(self, benchmark, name, func):
+        # Warm up any caches, so that the count reflects the steady state.
+        func()
+        with QueryCounter() as qc:
+            func()
+        benchmark.extra_info['queries'] = qc.count
+        assert qc.count <= QUERY_BUDGETS[name], qc.statements
+        return benchmark(func)
+
+    def test_serve_page(self, benchmark):
+        url = sp('test_child_course2/bench.html')
+        self.get_valid(url, b'course: "test_base_course"')
+        self.run_benchmark(benchmark, 'serve_page', lambda: self.test_client.get(url))
+
+    def test_serve_static(self, benchmark):
+        url = sp('test_child_course2/_static/bench.css')
+        self.get_valid(url, b'color: black')
+        # Close the response, so its file is closed.
+        self.run_benchmark(benchmark, 'serve_static', lambda: self.test_client.get(url).close())
+
+    # Record the size of a response's headers and body, since every byte of an hsblog response is sent again on each event.
+    def record_response_size(self, benchmark, rv):
+        benchmark.extra_info['response_bytes'] = len(str(rv.headers)) + len(rv.get_data())
+
+    def test_hsblog_anonymous(self, benchmark):
+        url = hsblog(act='', event='mChoice', answer='A', correct='F', div_id='test_div_id', course='test_child_course2')
+        self.get_valid_json(url, dict(log=True, is_authenticated=False))
+        # Once the visitor has a sid, no cookie is sent.
+        rv = self.test_client.get(url)
+        assert 'Set-Cookie' not in rv.headers
+        self.record_response_size(benchmark, rv)
+        self.run_benchmark(benchmark, 'hsblog_anonymous', lambda: self.test_client.get(url))
+        assert Useinfo.query.count() > 1
+
+    def test_hsblog_authenticated(self, benchmark):
+        # Incorrect answers are always stored, so every call does the full amount of work.
+        url = hsblog(act='', event='mChoice', answer='A', correct='F', div_id='test_div_id', course='test_child_course1')
+        with self.login_context:
+            self.get_valid_json(url, dict(log=True, is_authenticated=True))
+            self.record_response_size(benchmark, self.test_client.get(url))
+            self.run_benchmark(benchmark, 'hsblog_authenticated', lambda: self.test_client.get(url))
+        assert MchoiceAnswers.query.count() > 1
+
+    @pytest.mark.parametrize('column, value', [(Useinfo.event, 'mChoice'), (MchoiceAnswers.correct, 'T')])
+    def test_sql_validator(self, benchmark, column, value):
+        with app.test_request_context(hsblog(param=value)):
+            benchmark(sql_validator, 'param', column)
+
+    # Convert a typical mix of values.
+    def test_web2py_boolean_bind(self, benchmark):
+        bind = Web2PyBoolean().process_bind_param
+        dialect = db.engine.dialect
+        values = [True, False, None, True]*250
+        benchmark(lambda: [bind(value, dialect) for value in values])
+
+    def test_web2py_boolean_result(self, benchmark):
+        result = Web2PyBoolean().process_result_value
+        dialect = db.engine.dialect
+        values = ['T', 'F', None, 'T']*250
+        benchmark(lambda: [result(value, dialect) for value in values])
+
+    # The CPU time this process spends storing one answered event -- a Useinfo row and an answer -- through the ORM and through ``insert_row``. Timing CPU rather than wall-clock time leaves out the database's share of the work, which is the same either way.
+    @pytest.mark.benchmark(timer=process_time)
+    def test_insert_event_orm(self, benchmark):
+        useinfo, answer = self.event_rows()
+
+        def insert():
+            db.session.add(Useinfo(**useinfo))
+            db.session.add(MchoiceAnswers(**answer))
+            db.session.flush()
+        benchmark(insert)
+
+    @pytest.mark.benchmark(timer=process_time)
+    def test_insert_event_core(self, benchmark):
+        useinfo, answer = self.event_rows()
+
+        def insert():
+            insert_row(Useinfo, **useinfo)
+            insert_row(MchoiceAnswers, **answer)
+        benchmark(insert)
+
+    def event_rows(self):
+        common = dict(timestamp=datetime.now(), sid='student', div_id='test_div_id')
+        return (
+            dict(event='mChoice', act='answer:1:correct', course_id='test_child_course1', **common),
+            dict(answer='1', correct=True, course_name='test_child_course1', **common),
+        )
+
+    def test_hash_password(self, benchmark):
+        benchmark(app.user_manager.hash_password, 'grouplens')
+
+    # The per-request cost of the Prometheus `metrics <../runestone/metrics.py>`: the request hooks, plus counting one hsblog event and one cache lookup.
+    def test_metrics_overhead(self, benchmark):
+        response = Response()
+        with app.test_request_context(hsblog(event='mChoice')):
+            def record():
+                metrics._before_request()
+                metrics.count_cache_lookup('course', True)
+                metrics.count_hsblog_event('mChoice')
+                metrics._after_request(response)
+            benchmark(record)
+
+    # Read and check a visitor's signed `sid <../runestone/sid.py>`, as every hsblog call does.
+    def test_sid_cookie(self, benchmark):
+        new_sid = sid.new_sid()
+        with app.test_request_context():
+            cookie = sid._signer().sign('{}:{}'.format(sid.ANONYMOUS, new_sid).encode('utf-8')).decode('utf-8')
+        with app.test_request_context(headers={'Cookie': 'runestone_sid=' + cookie}):
+            def read_sid():
+                sid._before_request()
+                return sid.get_sid()
+            assert benchmark(read_sid) == new_sid
+            assert sid.is_anonymous_sid()
+
+
+# Analytics
+# =========
+# The number of answers in the synthetic course used by the analytics benchmarks. Set ``ANALYTICS_BENCHMARK_ROWS=1000000`` to time a large course; the default keeps the test suite quick.
+ANALYTICS_BENCHMARK_ROWS = int(os.environ.get('ANALYTICS_BENCHMARK_ROWS', 100000))
+
+
+# Fill test_child_course1 with answers from 2000 students to 50 questions, about 40% of them correct.
+def add_synthetic_answers(rows):
+    db.session.execute(db.text(
+        "insert into mchoice_answers (timestamp, div_id, sid, course_name, answer, correct) "
+        "select timestamp '2020-01-01' + i*interval '1 second', 'q' || (i % 50), 'student' || (i / 50 % 2000), "
+        "'test_child_course1', 'A', case when random() < 0.4 then 'T' else 'F' end "
+        "from generate_series(1, :rows) as i"
+    ), dict(rows=rows))
+
+
+# The ``question_report`` statistics computed the straightforward way: load each answer through the ORM, then update per-question and per-student totals one row at a time.
+def question_report_by_rows(course_name):
+    questions = {}
+    for model in scored_answer_models():
+        for answer in model.query.filter(model.course_name == course_name).order_by(model.div_id, model.sid, model.timestamp):
+            question = questions.setdefault(answer.div_id, dict(attempts=0, correct=0, students={}))
+            question['attempts'] += 1
+            student = question['students'].setdefault(answer.sid, dict(attempts=0, first_at=answer.timestamp, first_correct=None))
+            student['attempts'] += 1
+            if answer_score(answer.correct) == 100:
+                question['correct'] += 1
+                if student['first_correct'] is None:
+                    student['first_correct'] = (student['attempts'], (answer.timestamp - student['first_at']).total_seconds())
+
+    report = {}
+    for div_id, question in questions.items():
+        firsts = [student['first_correct'] for student in question['students'].values() if student['first_correct']]
+        report[div_id] = dict(
+            attempts=question['attempts'],
+            students=len(question['students']),
+            correct_rate=question['correct']/question['attempts'],
+            students_correct=len(firsts),
+            mean_attempts_to_correct=sum(attempts for attempts, _ in firsts)/len(firsts) if firsts else None,
+            median_seconds_to_correct=pd.Series([seconds for _, seconds in firsts], dtype=float).median(),
+        )
+    return pd.DataFrame.from_dict(report, orient='index').sort_index()
+
+
+class TestAnalyticsBenchmarks(BaseTest):
+    # Each round loads the whole course, so a few rounds suffice.
+    def test_question_report(self, benchmark):
+        add_synthetic_answers(ANALYTICS_BENCHMARK_ROWS)
+        report = benchmark.pedantic(lambda: question_report(load_answers('test_child_course1')), rounds=3)
+        assert report['attempts'].sum() == ANALYTICS_BENCHMARK_ROWS
+
+    def test_question_report_by_rows(self, benchmark):
+        add_synthetic_answers(ANALYTICS_BENCHMARK_ROWS)
+        report = benchmark.pedantic(question_report_by_rows, ('test_child_course1',), rounds=3)
+        # Both ways give the same results.
+        report.index.name = 'div_id'
+        pd.testing.assert_frame_equal(report, question_report(load_answers('test_child_course1')), check_dtype=False)
+
+    # Load every ``correct`` flag in the course, through the ORM and then in bulk. The ORM calls ``Web2PyBoolean.process_result_value`` once per row.
+    def test_load_correct_orm(self, benchmark):
+        add_synthetic_answers(ANALYTICS_BENCHMARK_ROWS)
+        query = db.session.query(MchoiceAnswers.correct).filter(MchoiceAnswers.course_name == 'test_child_course1').order_by(MchoiceAnswers.id)
+        correct = benchmark.pedantic(lambda: [row.correct for row in query], rounds=3)
+        assert len(correct) == ANALYTICS_BENCHMARK_ROWS
+
+    def test_load_correct_bulk(self, benchmark):
+        add_synthetic_answers(ANALYTICS_BENCHMARK_ROWS)
+        load = lambda: load_columns([MchoiceAnswers.correct], MchoiceAnswers.course_name == 'test_child_course1', MchoiceAnswers.id)['correct']
+        correct = benchmark.pedantic(load, rounds=3)
+        # Both ways give the same values.
+        assert correct.tolist() == [row.correct for row in db.session.query(MchoiceAnswers.correct).filter(MchoiceAnswers.course_name == 'test_child_course1').order_by(MchoiceAnswers.id)]